@@ -0,0 +1,1970 @@
+"""
+財報分析核心流程 (不依賴 Streamlit)：提示詞、API 呼叫、步驟依賴圖、結果快取與聊天上下文。
+streamlit_app.py 與 batch_analyze.py 共用本模組。
+"""
+import os
+import textwrap
+import time
+from io import BytesIO
+import re
+import json
+import hashlib
+import threading
+import uuid
+import queue
+import math
+import random
+import heapq
+import difflib
+from collections import Counter, OrderedDict, deque
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from lazy_import import LazyModule
+
+from ratio_engine import (
+    compute_ratios,
+    extraction_field_list,
+    infer_period_type,
+    merge_extraction,
+    missing_fields,
+    render_ratio_markdown,
+    resolve_inputs,
+)
+from pdf_pages import get_note_chunks, trimmed_pdf
+from prompt_registry import PromptRegistry, text_digest
+from report_tables import parse_report_tables, parse_results_tables
+
+# google.genai 匯入約需 0.5 秒以上，延遲到第一次建立請求內容時 (只使用解析器或快取的呼叫端不需要 SDK)
+types = LazyModule("google.genai.types")
+
+# 預設模型 (已修改為入門版 Flash)
+DEFAULT_MODEL = "gemini-3-flash-preview"
+# 進階模型：混合路由時負責最繁重的標準化提取 (見 ROUTING_POLICIES)
+PRO_MODEL = "gemini-3-pro-preview"
+
+CLIENT_MISSING_ERROR = "❌ 錯誤：Gemini CLIENT 未初始化，請檢查 GEMINI_API_KEY。"
+
+# =============================================================================
+# 1. 核心規則 (嚴禁更動)
+# =============================================================================
+
+# 各步驟的提示詞存放於 prompts/ 目錄 (可用環境變數覆寫)，由提示詞登記表 (get_prompt_registry()) 載入；
+# 修改檔案後最多 PROMPT_RELOAD_SECONDS 秒內生效，只有使用該提示詞的步驟 (與其下游) 的快取會失效。
+PROMPT_DIR = os.getenv('PROMPT_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'prompts'))
+PROMPT_RELOAD_SECONDS = float(os.getenv('PROMPT_RELOAD_SECONDS', '2'))
+PROMPT_FILES = {
+    "company_name": "系統提示詞_公司名稱.txt",  # 步驟 1：抓取公司名稱
+    "standardization": "系統提示詞_標準化.txt",  # 步驟 2：標準化提取 (各分片只送出所屬大項的規則行)
+    "ratio_inputs": "系統提示詞_比率欄位.txt",  # 步驟 3：標準化數據缺少的比率欄位才從 PDF 提取，{fields} 為缺少的項目清單
+    "summary": "系統提示詞_總結.txt",  # 步驟 4：總結
+    "explanation": "系統提示詞_講解.txt",  # 步驟 5：講解
+    "chat": "系統提示詞_聊天.txt",  # 聊天系統提示 (放入每份報告的快取上下文)
+}
+
+# 步驟 3：比率計算 (P/E 修正版)；現由本地比率引擎 (ratio_engine.py) 依此公式與限制計算
+PROMPT_RATIO_CONTENT = textwrap.dedent("""
+請根據以下計算公式及限制，計算股東權益報酬率 (ROE)、本益比 (P/E Ratio)、淨利率 (Net Profit Margin)、毛利率 (Gross Profit Margin)、負債比率 (Debt Ratio)、流動比率 (Current Ratio)、速動比率 (Quick Ratio) 之兩期數據。
+
+**注意：您必須輸出七個獨立的 Markdown 表格。**
+
+**除了本益比以外每個表格必須遵循以下嚴格的 3x2 格式要求 (3 欄 x 2 行)，本益比則只需 2x2 格式要求 (2 欄 x 2 行，無須比較期日期或期間的欄位第二欄名稱為本年度)：**
+
+| 財務比率名稱 (例如: 股東權益報酬率(ROE)) | [最近一期日期或期間] | [比較期日期或期間] |
+| :--- | :--- | :--- |
+| 比率 | [計算結果及單位，例如: 15.25%] | [計算結果及單位，例如: 12.80%] |
+
+**請嚴格遵守：**
+1. 輸出結果**必須是 7 個獨立的 Markdown 表格**，且只包含您計算出的數據和單位。
+2. 表格內容**只能是數字和單位** (例如 %、倍、次)。
+3. 表格的第一格**必須是比率名稱**，第二行第一格**必須是「比率」**這兩個字。
+**4. 禁止包含任何前言、開場白或問候語。您的回答必須直接從第一個 Markdown 表格 (股東權益報酬率) 開始。**
+
+計算公式：
+財務比率 (Financial Ratio),計算公式 (Formula),備註 (Notes)
+1. 股東權益報酬率 (ROE),(歸屬於母公司業主之本期淨利) / (歸屬於母公司業主之平均權益),當期（例如半年）數據計算。,其中，平均權益 = (期初歸屬於母公司業主之權益 + 期末歸屬於母公司業主之權益) / 2,
+2. 本益比 (P/E Ratio) (以當日收盤價格為基準), **(收盤價) / (年化每股盈餘)**。
+   **年化每股盈餘 (Annualized EPS) 計算規則 (必須嚴格遵守)：**
+   - 步驟 A: 判斷財報期間。
+   - 步驟 B: 根據期間調整 EPS：
+     - 若為第一季 (Q1, 1-3月): 年化 EPS = 本期 EPS x 4
+     - 若為上半年 (H1, 1-6月): 年化 EPS = 本期累計 EPS x 2
+     - 若為前三季 (Q3, 1-9月): 年化 EPS = (本期累計 EPS / 3) x 4
+     - 若為全年度 (Annual, 1-12月): 年化 EPS = 本期累計 EPS x 1
+   - 步驟 C: 使用指定的收盤價除以算出的年化 EPS。
+   *注意：使用基本每股盈餘。指定收盤價請使用 Google Search 搜尋使用本分析系統當日或前一日的收盤價格。*
+3. 淨利率 (Net Profit Margin),(本期淨利) / (營業收入),單季數據計算。
+4. 毛利率 (Gross Profit Margin),(營業毛利) / (營業收入),單季數據計算。
+5. 負債比率 (Debt Ratio),(負債總計) / (資產總計),期末時點數據計算。
+6. 流動比率 (Current Ratio),(流動資產合計) / (流動負債合計),期末時點數據計算。
+7. 速動比率 (Quick Ratio),(流動資產合計 - 存貨 - 預付款項) / (流動負債合計),期末時點數據計算，採保守定義。
+限制：
+唯一數據來源：除了公司的收盤價外所有的計算僅能使用您所提供的PDF財務報告檔案，除收盤價需上網絡查詢外，不得引用任何外部資訊。
+計算時間基準：毛利率、淨利率、本益比皆以「單季」數據進行計算；需要平均餘額的比率（ROE）以「當期」期間為基礎。
+平均餘額計算：分母的平均餘額必須採用該「當期」期間的期初餘額與期末餘額之平均。
+數據替換原則：若缺乏當期「期初」數據，則採用可取得的最近一期餘額來替代期初數據，並在報告中明確註明此近似處理。
+不進行年化處理：所有的比率計算結果直接呈現該期間的數據，不轉換為年化率，除非計算式有特別要求進行年化 (如 P/E)。
+內部驗證機制：在生成最終報告前，會進行內部雙重計算與核對。
+處理資料缺漏：若因缺乏必要的數據而無法計算，將明確標示為**「無法計算」**並註明原因。
+""")
+
+# =============================================================================
+# 2. API 呼叫函數
+# =============================================================================
+
+# 檔案在到期前多久就視為過期並重新上傳
+PDF_FILE_REFRESH_MARGIN = timedelta(minutes=30)
+
+class PdfFileRegistry:
+    """
+    PDF 上傳登記表 (跨 session 共用)：以內容 SHA-256 為鍵，每份 PDF 只透過 Files API 上傳一次。
+    只含部分頁面的精簡 PDF 以原始文件的 digest (document) 歸屬於同一份文件，各頁面群組同樣只上傳一次。
+    記錄每個檔案被哪些 session 使用，最後一個 session 釋放時才刪除遠端檔案。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}  # digest -> {"file": File, "document": 原始文件 digest, "holders": set(), "lock": Lock}
+
+    def get_part(self, client, pdf_bytes, holder, document=None):
+        """
+        取得 PDF 的檔案參照 Part；尚未上傳或即將到期時重新上傳。
+        document 為精簡 PDF 所屬原始文件的 digest (未提供時即為 pdf_bytes 本身)。
+        """
+        digest = hashlib.sha256(pdf_bytes).hexdigest()
+        document = document or digest
+        with self._lock:
+            entry = self._entries.setdefault(digest, {"file": None, "document": document, "holders": set(),
+                                                      "lock": threading.Lock()})
+            # 同一個 session 只持有目前這份文件 (含其精簡 PDF)
+            for other in self._entries.values():
+                if other["document"] != document: other["holders"].discard(holder)
+            entry["holders"].add(holder)
+
+        with entry["lock"]:
+            if self._is_stale(entry["file"]):
+                entry["file"] = self._upload(client, pdf_bytes, digest)
+            uploaded = entry["file"]
+
+        self._delete_unused(client)
+        return types.Part.from_uri(file_uri=uploaded.uri, mime_type=uploaded.mime_type or 'application/pdf')
+
+    def release(self, client, holder):
+        """釋放某個 session 持有的檔案 (清除資料時呼叫)。"""
+        with self._lock:
+            for entry in self._entries.values():
+                entry["holders"].discard(holder)
+        self._delete_unused(client)
+
+    @staticmethod
+    def _is_stale(uploaded):
+        if uploaded is None: return True
+        if uploaded.expiration_time is None: return False
+        return uploaded.expiration_time - PDF_FILE_REFRESH_MARGIN <= datetime.now(timezone.utc)
+
+    @staticmethod
+    def _upload(client, pdf_bytes, digest):
+        uploaded = client.files.upload(
+            file=BytesIO(pdf_bytes),
+            config=types.UploadFileConfig(mime_type='application/pdf', display_name=f"report-{digest[:16]}")
+        )
+        # PDF 通常立即可用；若仍在處理中則短暫輪詢
+        for _ in range(10):
+            if uploaded.state is None or uploaded.state.name != "PROCESSING": break
+            time.sleep(1)
+            uploaded = client.files.get(name=uploaded.name)
+        if uploaded.state is not None and uploaded.state.name == "FAILED":
+            raise Exception(f"檔案上傳處理失敗: {uploaded.name}")
+        return uploaded
+
+    def _delete_unused(self, client):
+        with self._lock:
+            unused = [d for d, e in self._entries.items() if not e["holders"]]
+            removed = [self._entries.pop(d) for d in unused]
+        for entry in removed:
+            if entry["file"] is None or client is None: continue
+            try:
+                client.files.delete(name=entry["file"].name)
+            except Exception:
+                pass  # 遠端檔案會在到期後自動刪除
+
+# 每個模型的請求速率上限 (每分鐘請求數 / 每分鐘 token 數)；未列出的模型使用 DEFAULT_RATE_LIMIT
+MODEL_RATE_LIMITS = {
+    "gemini-3-pro-preview": {"rpm": 25, "tpm": 1_000_000},
+    "gemini-3-flash-preview": {"rpm": 100, "tpm": 2_000_000},
+}
+DEFAULT_RATE_LIMIT = {"rpm": 30, "tpm": 1_000_000}
+
+# 重試、排隊與斷路器參數
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+MAX_ATTEMPTS = 4
+BACKOFF_BASE_SECONDS = 2.0
+BACKOFF_MAX_SECONDS = 60.0
+MAX_QUEUE_WAIT_SECONDS = 180.0
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_COOLDOWN_SECONDS = 30.0
+
+# 無法得知實際用量前的 token 預估 (中文約 2 字元 1 token；PDF 以固定值估算)
+PDF_TOKEN_ESTIMATE = 20_000
+
+class SchedulerBusyError(Exception):
+    """排隊等候超過上限 (系統忙碌)。"""
+
+class CircuitOpenError(Exception):
+    """模型連續失敗，斷路器開啟中，暫停送出請求。"""
+
+class TokenBucket:
+    """每分鐘補充 rate_per_min 單位的 token bucket；容量等於一分鐘的額度。"""
+
+    def __init__(self, rate_per_min):
+        self.capacity = float(rate_per_min)
+        self.rate_per_min = float(rate_per_min)
+        self.level = float(rate_per_min)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate_per_min / 60.0)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """距離可取出 amount 單位還需等待的秒數 (amount 超過容量時以容量計)。"""
+        self._refill(now)
+        missing = min(amount, self.capacity) - self.level
+        return 0.0 if missing <= 0 else missing * 60.0 / self.rate_per_min
+
+    def consume(self, amount):
+        self.level -= amount  # 可為負值 (實際用量高於預估時記為欠額)
+
+    def set_rate(self, rate_per_min):
+        self._refill(time.monotonic())
+        self.rate_per_min = float(rate_per_min)
+
+class _ModelState:
+    def __init__(self, limits):
+        self.configured_rpm = limits["rpm"]
+        self.requests = TokenBucket(limits["rpm"])
+        self.tokens = TokenBucket(limits["tpm"])
+        self.queued = 0
+        self.in_flight = 0
+        self.consecutive_failures = 0
+        self.circuit_open_until = 0.0
+
+def estimate_tokens(contents):
+    total = 0
+    for item in contents if isinstance(contents, list) else [contents]:
+        if isinstance(item, str):
+            total += len(item) // 2
+        elif isinstance(item, types.Content):
+            total += estimate_tokens(list(item.parts or []))
+        elif isinstance(item, types.Part):
+            total += len(item.text) // 2 if item.text else PDF_TOKEN_ESTIMATE
+    return total
+
+def retry_after_seconds(exc):
+    """讀取錯誤回應的 Retry-After 標頭或 RetryInfo.retryDelay (例如 "12s")。"""
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    if headers:
+        try:
+            return float(headers.get("retry-after"))
+        except (TypeError, ValueError):
+            pass
+    match = re.search(r'"retryDelay":\s*"([\d.]+)s"', json.dumps(getattr(exc, "details", None) or {}, default=str))
+    return float(match.group(1)) if match else None
+
+def is_retryable(exc):
+    code = getattr(exc, "code", None)
+    if isinstance(code, int):
+        return code in RETRYABLE_STATUS_CODES
+    # 連線層錯誤 (httpx 逾時、連線中斷) 也值得重試
+    return isinstance(exc, (ConnectionError, TimeoutError)) or type(exc).__module__.startswith("httpx")
+
+class RequestScheduler:
+    """
+    程序層級的 API 請求排程器，所有 call_*_api 共用 (Streamlit 的所有 session 與批次工作)。
+    - 每個模型各自的請求數 / token 數 token bucket，額度不足時排隊等待
+    - 429/503 等可重試錯誤採指數退避 + 隨機抖動，並優先遵守 Retry-After
+    - 遇到 429 時自動降低該模型的請求速率，成功後逐步恢復
+    - 連續失敗達門檻時開啟斷路器，冷卻期間直接失敗，避免所有使用者同時撞上配額錯誤
+      (只計入可重試的錯誤；400 等請求本身的錯誤代表服務正常，不會讓其他 session 無法使用該模型)
+    """
+
+    def __init__(self, rate_limits=None):
+        self.rate_limits = rate_limits or MODEL_RATE_LIMITS
+        self._cond = threading.Condition()
+        self._models = {}
+
+    def _state(self, model):
+        if model not in self._models:
+            self._models[model] = _ModelState(self.rate_limits.get(model, DEFAULT_RATE_LIMIT))
+        return self._models[model]
+
+    def _acquire(self, model, est_tokens):
+        deadline = time.monotonic() + MAX_QUEUE_WAIT_SECONDS
+        with self._cond:
+            state = self._state(model)
+            state.queued += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    if now < state.circuit_open_until:
+                        raise CircuitOpenError(f"{model} 暫時無法使用 (連續失敗)，請 {state.circuit_open_until - now:.0f} 秒後再試。")
+                    wait_for = max(state.requests.wait_time(1, now), state.tokens.wait_time(est_tokens, now))
+                    if wait_for <= 0:
+                        state.requests.consume(1)
+                        state.tokens.consume(est_tokens)
+                        state.in_flight += 1
+                        return
+                    if now + wait_for > deadline:
+                        raise SchedulerBusyError(f"目前 {model} 的請求量過大 (排隊 {state.queued} 筆)，請稍後再試。")
+                    self._cond.wait(timeout=min(wait_for, 1.0))
+            finally:
+                state.queued -= 1
+
+    def _release(self, model, success, throttled=False, retryable=True):
+        with self._cond:
+            state = self._state(model)
+            state.in_flight -= 1
+            if not success and not retryable:
+                state.consecutive_failures = 0
+            elif success:
+                state.consecutive_failures = 0
+                state.requests.set_rate(min(state.configured_rpm, state.requests.rate_per_min + state.configured_rpm * 0.05))
+            else:
+                state.consecutive_failures += 1
+                if throttled:
+                    state.requests.set_rate(max(1.0, state.requests.rate_per_min * 0.5))
+                if state.consecutive_failures >= CIRCUIT_FAILURE_THRESHOLD:
+                    state.circuit_open_until = time.monotonic() + CIRCUIT_COOLDOWN_SECONDS
+            self._cond.notify_all()
+
+    def record_usage(self, model, actual_tokens, est_tokens):
+        """以實際用量修正預估值 (usage_metadata.total_token_count)。"""
+        if not actual_tokens: return
+        with self._cond:
+            self._state(model).tokens.consume(actual_tokens - est_tokens)
+
+    def execute(self, model, fn, est_tokens=0, call_info=None, max_attempts=None):
+        """
+        在速率限制下執行 fn()，可重試的錯誤自動退避重試 (最多 max_attempts 次，預設 MAX_ATTEMPTS)；回傳 fn() 的結果。
+        提供 call_info (dict) 時寫入實際嘗試次數 "attempts"。
+        """
+        max_attempts = max_attempts or MAX_ATTEMPTS
+        for attempt in range(max_attempts):
+            if call_info is not None: call_info["attempts"] = attempt + 1
+            self._acquire(model, est_tokens)
+            try:
+                result = fn()
+            except Exception as e:
+                throttled = getattr(e, "code", None) == 429
+                retryable = is_retryable(e)
+                self._release(model, success=False, throttled=throttled, retryable=retryable)
+                if attempt == max_attempts - 1 or not retryable:
+                    raise
+                delay = retry_after_seconds(e)
+                if delay is None:
+                    delay = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+                time.sleep(delay)
+            else:
+                self._release(model, success=True)
+                return result
+
+    def queue_depth(self, model=None):
+        with self._cond:
+            states = [self._state(model)] if model else list(self._models.values())
+            return sum(state.queued for state in states)
+
+    def stats(self):
+        """每個模型的排隊數、進行中請求數、目前速率與斷路器狀態。"""
+        now = time.monotonic()
+        with self._cond:
+            return {
+                model: {
+                    "queued": state.queued,
+                    "in_flight": state.in_flight,
+                    "rpm": round(state.requests.rate_per_min, 1),
+                    "circuit_open": now < state.circuit_open_until,
+                }
+                for model, state in self._models.items()
+            }
+
+_SCHEDULER = RequestScheduler()
+
+def get_scheduler():
+    return _SCHEDULER
+
+# API 呼叫紀錄 (JSONL)，供設定對話框的「診斷」分頁統計各步驟延遲與 token 用量
+CALL_LOG_PATH = os.getenv('API_CALL_LOG', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs', 'api_calls.jsonl'))
+
+class CallLogger:
+    """以 JSONL 追加寫入每次 API 呼叫 (與結果快取命中) 的紀錄。"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def record(self, **fields):
+        fields.setdefault("ts", time.time())
+        line = json.dumps(fields, ensure_ascii=False)
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+    def read(self, limit=5000):
+        """讀取最近 limit 筆紀錄。"""
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                lines = f.readlines()[-limit:]
+        except OSError:
+            return []
+        records = []
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+        return records
+
+_CALL_LOGGER = CallLogger(CALL_LOG_PATH)
+
+def get_call_logger():
+    return _CALL_LOGGER
+
+def percentile(values, pct):
+    """最近秩 (nearest-rank) 百分位數；values 為空時回傳 None。"""
+    if not values: return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+def summarize_call_log(records):
+    """
+    彙整呼叫紀錄：回傳 (各步驟統計, 各報告 token 總量)。
+    步驟統計包含呼叫數、快取命中率、p50/p95 延遲與平均 token；快取命中不計入延遲。
+    """
+    by_step = {}
+    by_report = {}
+    for record in records:
+        step = record.get("step") or "other"
+        by_step.setdefault(step, []).append(record)
+        if record.get("report") and record.get("cache") != "hit":
+            report = by_report.setdefault(record["report"], {"report": record["report"][:12], "model": record.get("model"), "calls": 0, "prompt_tokens": 0, "response_tokens": 0})
+            report["calls"] += 1
+            report["prompt_tokens"] += record.get("prompt_tokens") or 0
+            report["response_tokens"] += record.get("response_tokens") or 0
+
+    step_rows = []
+    for step, step_records in sorted(by_step.items()):
+        calls = [r for r in step_records if r.get("cache") != "hit"]
+        latencies = [r["latency"] for r in calls if r.get("latency") is not None and not r.get("error")]
+        step_rows.append({
+            "step": step,
+            "calls": len(calls),
+            "cache_hit_rate": round(1 - len(calls) / len(step_records), 2),
+            "errors": sum(1 for r in calls if r.get("error")),
+            "avg_attempts": round(sum(r.get("attempts") or 1 for r in calls) / len(calls), 2) if calls else None,
+            "p50_latency_s": percentile(latencies, 50),
+            "p95_latency_s": percentile(latencies, 95),
+            "avg_prompt_tokens": round(sum(r.get("prompt_tokens") or 0 for r in calls) / len(calls)) if calls else None,
+            "avg_response_tokens": round(sum(r.get("response_tokens") or 0 for r in calls) / len(calls)) if calls else None,
+        })
+    return step_rows, list(by_report.values())
+
+def _usage_fields(usage):
+    if usage is None: return {}
+    return {
+        "prompt_tokens": usage.prompt_token_count,
+        "response_tokens": usage.candidates_token_count,
+        "cached_tokens": usage.cached_content_token_count,
+        "total_tokens": usage.total_token_count,
+    }
+
+def log_api_call(model, started, call_info, usage=None, tags=None, error=None):
+    record = dict(tags or {}, model=model, latency=round(time.monotonic() - started, 3),
+                  attempts=call_info.get("attempts"), **_usage_fields(usage))
+    if error: record["error"] = error[:500]
+    try:
+        get_call_logger().record(**record)
+    except OSError:
+        pass  # 紀錄失敗不影響分析流程
+
+def generate_text(client, model, contents, config, on_chunk=None, tags=None, max_attempts=None):
+    """
+    透過排程器呼叫模型並回傳完整文字。提供 on_chunk 時改用串流 API，
+    每收到一段輸出就以「目前累積的全文」呼叫 on_chunk (重試時會自然覆蓋先前內容)。
+    tags (例如 {"step": ..., "report": ...}) 會寫入呼叫紀錄；max_attempts 見 RequestScheduler.execute。
+    """
+    est_tokens = estimate_tokens(contents)
+
+    def run():
+        if on_chunk is None:
+            response = client.models.generate_content(model=model, contents=contents, config=config)
+            return response.text, response.usage_metadata
+        text, usage = "", None
+        for chunk in client.models.generate_content_stream(model=model, contents=contents, config=config):
+            usage = chunk.usage_metadata or usage
+            if chunk.text:
+                text += chunk.text
+                on_chunk(text)
+        return text, usage
+
+    call_info = {}
+    started = time.monotonic()
+    try:
+        text, usage = get_scheduler().execute(model, run, est_tokens, call_info, max_attempts=max_attempts)
+    except Exception as e:
+        log_api_call(model, started, call_info, tags=tags, error=str(e))
+        raise
+    log_api_call(model, started, call_info, usage, tags)
+    get_scheduler().record_usage(model, usage.total_token_count if usage else None, est_tokens)
+    return text
+
+def call_multimodal_api(client, pdf_part, prompt, use_search=False, model_name=DEFAULT_MODEL, on_chunk=None, tags=None,
+                        max_attempts=None):
+    if client is None: return {"error": CLIENT_MISSING_ERROR}
+    
+    contents = [pdf_part, prompt] 
+    tools_config = [{"google_search": {}}] if use_search else None
+    config = types.GenerateContentConfig(temperature=0.0, tools=tools_config)
+
+    try:
+        content = generate_text(client, model_name, contents, config, on_chunk=on_chunk, tags=tags, max_attempts=max_attempts)
+        return {"status": "success", "content": content}
+    except Exception as e:
+        return {"error": str(e)}
+
+def call_text_api(client, input_text, prompt, model_name=DEFAULT_MODEL, on_chunk=None, tags=None, max_attempts=None):
+    if client is None: return {"error": CLIENT_MISSING_ERROR}
+    contents = [input_text, prompt] 
+    config = types.GenerateContentConfig(temperature=0.0)
+
+    try:
+        content = generate_text(client, model_name, contents, config, on_chunk=on_chunk, tags=tags, max_attempts=max_attempts)
+        return {"status": "success", "content": content}
+    except Exception as e:
+        return {"error": str(e)}
+
+def call_chat_api(client, contents, model_name=DEFAULT_MODEL, config=None, tags=None):
+    if client is None: return {"error": CLIENT_MISSING_ERROR}
+    config = config or types.GenerateContentConfig(temperature=1.2, tools=[{"google_search": {}}])
+
+    try:
+        content = generate_text(client, model_name, contents, config, tags=tags or {"step": "chat"})
+        return {"status": "success", "content": content}
+    except Exception as e:
+        return {"error": str(e)}
+
+def stream_chat_api(client, contents, model_name=DEFAULT_MODEL, config=None, raise_errors=False, tags=None):
+    """call_chat_api 的串流版本：逐段 yield 文字，錯誤時 yield 錯誤訊息 (raise_errors=True 時改為拋出)。"""
+    if client is None:
+        yield f"❌ Error: {CLIENT_MISSING_ERROR}"
+        return
+    config = config or types.GenerateContentConfig(temperature=1.2, tools=[{"google_search": {}}])
+    est_tokens = estimate_tokens(contents)
+
+    def open_stream():
+        # 取得第一段輸出才算請求成功；之後的中斷不再重試 (已輸出的內容無法收回)
+        stream = client.models.generate_content_stream(model=model_name, contents=contents, config=config)
+        return next(stream, None), stream
+
+    call_info = {}
+    started = time.monotonic()
+    try:
+        first, stream = get_scheduler().execute(model_name, open_stream, est_tokens, call_info)
+        usage = None
+        if first is not None:
+            usage = first.usage_metadata
+            if first.text: yield first.text
+        for chunk in stream:
+            usage = chunk.usage_metadata or usage
+            if chunk.text: yield chunk.text
+        log_api_call(model_name, started, call_info, usage, tags or {"step": "chat"})
+        get_scheduler().record_usage(model_name, usage.total_token_count if usage else None, est_tokens)
+    except Exception as e:
+        log_api_call(model_name, started, call_info, tags=tags or {"step": "chat"}, error=str(e))
+        if raise_errors: raise
+        yield f"\n\n❌ Error: {e}"
+
+# =============================================================================
+# 3. 分析步驟與結果快取
+# =============================================================================
+
+# 結果快取目錄與容量上限 (可用環境變數覆寫)
+RESULT_CACHE_DIR = os.getenv('ANALYSIS_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'analysis_results'))
+RESULT_CACHE_MAX_BYTES = int(os.getenv('ANALYSIS_CACHE_MAX_MB', '200')) * 1024 * 1024
+
+class AnalysisResultCache:
+    """
+    以內容定址的分析結果磁碟快取：每個步驟的輸出存成一個 JSON 檔，重啟後仍有效。
+    讀取時更新檔案修改時間作為 LRU 依據，總容量超過上限時刪除最久未使用的項目。
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def contains(self, key):
+        return os.path.exists(self._path(key))
+
+    def get_entry(self, key):
+        """回傳快取項目 (含 put 時的 meta 與 "content")，不存在時回傳 None。"""
+        path = self._path(key)
+        try:
+            with open(path, encoding='utf-8') as f:
+                entry = json.load(f)
+            if "content" not in entry: raise KeyError("content")
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            with self._lock: self.misses += 1
+            return None
+        with self._lock: self.hits += 1
+        return entry
+
+    def get(self, key):
+        entry = self.get_entry(key)
+        return None if entry is None else entry["content"]
+
+    def put(self, key, content, **meta):
+        path = self._path(key)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(dict(meta, content=content, created=time.time()), f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.json'): continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        return entries
+
+    def _evict(self):
+        with self._lock:
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, name in entries:
+                if total <= self.max_bytes: break
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                    total -= size
+                except OSError:
+                    pass
+
+    def stats(self):
+        entries = self._entries()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(entries),
+            "bytes": sum(size for _, size, _ in entries),
+        }
+
+    def clear(self):
+        for _, _, name in self._entries():
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+
+# 上傳 PDF 的共用儲存區：超過 DOCUMENT_SPILL_BYTES 的檔案寫入磁碟，閒置超過 DOCUMENT_IDLE_TTL 的持有者自動釋放
+DOCUMENT_STORE_DIR = os.getenv('DOCUMENT_STORE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'documents'))
+DOCUMENT_SPILL_BYTES = int(float(os.getenv('DOCUMENT_SPILL_MB', '1')) * 1024 * 1024)
+DOCUMENT_IDLE_TTL = timedelta(hours=2)
+DOCUMENT_READ_CHUNK = 1024 * 1024
+# 儲存區只管理自己命名的檔案 (<digest>.pdf 與暫存的 <uuid>.tmp)，各程序寫入自己的子目錄 (proc-<pid>)
+DOCUMENT_FILE_NAME = re.compile(r"^(?:[0-9a-f]{64}\.pdf|[0-9a-f]{32}\.tmp)$")
+DOCUMENT_PROCESS_DIR = re.compile(r"^proc-(\d+)$")
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True  # 存在但無權限
+    return True
+
+class DocumentStore:
+    """
+    程序層級的 PDF 儲存區 (跨 session 共用)：以內容 SHA-256 為鍵，相同檔案只保存一份。
+    session 只記錄 digest；小檔案留在記憶體，大檔案寫入磁碟，專案隨附的範例檔直接引用原始路徑。
+    每份文件記錄持有者 (session) 與最後使用時間，沒有持有者 (釋放或閒置逾時) 時即移除。
+    大檔案寫入 store_dir 下本程序專用的子目錄，多個伺服器程序可共用同一個 store_dir。
+    """
+
+    def __init__(self, store_dir, spill_bytes=DOCUMENT_SPILL_BYTES, idle_ttl=DOCUMENT_IDLE_TTL):
+        self.store_dir = os.path.join(store_dir, f"proc-{os.getpid()}")
+        self.spill_bytes = spill_bytes
+        self.idle_ttl = idle_ttl.total_seconds()
+        self._lock = threading.Lock()
+        self._entries = {}  # digest -> {"data": bytes | None, "path": str | None, "owned": bool, "size": int, "holders": {holder: 最後使用時間}}
+        os.makedirs(store_dir, exist_ok=True)
+        # 已結束的程序 (與本程序先前使用相同 pid 的程序) 遺留的檔案已無人持有；其他檔案一律不動
+        for name in os.listdir(store_dir):
+            match = DOCUMENT_PROCESS_DIR.match(name)
+            if match and (int(match.group(1)) == os.getpid() or not _process_alive(int(match.group(1)))):
+                self._remove_leftovers(os.path.join(store_dir, name))
+        os.makedirs(self.store_dir, exist_ok=True)
+
+    @staticmethod
+    def _remove_leftovers(directory):
+        """只刪除符合儲存區命名的檔案，目錄清空後才移除。"""
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return
+        for name in names:
+            if not DOCUMENT_FILE_NAME.match(name): continue
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+        try:
+            os.rmdir(directory)
+        except OSError:
+            pass
+
+    def put_file(self, fileobj, holder):
+        """以串流方式讀入檔案物件 (例如 st.file_uploader 的結果) 並回傳 digest，不會在記憶體中產生多餘副本。"""
+        sha = hashlib.sha256()
+        head, size = [], 0
+        tmp_path, tmp = None, None
+        try:
+            while True:
+                chunk = fileobj.read(DOCUMENT_READ_CHUNK)
+                if not chunk: break
+                sha.update(chunk)
+                size += len(chunk)
+                if tmp is None and size > self.spill_bytes:
+                    tmp_path = os.path.join(self.store_dir, f"{uuid.uuid4().hex}.tmp")
+                    tmp = open(tmp_path, "wb")
+                    tmp.writelines(head)
+                    head = []
+                if tmp is not None:
+                    tmp.write(chunk)
+                else:
+                    head.append(chunk)
+        finally:
+            if tmp is not None: tmp.close()
+
+        digest = sha.hexdigest()
+        if tmp_path is None:
+            entry = {"data": b"".join(head), "path": None, "owned": False, "size": size}
+        else:
+            entry = {"data": None, "path": os.path.join(self.store_dir, f"{digest}.pdf"), "owned": True, "size": size}
+        self._add(digest, entry, holder, tmp_path)
+        return digest
+
+    def put_path(self, path, holder):
+        """登記磁碟上既有的檔案 (範例 PDF)：只計算雜湊並引用原始路徑，不複製內容。"""
+        sha = hashlib.sha256()
+        size = 0
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(DOCUMENT_READ_CHUNK), b""):
+                sha.update(chunk)
+                size += len(chunk)
+        digest = sha.hexdigest()
+        self._add(digest, {"data": None, "path": os.path.abspath(path), "owned": False, "size": size}, holder)
+        return digest
+
+    def _add(self, digest, entry, holder, tmp_path=None):
+        with self._lock:
+            existing = self._entries.get(digest)
+            if existing is None:
+                if tmp_path is not None: os.replace(tmp_path, entry["path"])
+                entry["holders"] = {}
+                self._entries[digest] = existing = entry
+            elif tmp_path is not None:
+                os.remove(tmp_path)  # 已有相同內容
+            # 同一個 session 只持有目前這份文件
+            for other in self._entries.values():
+                other["holders"].pop(holder, None)
+            existing["holders"][holder] = time.monotonic()
+        self._evict()
+
+    def contains(self, digest):
+        with self._lock:
+            return digest in self._entries
+
+    def get(self, digest, holder=None):
+        """取得文件內容 (bytes)；已被移除時回傳 None。提供 holder 時同時更新其最後使用時間。"""
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None: return None
+            if holder is not None and holder in entry["holders"]:
+                entry["holders"][holder] = time.monotonic()
+            if entry["data"] is not None: return entry["data"]
+            path = entry["path"]
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def touch(self, digest, holder):
+        """更新 holder 對文件的最後使用時間 (例如聊天仍在使用文件時)；文件已被移除時回傳 False。"""
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None: return False
+            entry["holders"][holder] = time.monotonic()
+            return True
+
+    def hold(self, digest, holder):
+        """
+        讓 holder 改為持有已在儲存區中的文件 (同一個 holder 只持有一份，例如 session 的增量更新基準)；
+        文件已被移除時回傳 False。
+        """
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None: return False
+            for other in self._entries.values():
+                other["holders"].pop(holder, None)
+            entry["holders"][holder] = time.monotonic()
+        self._evict()
+        return True
+
+    def release(self, holder):
+        """釋放某個 session 持有的文件 (清除資料時呼叫)。"""
+        with self._lock:
+            for entry in self._entries.values():
+                entry["holders"].pop(holder, None)
+        self._evict()
+
+    def _evict(self):
+        deadline = time.monotonic() - self.idle_ttl
+        with self._lock:
+            for entry in self._entries.values():
+                for holder, last_used in list(entry["holders"].items()):
+                    if last_used < deadline: del entry["holders"][holder]
+            unused = [d for d, e in self._entries.items() if not e["holders"]]
+            removed = [self._entries.pop(d) for d in unused]
+        for entry in removed:
+            if not entry["owned"]: continue
+            try:
+                os.remove(entry["path"])
+            except OSError:
+                pass
+
+    def stats(self):
+        self._evict()
+        with self._lock:
+            entries = list(self._entries.values())
+        return {
+            "documents": len(entries),
+            "holders": sum(len(e["holders"]) for e in entries),
+            "memory_bytes": sum(e["size"] for e in entries if e["data"] is not None),
+            "disk_bytes": sum(e["size"] for e in entries if e["owned"]),
+        }
+
+def compute_step_cache_keys(steps, pdf_digest, model_name, params=None):
+    """
+    依拓撲順序計算每個步驟的快取鍵。下游步驟的鍵包含上游步驟的鍵，
+    因此只修改某一步驟的提示詞時，只有該步驟 (與其下游) 需要重新執行。
+    步驟的 "cache_params" 列出會影響結果的額外參數 (取自 params，例如收盤價)；
+    "pages" (送給模型的頁面群組) 與 "carried" (增量更新沿用的先前結果) 也屬於輸入的一部分；
+    步驟的 "model" (見 route_steps) 取代 model_name。
+    """
+    params = params or {}
+    keys = {}
+    remaining = list(steps)
+    while remaining:
+        for step in list(remaining):
+            if not all(d in keys for d in step["deps"]): continue
+            parts = [pdf_digest, step.get("model") or model_name, step["key"], text_digest(step["prompt"])]
+            parts += [keys[d] for d in step["deps"]]
+            parts += [f"{name}={params.get(name)}" for name in step.get("cache_params", ())]
+            if step.get("pages"): parts.append("pages=" + ",".join(step["pages"]))
+            if step.get("carried"): parts.append("carried=" + text_digest(step["carried"]))
+            keys[step["key"]] = hashlib.sha256("|".join(parts).encode('utf-8')).hexdigest()
+            remaining.remove(step)
+    return keys
+
+def rekey_step(key, changed_inputs):
+    """
+    由預先計算的快取鍵衍生新鍵：步驟改用備援模型 ("model=...") 或上游步驟的鍵改變時使用，
+    讓這些結果不會佔用主要模型的快取鍵 (下次執行時仍會重新嘗試主要模型)。
+    """
+    if not changed_inputs: return key
+    return hashlib.sha256("|".join([key, *changed_inputs]).encode('utf-8')).hexdigest()
+
+def prompt_version(steps=None):
+    """
+    整個分析流程的版本雜湊 (各步驟提示詞、依賴與頁面設定)；任一步驟改變時版本即不同。
+    預設流程 (目前的提示詞) 的版本在提示詞未變動時只計算一次 (首頁每次 rerun 都會查詢範例結果的版本)。
+    """
+    if steps is None: return _current_steps()["version"]
+    keys = compute_step_cache_keys(steps, "", "")
+    return text_digest("|".join(keys[step["key"]] for step in steps))
+
+def run_ratio_step(step, ctx):
+    """
+    步驟 3：以本地比率引擎計算七項比率。所需欄位優先取自標準化數據，
+    缺少的欄位才以精簡提示詞 (不使用搜尋) 從 PDF 提取；收盤價由 ctx["closing_price"] 提供。
+    回傳格式與 call_*_api 相同。
+    """
+    values, labels, bases = resolve_inputs(parse_report_tables(ctx["standardization"], "standardization"))
+    period_type = infer_period_type(labels)
+    missing = missing_fields(values)
+    if missing and ctx.get("client") is not None:
+        response = call_multimodal_api(
+            client=ctx["client"],
+            pdf_part=ctx["load_pdf_part"](step.get("pages")),
+            prompt=step["prompt"].format(fields=extraction_field_list(missing)),
+            use_search=False,
+            model_name=ctx["model_name"],
+            on_chunk=ctx.get("on_chunk"),
+            tags=ctx.get("tags"),
+            max_attempts=ctx.get("max_attempts")
+        )
+        if response.get("error"): return response
+        values, labels, bases, extracted_type = merge_extraction(values, labels, bases, response["content"])
+        period_type = extracted_type or period_type or infer_period_type(labels)
+    ratios = compute_ratios(values, closing_price=ctx.get("closing_price"), period_type=period_type, bases=bases)
+    return {"status": "success", "content": render_ratio_markdown(ratios, labels)}
+
+# 步驟 2 依相關大項拆成數個分片同時提取 (各自重試與快取)，完成後依規則原本的順序合併為單一標準化結果。
+# "sections" 為標準化提示詞中大項的序號 (1~37)；每個大項必須恰好屬於一個分片。
+STANDARDIZATION_SHARDS = [
+    {"key": "standardization_disclosures", "name": "公司概況與揭露事項", "sections": (1, 2, 3, 4, 5, 31, 34, 36, 37)},
+    {"key": "standardization_assets", "name": "資產", "sections": (6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16)},
+    {"key": "standardization_liabilities", "name": "負債與權益", "sections": (17, 18, 19, 32, 33)},
+    {"key": "standardization_income", "name": "損益", "sections": (20, 21, 22, 23, 24, 25, 26, 27, 28)},
+    {"key": "standardization_cash_flow", "name": "現金流量與金融工具", "sections": (29, 30, 35)},
+]
+ANALYSIS_MAX_WORKERS = 1 + len(STANDARDIZATION_SHARDS)
+
+# 模型路由：依步驟群組選擇模型。單一模型 (預設) 時每個步驟都使用使用者選擇的模型；
+# 混合路由只把 37 大項的標準化提取交給 Pro，識別公司名稱、補充比率欄位、總結與講解使用 Flash。
+# 群組 -> (顯示名稱, 步驟 key)；不呼叫模型的本地步驟 (附註比對、合併) 不需要路由。
+ROUTING_GROUPS = {
+    "company_name": ("識別公司名稱", ("company_name",)),
+    "standardization": ("標準化提取", tuple(shard["key"] for shard in STANDARDIZATION_SHARDS)),
+    "ratio": ("補充比率欄位", ("ratio",)),
+    "summary": ("專業審計總結", ("summary",)),
+    "explanation": ("白話文講解", ("explanation",)),
+}
+ROUTING_POLICIES = {
+    "hybrid": {
+        "company_name": DEFAULT_MODEL,
+        "standardization": PRO_MODEL,
+        "ratio": DEFAULT_MODEL,
+        "summary": DEFAULT_MODEL,
+        "explanation": DEFAULT_MODEL,
+    },
+}
+# 備援模型：主要模型失敗 (錯誤、排隊逾時或熔斷) 時改用另一個模型重新執行該步驟
+MODEL_FALLBACKS = {PRO_MODEL: DEFAULT_MODEL, DEFAULT_MODEL: PRO_MODEL}
+# 有備援模型時，主要模型只嘗試這麼多次就改用備援 (不必等完整的退避重試)
+FALLBACK_PRIMARY_ATTEMPTS = 2
+# 預設路由 (空白為單一模型，或 ROUTING_POLICIES 的名稱) 與是否啟用備援，可用環境變數覆寫
+MODEL_ROUTING = os.getenv('MODEL_ROUTING', '')
+MODEL_FALLBACK = os.getenv('MODEL_FALLBACK', '0') == '1'
+
+def routing_policy(name):
+    """路由策略名稱 -> {群組: 模型} (空白或 None 為單一模型，回傳 None)。"""
+    if not name: return None
+    if name not in ROUTING_POLICIES:
+        raise ValueError(f"未知的模型路由: {name}")
+    return dict(ROUTING_POLICIES[name])
+
+def route_steps(steps, model_name, routing=None, fallback=False):
+    """
+    為呼叫模型的步驟指定 "model" (routing 為 {群組: 模型}，未列出的群組使用 model_name)，
+    fallback 為 True 時另外指定 "fallback_model" (見 MODEL_FALLBACKS)。回傳新的步驟 list。
+    步驟的快取鍵包含其模型，因此改變路由只會重新執行模型不同的步驟。
+    """
+    groups = {key: group for group, (_, keys) in ROUTING_GROUPS.items() for key in keys}
+    routed = []
+    for step in steps:
+        if not step["prompt"] or step["key"] not in groups:
+            routed.append(step)
+            continue
+        model = (routing or {}).get(groups[step["key"]]) or model_name
+        fallback_model = MODEL_FALLBACKS.get(model) if fallback else None
+        routed.append(dict(step, model=model, fallback_model=fallback_model))
+    return routed
+
+def summarize_routing(routes):
+    """分析結果的 "routing" 依群組彙整為 [(顯示名稱, 實際使用的模型 list, 改用備援的步驟數)]。"""
+    summary = []
+    for label, keys in ROUTING_GROUPS.values():
+        entries = [routes[key] for key in keys if key in (routes or {})]
+        if not entries: continue
+        models = sorted({entry["model"] for entry in entries})
+        summary.append((label, models, sum(1 for entry in entries if entry.get("fallback_from"))))
+    return summary
+
+def run_routed_step(step, ctx):
+    """
+    以步驟指定的模型執行 (未指定時使用 ctx["model_name"])；失敗時改用 "fallback_model" 重新執行。
+    回傳格式與 call_*_api 相同，另含實際使用的 "model"，改用備援時含主要模型的錯誤 "fallback_from"。
+    """
+    model = step.get("model") or ctx["model_name"]
+    fallback_model = step.get("fallback_model")
+    attempts = FALLBACK_PRIMARY_ATTEMPTS if fallback_model else ctx.get("max_attempts")
+    response = step["run"](step, dict(ctx, model_name=model, max_attempts=attempts))
+    if response.get("error") and fallback_model:
+        error = response["error"]
+        tags = dict(ctx.get("tags") or {}, fallback_from=model)
+        response = step["run"](step, dict(ctx, model_name=fallback_model, tags=tags))
+        if response.get("error"):
+            response = dict(response, error=f"{model}: {error}；備援 {fallback_model}: {response['error']}")
+        return dict(response, model=fallback_model, fallback_from={"model": model, "error": error})
+    return dict(response, model=model)
+
+_SECTION_RULE = re.compile(r"^[一二三四五六七八九十]+、")
+
+def standardization_sections(prompt=None):
+    """拆解標準化提示詞 (預設為目前的提示詞檔案)：回傳 (限制說明各行, {序號: 大項規則行})。"""
+    header, rules = [], {}
+    for line in (prompt if prompt is not None else _PROMPTS.get("standardization")).strip().splitlines():
+        if _SECTION_RULE.match(line):
+            rules[len(rules) + 1] = line
+        else:
+            header.append(line)
+    return header, rules
+
+def section_name(rule_line):
+    """大項規則行的名稱，例如「六、現金及約當現金,…」→「現金及約當現金」。"""
+    return _SECTION_RULE.sub("", rule_line).split(",")[0].strip()
+
+def build_shard_prompt(sections, prompt=None):
+    """只含指定大項的標準化提示詞 (限制說明不變，大項數量依分片調整)。"""
+    header, rules = standardization_sections(prompt)
+    total, count = len(rules), len(sections)
+    header = [line.replace(f"{total} 個大項", f"{count} 個大項").replace(f"{total} 項規則", f"{count} 項規則") for line in header]
+    return "\n".join(header + [rules[n] for n in sections]) + "\n"
+
+def section_rule_digests(prompt=None):
+    """
+    每個大項的提示詞雜湊 (限制說明 + 該大項的規則行)：{大項序號 (字串): 雜湊}。
+    增量更新只沿用規則未修改的大項 (修改限制說明時所有大項都需重新提取)。
+    """
+    header, rules = standardization_sections(prompt)
+    header_text = "\n".join(header)
+    return {str(n): text_digest(header_text + "\n" + line) for n, line in rules.items()}
+
+def _validate_standardization_prompt(text):
+    """標準化提示詞的大項必須與 STANDARDIZATION_SHARDS 的序號完全一致 (否則無法拆成分片)。"""
+    _, rules = standardization_sections(text)
+    expected = sorted(n for shard in STANDARDIZATION_SHARDS for n in shard["sections"])
+    if sorted(rules) != expected:
+        raise ValueError(f"標準化提示詞應有 {len(expected)} 個大項規則行，實際為 {len(rules)} 個")
+
+def _validate_ratio_inputs_prompt(text):
+    if "{fields}" not in text:
+        raise ValueError("比率欄位提示詞缺少 {fields} (缺少的項目清單)")
+
+# 提示詞登記表 (跨 session 共用)：啟動時載入 prompts/ 的檔案，修改後自動重新載入；
+# 重新載入的內容未通過檢查時沿用先前的版本 (原因見 errors)
+_PROMPTS = PromptRegistry(
+    PROMPT_DIR,
+    PROMPT_FILES,
+    reload_interval=PROMPT_RELOAD_SECONDS,
+    validators={"standardization": _validate_standardization_prompt, "ratio_inputs": _validate_ratio_inputs_prompt},
+)
+
+def get_prompt_registry():
+    return _PROMPTS
+
+def _match_section(heading, names):
+    """以 ## 標題比對分片內的大項名稱 (互相包含即可，取最長的名稱)；無法比對時回傳 None。"""
+    title = re.sub(r"\s+", "", heading.lstrip("#"))
+    candidates = [(len(name), n) for n, name in names.items() if name in title or (len(title) >= 2 and title in name)]
+    return max(candidates)[1] if candidates else None
+
+def _split_blocks(text):
+    """把 Markdown 切成以 ## 標題開頭的區塊 (每個區塊為行的 list；第一個區塊可能沒有標題)。"""
+    chunks, current = [], []
+    for line in (text or "").strip().splitlines():
+        if line.startswith("## ") and current:
+            chunks.append(current)
+            current = []
+        current.append(line)
+    if current: chunks.append(current)
+    return chunks
+
+def section_blocks(text, sections):
+    """
+    把標準化輸出切成 ## 區塊並對應到 sections 中的大項：回傳 [(序號, 區塊文字)]。
+    無法對應大項的區塊 (例如模型自訂標題) 跟隨前一個區塊；開頭的文字視為第一個大項。
+    """
+    _, rules = standardization_sections()
+    names = {n: section_name(rules[n]) for n in sections}
+    number = min(sections)
+    blocks = []
+    for chunk in _split_blocks(text):
+        if chunk[0].startswith("## "):
+            number = _match_section(chunk[0], names) or number
+        blocks.append((number, "\n".join(chunk).strip()))
+    return blocks
+
+def merge_standardization_shards(outputs):
+    """
+    outputs: [(分片設定, 輸出文字)]。把各分片輸出切成 ## 區塊 (見 section_blocks)，依大項序號排序後合併。
+    沒有輸出的分片 (None 或空字串) 略過，其餘大項的順序不變。
+    """
+    blocks = []
+    for shard_index, (shard, text) in enumerate(outputs):
+        for chunk_index, (number, block) in enumerate(section_blocks(text, shard["sections"])):
+            blocks.append(((number, shard_index, chunk_index), block))
+    blocks.sort(key=lambda block: block[0])
+    return "\n\n".join(text for _, text in blocks if text) + "\n"
+
+def run_standardization_merge(step, ctx):
+    outputs = [(shard, ctx.get(shard["key"])) for shard in STANDARDIZATION_SHARDS]
+    return {"status": "success", "content": merge_standardization_shards(outputs)}
+
+def run_pdf_prompt_step(step, ctx):
+    """以步驟所需頁面的 PDF 與提示詞呼叫模型 (不使用搜尋)。"""
+    return call_multimodal_api(
+        client=ctx["client"],
+        pdf_part=ctx["load_pdf_part"](step.get("pages")),
+        prompt=step["prompt"],
+        use_search=False,
+        model_name=ctx["model_name"],
+        on_chunk=ctx.get("on_chunk"),
+        tags=ctx.get("tags"),
+        max_attempts=ctx.get("max_attempts")
+    )
+
+def standardization_shard_step(shard, prompt=None):
+    return {
+        "key": shard["key"],
+        "label": f"🔍 步驟 2/5: 提取與標準化財報數據 ({shard['name']})",
+        "deps": [],
+        "prompt": build_shard_prompt(shard["sections"], prompt),
+        "needs_pdf": True,
+        "pages": ("cover", "notes"),  # 四大表後的附註 (封面提供公司基本資料)
+        "run": run_pdf_prompt_step,
+    }
+
+# 增量更新：以附註各大項的原文雜湊比對前一期 (或先前版本) 的報告，內容相同的大項直接沿用先前的標準化表格
+NOTE_HEADING_MIN_SIMILARITY = 0.8
+
+def _match_note_heading(title, rules):
+    """
+    附註標題對應的大項序號：依序比對大項名稱、規則行列出的項目 (例如「客戶合約之收入」) 與名稱相似度；
+    無法比對時回傳 None。
+    """
+    names = {n: section_name(line) for n, line in rules.items()}
+    candidates = [(len(name), n) for n, name in names.items() if name in title or (len(title) >= 4 and title in name)]
+    if candidates: return max(candidates)[1]
+    if len(title) < 4: return None
+    field_match = next((n for n, line in rules.items() if any(title in field for field in line.split(",")[1:])), None)
+    if field_match is not None: return field_match
+    # 用詞略有差異 (例如「長期借款」與「長期銀行借款」)
+    ratio, number = max((difflib.SequenceMatcher(None, title, name).ratio(), n) for n, name in names.items())
+    return number if ratio >= NOTE_HEADING_MIN_SIMILARITY else None
+
+def note_section_digests(chunks):
+    """
+    chunks 為 pdf_pages.extract_note_chunks 的附註切段；回傳 {大項序號 (字串): 原文雜湊}。
+    第一層標題 (「四、重大會計政策之彙總說明」) 對應到大項時，其下的第二層段落都屬於該大項；
+    否則 (例如「六、重要會計項目之說明」) 逐一比對第二層標題。無法比對的段落併入前一個大項，
+    找不到標題的大項不列入 (增量更新時一律重新提取)。
+    """
+    _, rules = standardization_sections()
+    texts = {}
+    number, parent = None, None
+    for level, title, text in chunks or []:
+        if level == 1:
+            parent = _match_note_heading(title, rules)
+            number = parent or number
+        elif level == 2 and parent is None:
+            number = _match_note_heading(title, rules) or number
+        if number is not None:
+            texts.setdefault(number, []).append(title + text)
+    return {str(n): text_digest("\n".join(parts)) for n, parts in sorted(texts.items())}
+
+# 分析步驟依賴圖：步驟 1 與步驟 2 的各分片只需要 PDF，可同時執行；步驟 3~5 需等待步驟 2 合併後的標準化結果。
+# 每個步驟的 run(step, ctx) 只能使用 ctx 中的資料 (於背景執行緒執行)。
+# "pages" 為該步驟需要的頁面群組 (見 pdf_pages)，ctx["load_pdf_part"](pages) 回傳只含這些頁面的 PDF。
+# 提示詞取自提示詞登記表；檔案修改後 analysis_steps() 依新的內容重新建立步驟 (快取鍵隨之改變)。
+def build_analysis_steps(prompts):
+    """prompts: {名稱: 內容} (見 PROMPT_FILES)。"""
+    return [
+        {
+            "key": "company_name",
+            "label": "📜 步驟 1/5: 識別公司名稱",
+            "deps": [],
+            "prompt": prompts["company_name"],
+            "needs_pdf": True,
+            "pages": ("cover",),
+            "run": lambda step, ctx: call_multimodal_api(
+                client=ctx["client"],
+                pdf_part=ctx["load_pdf_part"](step.get("pages")),
+                prompt=step["prompt"],
+                use_search=False,
+                model_name=ctx["model_name"],
+                on_chunk=ctx.get("on_chunk"),
+                tags=ctx.get("tags"),
+                max_attempts=ctx.get("max_attempts")
+            ),
+        },
+        *[standardization_shard_step(shard, prompts["standardization"]) for shard in STANDARDIZATION_SHARDS],
+        {
+            "key": "standardization",
+            "label": "🔍 步驟 2/5: 合併標準化數據",
+            "deps": [shard["key"] for shard in STANDARDIZATION_SHARDS],
+            "prompt": "",  # 本地合併，不呼叫模型
+            "needs_pdf": False,
+            "run": run_standardization_merge,
+        },
+        {
+            "key": "ratio",
+            "label": "🧮 步驟 3/5: 計算關鍵財務比率",
+            "deps": ["standardization"],
+            "prompt": prompts["ratio_inputs"],
+            "needs_pdf": False,  # 只有標準化數據缺少欄位時才需要 PDF (ctx["load_pdf_part"])
+            "pages": ("cover", "statements"),
+            "cache_params": ("closing_price",),
+            "run": run_ratio_step,
+        },
+        {
+            "key": "summary",
+            "label": "⚖️ 步驟 4/5: 生成專業審計總結",
+            "deps": ["standardization"],
+            "prompt": prompts["summary"],
+            "needs_pdf": False,
+            "run": lambda step, ctx: call_text_api(
+                client=ctx["client"],
+                input_text=ctx["standardization"],
+                prompt=step["prompt"],
+                model_name=ctx["model_name"],
+                on_chunk=ctx.get("on_chunk"),
+                tags=ctx.get("tags"),
+                max_attempts=ctx.get("max_attempts")
+            ),
+        },
+        {
+            "key": "explanation",
+            "label": "🗣️ 步驟 5/5: 生成白話文數據講解",
+            "deps": ["standardization"],
+            "prompt": prompts["explanation"],
+            "needs_pdf": False,
+            "run": lambda step, ctx: call_text_api(
+                client=ctx["client"],
+                input_text=ctx["standardization"],
+                prompt=step["prompt"],
+                model_name=ctx["model_name"],
+                on_chunk=ctx.get("on_chunk"),
+                tags=ctx.get("tags"),
+                max_attempts=ctx.get("max_attempts")
+            ),
+        },
+    ]
+
+_steps_lock = threading.Lock()
+_steps_cache = {"prompts_version": None}
+
+def _current_steps():
+    """目前提示詞的步驟、流程版本與各大項的提示詞雜湊 (提示詞未變動時重複使用同一份)。"""
+    prompts_version, prompts = _PROMPTS.snapshot()
+    with _steps_lock:
+        if _steps_cache["prompts_version"] != prompts_version:
+            steps = build_analysis_steps(prompts)
+            _steps_cache.update(prompts_version=prompts_version, steps=steps, version=prompt_version(steps),
+                                section_rules=section_rule_digests(prompts["standardization"]))
+        return dict(_steps_cache)
+
+def analysis_steps():
+    """目前提示詞的分析步驟依賴圖 (呼叫端不可修改回傳的 list)。"""
+    return _current_steps()["steps"]
+
+def run_incremental_shard(step, ctx):
+    """增量更新的標準化分片：只重新提取內容有變動的大項，再接上沿用的先前表格 (由合併步驟依大項排序)。"""
+    content = ""
+    if step["prompt"]:
+        response = run_pdf_prompt_step(step, ctx)
+        if response.get("error"): return response
+        content = response["content"].strip()
+    return {"status": "success", "content": "\n\n".join(text for text in (content, step["carried"]) if text) + "\n"}
+
+def incremental_steps(previous, digests, steps=None, previous_digests=None):
+    """
+    依附註章節雜湊與先前的分析結果 (previous，需含 "section_digests" 與 "standardization_shards") 改寫標準化分片：
+    雜湊相同的大項沿用先前的表格，其餘大項重新提取；整個分片都沒有變動時不呼叫模型。
+    先前結果的 "section_rules" (各大項的提示詞雜湊) 與目前不同的大項也會重新提取 (提示詞已修改)。
+    previous 沒有記錄附註雜湊時使用 previous_digests (由先前報告的 PDF 計算，見 analyze_pdf)。
+    回傳 (步驟 list, {"previous", "reused", "rerun"})；無法比對時回傳 (原步驟, None)。
+    """
+    current = _current_steps()
+    steps = steps or current["steps"]
+    previous_digests = (previous or {}).get("section_digests") or previous_digests or {}
+    previous_shards = (previous or {}).get("standardization_shards") or {}
+    if not digests or not previous_digests or not previous_shards:
+        return steps, None
+
+    prompt = _PROMPTS.get("standardization")
+    rules = current["section_rules"]
+    previous_rules = previous.get("section_rules") or rules  # 較早的結果沒有記錄時視為相同
+    shards = {shard["key"]: shard for shard in STANDARDIZATION_SHARDS}
+    all_sections = [n for shard in STANDARDIZATION_SHARDS for n in shard["sections"]]
+    reused = [n for n in all_sections if digests.get(str(n)) is not None and digests.get(str(n)) == previous_digests.get(str(n))
+              and previous_rules.get(str(n)) == rules[str(n)]]
+
+    rewritten = []
+    for step in steps:
+        shard = shards.get(step["key"])
+        if shard is None:
+            rewritten.append(step)
+            continue
+        changed = [n for n in shard["sections"] if n not in reused]
+        # 以先前同一分片的輸出切分區塊 (與合併步驟的對應方式相同)
+        carried = "\n\n".join(block for n, block in section_blocks(previous_shards.get(shard["key"]), shard["sections"]) if n in reused)
+        rewritten.append(dict(
+            step,
+            label=f"{step['label']} (沿用 {len(shard['sections']) - len(changed)}/{len(shard['sections'])} 項)",
+            prompt=build_shard_prompt(changed, prompt) if changed else "",
+            needs_pdf=bool(changed),
+            pages=step["pages"] if changed else None,
+            carried=carried,
+            run=run_incremental_shard,
+        ))
+    rerun = [n for n in all_sections if n not in reused]
+    return rewritten, {"previous": previous.get("pdf_sha256"), "reused": sorted(reused), "rerun": sorted(rerun)}
+
+def run_step_graph(steps, ctx, on_start=None, on_done=None, on_progress=None, max_workers=3, cache=None, cache_keys=None,
+                   routes=None):
+    """
+    依照依賴關係執行步驟：依賴已完成的步驟立即送入執行緒池，其餘等待。
+    回調函數 (on_start / on_done / on_progress) 在呼叫端執行緒中觸發 (Streamlit 可安全地更新元件)。
+    提供 on_progress 時，各步驟以串流方式執行，並定期回報目前累積的輸出文字。
+    若提供 cache 與 cache_keys，命中快取的步驟直接取用結果；成功的步驟在工作執行緒中立即寫入快取 (檢查點)，
+    即使呼叫端中斷或其他步驟失敗，已完成的結果也不會遺失，下次執行時從缺少的步驟繼續。
+    各步驟以其 "model" 執行並可改用備援模型 (見 run_routed_step)。備援模型的結果與其下游步驟以衍生的快取鍵
+    (見 rekey_step) 寫入，不會取代主要模型的結果。提供 routes (dict) 時寫入呼叫模型的步驟
+    {key: {"planned", "model", "from_cache"} (改用備援時另含 "fallback_from")}。
+    任一步驟失敗時取消尚未開始的步驟並拋出例外。
+    """
+    pending = {step["key"]: step for step in steps}
+    results = {}
+    running = {}
+    chunk_queue = queue.Queue()
+
+    def drain_progress():
+        latest = {}
+        while True:
+            try:
+                key, text = chunk_queue.get_nowait()
+            except queue.Empty:
+                break
+            latest[key] = text
+        for key, text in latest.items():
+            if key not in results: on_progress(steps_by_key[key], text)
+
+    steps_by_key = {step["key"]: step for step in steps}
+
+    def record_route(step, model, from_cache, fallback_from=None):
+        if routes is None or not step.get("model"): return
+        routes[step["key"]] = {"planned": step["model"], "model": model, "from_cache": from_cache}
+        if fallback_from: routes[step["key"]]["fallback_from"] = fallback_from
+
+    # 實際使用的快取鍵與預先計算的鍵不同的步驟 (改用備援模型，或上游改用備援模型)
+    actual_keys = {}
+
+    def step_cache_key(step):
+        return rekey_step(cache_keys[step["key"]], [actual_keys[d] for d in step["deps"] if d in actual_keys])
+
+    def output_cache_key(key, response):
+        return rekey_step(key, [f"model={response['model']}"] if response.get("fallback_from") else [])
+
+    def run_and_checkpoint(step, step_ctx, key):
+        response = run_routed_step(step, step_ctx)
+        if cache is not None and not response.get("error"):
+            cache.put(output_cache_key(key, response), response["content"], step=step["key"], model=response["model"],
+                      fallback_from=response.get("fallback_from"))
+        return response
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            while pending or running:
+                # 命中快取的步驟會立即完成，可能讓下游步驟也變成可執行，因此重複檢查直到沒有新步驟
+                ready = [s for s in pending.values() if all(d in results for d in s["deps"])]
+                while ready:
+                    step = ready.pop(0)
+                    del pending[step["key"]]
+                    key = step_cache_key(step) if cache is not None else None
+                    if key is not None and key != cache_keys[step["key"]]: actual_keys[step["key"]] = key
+                    cached = cache.get_entry(key) if cache is not None else None
+                    if cached is not None and cached.get("fallback_from"):
+                        cached = None  # 較早版本把備援模型的結果寫在主要模型的鍵，不可沿用
+                    if cached is not None:
+                        results[step["key"]] = cached["content"]
+                        model = cached.get("model") or step.get("model") or ctx.get("model_name")
+                        record_route(step, model, True, cached.get("fallback_from"))
+                        get_call_logger().record(step=step["key"], report=ctx.get("report_id"), model=model, cache="hit")
+                        if on_done: on_done(step, len(results), from_cache=True)
+                        ready = [s for s in pending.values() if all(d in results for d in s["deps"])]
+                        continue
+                    if on_start: on_start(step)
+                    step_ctx = dict(ctx, **{d: results[d] for d in step["deps"]})
+                    step_ctx["tags"] = {"step": step["key"], "report": ctx.get("report_id"), "cache": "miss" if cache is not None else None}
+                    if on_progress:
+                        step_ctx["on_chunk"] = lambda text, key=step["key"]: chunk_queue.put((key, text))
+                    running[executor.submit(run_and_checkpoint, step, step_ctx, key)] = step
+
+                if not running and not pending:
+                    break
+
+                if not running:
+                    raise Exception(f"步驟依賴無法滿足: {', '.join(pending)}")
+
+                done, _ = wait(running, timeout=0.3 if on_progress else None, return_when=FIRST_COMPLETED)
+                if on_progress: drain_progress()
+                for future in done:
+                    step = running.pop(future)
+                    response = future.result()
+                    if response.get("error"):
+                        raise Exception(f"{step['label']} 失敗: {response['error']}")
+                    results[step["key"]] = response["content"]
+                    if cache is not None and response.get("fallback_from"):
+                        actual_keys[step["key"]] = output_cache_key(step_cache_key(step), response)
+                    record_route(step, response["model"], False, response.get("fallback_from"))
+                    if on_done: on_done(step, len(results), from_cache=False)
+        except BaseException:
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+    return results
+
+def analyze_pdf(client, pdf_bytes, model_name=DEFAULT_MODEL, cache=None, get_pdf_part=None,
+                on_start=None, on_done=None, on_progress=None, closing_price=None, previous=None, previous_pdf=None,
+                record_sections=False, routing=None, fallback=False):
+    """
+    對單份 PDF 執行完整分析並回傳結果 dict (analysis_results 的格式，"tables" 為解析後的欄式表格紀錄)。
+    get_pdf_part(data, document) 用於取得可重用的 PDF 參照 (例如 PdfFileRegistry；document 為原始 PDF 的 digest)；
+    未提供時直接內嵌位元組。各步驟只送出所需頁面的精簡 PDF (每個頁面群組取得一次參照，所有分片共用)；
+    無法篩選頁面時才使用完整 PDF。
+    closing_price 為計算本益比用的收盤價 (未提供時本益比標示為無法計算)。
+    previous 為同一公司先前的分析結果 (例如上一季)：附註內容相同的大項沿用其標準化表格，只重新提取有變動的大項
+    (見 incremental_steps；結果的 "incremental" 記錄沿用與重新提取的大項)。previous 沒有記錄附註雜湊時
+    以 previous_pdf (先前報告的 PDF 位元組) 計算。
+    附註章節雜湊 ("section_digests"，擷取附註文字需數秒) 只在提供 previous 或 record_sections 為 True 時計算；
+    結果會作為之後增量更新的基準時 (例如批次輸出、範例結果) 設定 record_sections，否則為 None。
+    提示詞取自開始分析時的提示詞檔案 (見 get_prompt_registry)；"section_rules" 記錄各大項的提示詞雜湊。
+    routing 為 {群組: 模型} (見 ROUTING_GROUPS / routing_policy)，未列出的群組使用 model_name；fallback 為 True 時
+    失敗的步驟改用另一個模型重試。結果的 "routing" 記錄各步驟預定與實際使用的模型 (見 run_step_graph)。
+    PDF 只在步驟實際執行時才處理，全部命中快取時不會取得 PDF 參照。任一步驟失敗時拋出例外。
+    """
+    pdf_digest = hashlib.sha256(pdf_bytes).hexdigest()
+    current = _current_steps()
+    steps, incremental, section_digests = current["steps"], None, None
+    if previous is not None or record_sections:
+        section_digests = note_section_digests(get_note_chunks(pdf_bytes, pdf_digest))
+    if previous is not None:
+        previous_digests = None
+        if not previous.get("section_digests") and previous_pdf is not None:
+            previous_digests = note_section_digests(get_note_chunks(previous_pdf, hashlib.sha256(previous_pdf).hexdigest()))
+        steps, incremental = incremental_steps(previous, section_digests, steps, previous_digests)
+    steps = route_steps(steps, model_name, routing, fallback)
+    cache_keys = compute_step_cache_keys(steps, pdf_digest, model_name, {"closing_price": closing_price})
+
+    # 每個頁面群組的 PDF 參照只建立一次 (於背景執行緒中按需建立；不同群組可同時處理)
+    parts_lock = threading.Lock()
+    parts = {}
+
+    def load_pdf_part(pages=None):
+        with parts_lock:
+            entry = parts.setdefault(pages, {"lock": threading.Lock()})
+        with entry["lock"]:
+            if "part" not in entry:
+                trimmed = trimmed_pdf(pdf_bytes, pdf_digest, pages) if pages else None
+                if trimmed is not None and get_pdf_part is not None:
+                    entry["part"] = get_pdf_part(trimmed, pdf_digest)  # 各頁面群組只上傳一次，所有分片共用
+                elif trimmed is not None:
+                    entry["part"] = types.Part.from_bytes(data=trimmed, mime_type='application/pdf')
+                elif pages:
+                    entry["part"] = load_pdf_part()
+                elif get_pdf_part is not None:
+                    entry["part"] = get_pdf_part(pdf_bytes, pdf_digest)
+                else:
+                    entry["part"] = types.Part.from_bytes(data=pdf_bytes, mime_type='application/pdf')
+            return entry["part"]
+
+    routes = {}
+    step_results = run_step_graph(
+        steps,
+        {"client": client, "load_pdf_part": load_pdf_part,
+         "model_name": model_name, "report_id": pdf_digest, "closing_price": closing_price},
+        on_start=on_start,
+        on_done=on_done,
+        on_progress=on_progress,
+        max_workers=ANALYSIS_MAX_WORKERS,
+        cache=cache,
+        cache_keys=cache_keys,
+        routes=routes
+    )
+
+    results = {
+        "pdf_sha256": pdf_digest,
+        "model_name": model_name,
+        "closing_price": closing_price,
+        "company_name": step_results["company_name"].strip(),
+        "ratio": step_results["ratio"],
+        "summary": step_results["summary"],
+        "explanation": step_results["explanation"],
+        "standardization": step_results["standardization"],
+        "standardization_shards": {shard["key"]: step_results[shard["key"]] for shard in STANDARDIZATION_SHARDS},
+        "section_digests": section_digests,
+        "section_rules": current["section_rules"],
+        "incremental": incremental,
+        "routing": {step["key"]: routes[step["key"]] for step in steps if step["key"] in routes}
+    }
+    # 比率與標準化表格只在此解析一次，之後的呈現、匯出與比較都使用欄式紀錄
+    results["tables"] = parse_results_tables(results)
+    return results
+
+# 背景分析工作佇列：全域同時執行的分析數上限 (其餘排隊)，以及尚無紀錄時預估的單次分析秒數
+ANALYSIS_JOB_WORKERS = int(os.getenv('ANALYSIS_JOB_WORKERS', '2'))
+ANALYSIS_JOB_DEFAULT_SECONDS = 120.0
+ANALYSIS_JOB_HISTORY = 20
+
+class AnalysisJob:
+    """
+    由 AnalysisJobQueue 在背景執行緒執行的單次分析 (不依賴 Streamlit)。各步驟的進度記錄在物件中，
+    Streamlit 端輪詢 snapshot() 顯示；腳本重新執行或瀏覽器斷線都不會中斷進行中的 API 呼叫。
+    state："queued" → "running" → "done" / "failed"
+    """
+
+    def __init__(self, pdf_digest, model_name=DEFAULT_MODEL, closing_price=None, previous=None, routing=None, fallback=False):
+        self.id = uuid.uuid4().hex
+        self.pdf_digest = pdf_digest
+        self.model_name = model_name
+        self.closing_price = closing_price
+        self.previous = previous  # 增量更新沿用的先前分析結果 (見 analyze_pdf)
+        self.routing = dict(routing) if routing else None  # {群組: 模型} (見 analyze_pdf)
+        self.fallback = fallback
+        self._lock = threading.Lock()
+        self._args = None
+        self.state = "queued"
+        self.submitted = time.monotonic()
+        self.started = None
+        self.finished = None
+        self.steps = {}  # key -> {"label", "state": "running"/"done", "from_cache", "text"}
+        self.done_count = 0
+        self.results = None
+        self.error = None
+
+    def _request(self):
+        return (self.pdf_digest, self.model_name, self.closing_price, (self.previous or {}).get("pdf_sha256"),
+                tuple(sorted((self.routing or {}).items())), self.fallback)
+
+    def same_request(self, other):
+        return self._request() == other._request()
+
+    def is_active(self):
+        return self.state in ("queued", "running")
+
+    def _on_start(self, step):
+        with self._lock:
+            self.steps[step["key"]] = {"label": step["label"], "state": "running", "from_cache": False, "text": ""}
+
+    def _on_progress(self, step, text):
+        with self._lock:
+            if step["key"] in self.steps: self.steps[step["key"]]["text"] = text
+
+    def _on_done(self, step, done_count, from_cache=False):
+        with self._lock:
+            self.steps[step["key"]] = {"label": step["label"], "state": "done", "from_cache": from_cache, "text": ""}
+            self.done_count = done_count
+
+    def run(self):
+        """執行分析 (參數於 AnalysisJobQueue.submit 時指定)；結果與錯誤記錄在物件中。"""
+        client, pdf_bytes, kwargs = self._args
+        with self._lock:
+            self.state, self.started = "running", time.monotonic()
+        try:
+            results = analyze_pdf(
+                client, pdf_bytes,
+                model_name=self.model_name,
+                closing_price=self.closing_price,
+                previous=self.previous,
+                routing=self.routing,
+                fallback=self.fallback,
+                on_start=self._on_start,
+                on_done=self._on_done,
+                on_progress=self._on_progress,
+                **kwargs
+            )
+        except Exception as e:
+            with self._lock:
+                self.state, self.error = "failed", str(e)
+        else:
+            with self._lock:
+                self.state, self.results = "done", results
+        finally:
+            self._args = None  # 釋放 PDF 位元組
+            self.finished = time.monotonic()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "state": self.state,
+                "steps": [dict(step, key=key) for key, step in self.steps.items()],
+                "done_count": self.done_count,
+                "total_steps": len(analysis_steps()),
+                "results": self.results,
+                "error": self.error,
+            }
+
+class AnalysisJobQueue:
+    """
+    背景分析工作佇列 (跨 session 共用)：最多 max_workers 個分析同時執行，其餘依提交順序排隊，
+    避免大量使用者同時分析時佔用伺服器執行緒或對共用 CLIENT 送出無上限的並行請求。
+    每個 holder (session) 記錄最近一次分析，頁面重新執行後可重新接上；相同請求仍在進行時不會重複送出。
+    """
+
+    def __init__(self, max_workers=ANALYSIS_JOB_WORKERS):
+        self.max_workers = max(1, max_workers)
+        self._cond = threading.Condition()
+        self._jobs = {}  # holder -> AnalysisJob
+        self._queue = deque()
+        self._running = []
+        self._workers = 0
+        self._durations = deque(maxlen=ANALYSIS_JOB_HISTORY)
+
+    def submit(self, holder, job, client, pdf_bytes, **kwargs):
+        """排入分析 (kwargs 傳給 analyze_pdf，例如 cache、get_pdf_part)；回傳實際排入 (或已在進行) 的工作。"""
+        with self._cond:
+            current = self._jobs.get(holder)
+            if current is not None and current.is_active() and current.same_request(job):
+                return current
+            job._args = (client, pdf_bytes, kwargs)
+            self._jobs[holder] = job
+            self._queue.append(job)
+            if self._workers < self.max_workers:
+                self._workers += 1
+                threading.Thread(target=self._worker, name=f"analysis-worker-{self._workers}", daemon=True).start()
+            self._cond.notify()
+        return job
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                job = self._queue.popleft()
+                self._running.append(job)
+            try:
+                job.run()
+            finally:
+                with self._cond:
+                    self._running.remove(job)
+                    self._durations.append(job.finished - job.started)
+
+    def get(self, holder):
+        with self._cond:
+            return self._jobs.get(holder)
+
+    def discard(self, holder, job_id=None):
+        """
+        移除 holder 的分析紀錄 (結果已取用或使用者放棄)；指定 job_id 時只移除該次分析。
+        尚在排隊的工作一併取消 (執行中的工作會完成並寫入快取)。
+        """
+        with self._cond:
+            job = self._jobs.get(holder)
+            if job is None or (job_id is not None and job.id != job_id): return
+            del self._jobs[holder]
+            if job in self._queue:
+                self._queue.remove(job)
+                job.state, job.error, job._args = "failed", "已取消", None
+
+    def average_seconds(self):
+        with self._cond:
+            return sum(self._durations) / len(self._durations) if self._durations else ANALYSIS_JOB_DEFAULT_SECONDS
+
+    def position(self, job):
+        """
+        回傳 (排隊順位, 預計開始秒數, 預計完成秒數)；順位從 1 開始，已開始的工作順位為 0。
+        預估以最近完成的分析平均耗時模擬各工作槽的空出時間。
+        """
+        average = self.average_seconds()
+        now = time.monotonic()
+        with self._cond:
+            if job.state == "running":
+                return 0, 0.0, max(0.0, average - (now - job.started))
+            if job not in self._queue:
+                return 0, 0.0, 0.0
+            slots = [max(0.0, average - (now - running.started)) for running in self._running if running.started]
+            slots += [0.0] * (self.max_workers - len(slots))
+            heapq.heapify(slots)
+            for index, queued in enumerate(self._queue):
+                start = heapq.heappop(slots)
+                if queued is job:
+                    return index + 1, start, start + average
+                heapq.heappush(slots, start + average)
+        return 0, 0.0, 0.0
+
+    def stats(self):
+        with self._cond:
+            return {"queued": len(self._queue), "running": len(self._running), "max_workers": self.max_workers}
+
+def render_report_markdown(results):
+    """將分析結果組合成單一 Markdown 報告 (批次輸出用)。"""
+    company_name = results.get("company_name") or "財報分析"
+    return "\n\n".join([
+        f"# {company_name} 財報分析",
+        f"> 模型: {results.get('model_name', '')} · PDF SHA-256: {results.get('pdf_sha256', '')}",
+        "## 關鍵財務比率", results.get("ratio", ""),
+        "## 財報總結", results.get("summary", ""),
+        "## 數據講解", results.get("explanation", ""),
+        "# 原始資訊", results.get("standardization", ""),
+    ]) + "\n"
+
+# =============================================================================
+# 4. 聊天：章節檢索與上下文快取
+# =============================================================================
+
+# 聊天檢索：每次提問附上最相關的標準化章節數
+CHAT_RETRIEVAL_TOP_K = 3
+
+class SectionIndex:
+    """
+    標準化 Markdown 的章節檢索索引：依 '## ' 標題切成章節，
+    以字元 n-gram (適用繁體中文，不需斷詞) 建立 BM25 索引。
+    """
+
+    K1 = 1.5
+    B = 0.75
+    TITLE_WEIGHT = 3  # 標題中的 n-gram 權重加倍，讓「關係人交易」等問題直接命中章節
+
+    def __init__(self, markdown_text, ngram_sizes=(1, 2)):
+        self.digest = text_digest(markdown_text)
+        self.ngram_sizes = ngram_sizes
+        self.sections = self.split_sections(markdown_text)
+        self._term_freqs = []
+        self._doc_freqs = Counter()
+        for title, body in self.sections:
+            tf = Counter(self.tokenize(body))
+            for _ in range(self.TITLE_WEIGHT):
+                tf.update(self.tokenize(title))
+            self._term_freqs.append(tf)
+            self._doc_freqs.update(tf.keys())
+        self._lengths = [sum(tf.values()) for tf in self._term_freqs]
+        self._avg_length = (sum(self._lengths) / len(self._lengths)) if self._lengths else 0.0
+
+    @staticmethod
+    def split_sections(markdown_text):
+        """依 '## ' 標題切分，回傳 [(標題, 章節全文)]；第一個標題前的內容歸入「前言」。"""
+        sections = []
+        title, lines = "前言", []
+        for line in markdown_text.splitlines():
+            if line.startswith("## "):
+                if "".join(lines).strip(): sections.append((title, "\n".join(lines).strip()))
+                title, lines = line[3:].strip(), [line]
+            else:
+                lines.append(line)
+        if "".join(lines).strip(): sections.append((title, "\n".join(lines).strip()))
+        return sections
+
+    def tokenize(self, text):
+        # 移除表格符號與空白，只保留文字與數字後切出字元 n-gram
+        chars = re.sub(r"[\s|:\-#*`]+", "", text.lower())
+        return [chars[i:i + n] for n in self.ngram_sizes for i in range(len(chars) - n + 1)]
+
+    def search(self, query, k=CHAT_RETRIEVAL_TOP_K):
+        """回傳 BM25 分數最高的 k 個章節 [(標題, 全文)]，依分數排序。"""
+        if not self.sections: return []
+        doc_count = len(self.sections)
+        scores = [0.0] * doc_count
+        for term in set(self.tokenize(query)):
+            df = self._doc_freqs.get(term)
+            if not df: continue
+            idf = math.log(1 + (doc_count - df + 0.5) / (df + 0.5))
+            for i, tf in enumerate(self._term_freqs):
+                freq = tf.get(term)
+                if not freq: continue
+                norm = self.K1 * (1 - self.B + self.B * self._lengths[i] / self._avg_length)
+                scores[i] += idf * freq * (self.K1 + 1) / (freq + norm)
+        ranked = sorted(range(doc_count), key=lambda i: scores[i], reverse=True)
+        return [self.sections[i] for i in ranked[:k] if scores[i] > 0]
+
+# 每次請求附帶的最近對話則數 (使用者 + AI 各算一則)
+CHAT_HISTORY_WINDOW = 8
+# 聊天上下文快取存活時間；CHAT_CONTEXT_MODE=local 時改用本地替代 (測試用)
+CHAT_CONTEXT_TTL = timedelta(hours=1)
+CHAT_CONTEXT_MODE = os.getenv('CHAT_CONTEXT_MODE', 'provider')
+# 聊天上下文登記表：閒置超過 DOCUMENT_IDLE_TTL (與文件儲存區相同) 或超過上限時移除最久未使用的項目
+CHAT_CONTEXT_MAX_ENTRIES = int(os.getenv('CHAT_CONTEXT_MAX_ENTRIES', '64'))
+
+class ChatContext:
+    """
+    單份報告的聊天上下文：PDF + 標準化數據 + 系統提示 (建立時的聊天提示詞)。
+    cached_content 有值時代表已建立於 Gemini 端的快取 (含完整標準化數據)，請求只需送出新的對話；
+    否則為本地替代版本，每次請求時把 PDF 放在對話最前面，標準化數據則只附上檢索到的章節。
+    """
+
+    def __init__(self, prefix_parts, system_prompt, cached_content=None, expires_at=None, client=None):
+        self.prefix_parts = prefix_parts
+        self.system_prompt = system_prompt
+        self.cached_content = cached_content
+        self.expires_at = expires_at or datetime.now(timezone.utc) + CHAT_CONTEXT_TTL
+        self.client = client  # 建立 Gemini 端快取的 client (刪除快取用)
+
+    @property
+    def is_provider_cached(self):
+        return self.cached_content is not None
+
+    def is_stale(self):
+        return self.expires_at - timedelta(minutes=5) <= datetime.now(timezone.utc)
+
+    def build_request(self, history, user_question, relevant_sections=()):
+        """
+        組合 (contents, config)：最近 CHAT_HISTORY_WINDOW 則對話 + 本次問題。
+        relevant_sections 為檢索到的標準化章節；Gemini 端快取已含完整數據，只附上章節名稱作為提示，
+        本地替代版本則直接附上章節內容。
+        """
+        contents = []
+        if not self.is_provider_cached:
+            contents.append(types.Content(role="user", parts=self.prefix_parts))
+        for message in history[-CHAT_HISTORY_WINDOW:]:
+            role = "user" if message["role"] == "user" else "model"
+            contents.append(types.Content(role=role, parts=[types.Part.from_text(text=message["content"])]))
+        question_text = f"使用者問題: {user_question}"
+        if relevant_sections and self.is_provider_cached:
+            titles = "、".join(title for title, _ in relevant_sections)
+            question_text = f"【可優先參考的標準化章節】{titles}\n{question_text}"
+        elif relevant_sections:
+            excerpts = "\n\n".join(body for _, body in relevant_sections)
+            question_text = f"【相關標準化章節】\n{excerpts}\n\n{question_text}"
+        contents.append(types.Content(role="user", parts=[types.Part.from_text(text=question_text)]))
+
+        if self.is_provider_cached:
+            config = types.GenerateContentConfig(temperature=1.2, cached_content=self.cached_content)
+        else:
+            config = types.GenerateContentConfig(
+                temperature=1.2,
+                system_instruction=self.system_prompt,
+                tools=[types.Tool(google_search=types.GoogleSearch())]
+            )
+        return contents, config
+
+    def invalidate(self):
+        self.expires_at = datetime.now(timezone.utc)
+
+    def delete(self):
+        """刪除 Gemini 端的快取 (不再使用時停止計費)；失敗時忽略，快取會在到期後自動刪除。"""
+        if self.cached_content is None or self.client is None: return
+        try:
+            self.client.caches.delete(name=self.cached_content)
+        except Exception:
+            pass
+
+class ChatContextRegistry:
+    """
+    跨 session 共用的聊天上下文登記表，以 chat_context_key() 為鍵。
+    上下文在各鍵自己的鎖中建立 (建立 Gemini 端快取需呼叫 API，不會阻擋其他報告的聊天)，同一個鍵同時只建立一次。
+    閒置超過 idle_ttl 的項目在下次取用時移除，項目數超過 max_entries 時移除最久未使用的項目；
+    移除或重建的上下文同時刪除其 Gemini 端快取。
+    """
+
+    def __init__(self, idle_ttl=DOCUMENT_IDLE_TTL, max_entries=CHAT_CONTEXT_MAX_ENTRIES):
+        self.idle_ttl = idle_ttl.total_seconds()
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._contexts = OrderedDict()  # key -> {"context": ChatContext | None, "last_used": 時間, "lock": Lock}
+
+    def get(self, key, create_fn):
+        now = time.monotonic()
+        with self._lock:
+            removed = self._evict(now)
+            entry = self._contexts.pop(key, None) or {"context": None, "lock": threading.Lock()}
+            entry["last_used"] = now
+            self._contexts[key] = entry
+            while len(self._contexts) > self.max_entries:
+                removed.append(self._contexts.popitem(last=False)[1])
+        for old in removed:
+            if old["context"] is not None: old["context"].delete()
+
+        with entry["lock"]:
+            context = entry["context"]
+            if context is None or context.is_stale():
+                entry["context"] = create_fn()
+                if context is not None: context.delete()
+                context = entry["context"]
+            return context
+
+    def _evict(self, now):
+        deadline = now - self.idle_ttl
+        expired = [k for k, entry in self._contexts.items() if entry["last_used"] < deadline]
+        return [self._contexts.pop(k) for k in expired]
+
+def create_chat_context(client, results, model_name, pdf_part=None):
+    """建立聊天上下文：優先建立 Gemini 端的快取，失敗時退回本地替代。"""
+    prefix_parts = [pdf_part] if pdf_part is not None else []
+    system_prompt = _PROMPTS.get("chat")
+    std_data = results.get('standardization', '')
+    std_part = types.Part.from_text(text=f"【標準化財務數據】\n{std_data}")
+
+    if client is not None and CHAT_CONTEXT_MODE != 'local':
+        try:
+            cached = client.caches.create(
+                model=model_name,
+                config=types.CreateCachedContentConfig(
+                    display_name=f"chat-{results.get('pdf_sha256', '')[:16]}",
+                    contents=[types.Content(role="user", parts=prefix_parts + [std_part])],
+                    system_instruction=system_prompt,
+                    tools=[types.Tool(google_search=types.GoogleSearch())],
+                    ttl=f"{int(CHAT_CONTEXT_TTL.total_seconds())}s"
+                )
+            )
+            return ChatContext(prefix_parts, system_prompt, cached_content=cached.name, expires_at=cached.expire_time,
+                               client=client)
+        except Exception:
+            pass  # 模型不支援快取或內容太短時，改用本地替代
+    return ChatContext(prefix_parts, system_prompt)
+
+def chat_context_key(results, model_name):
+    """聊天上下文的鍵：聊天提示詞修改後，下一則訊息改用新的上下文。"""
+    return "|".join([results.get('pdf_sha256', ''), model_name, text_digest(results.get('standardization', '') or ''),
+                     _PROMPTS.digest("chat")])
+
+def process_chat_message(client, user_question, get_context, index, history=(), model_name=DEFAULT_MODEL):
+    """
+    回答一則聊天訊息並回傳文字 (錯誤時回傳錯誤訊息)。
+    get_context() 回傳目前的 ChatContext (通常經由 ChatContextRegistry 取得)；index 為 SectionIndex。
+    Gemini 端快取可能已失效，失敗時會重建上下文再試一次。
+    """
+    context = get_context()
+    sections = index.search(user_question)
+    contents, config = context.build_request(list(history), user_question, sections)
+    response = call_chat_api(client, contents, model_name=model_name, config=config)
+    if response.get("error") and context.is_provider_cached:
+        context.invalidate()
+        contents, config = get_context().build_request(list(history), user_question, sections)
+        response = call_chat_api(client, contents, model_name=model_name, config=config)
+    if response.get("error"): return f"❌ Error: {response['error']}"
+    return response["content"]
+
+def stream_chat_message(client, user_question, get_context, index, history=(), model_name=DEFAULT_MODEL):
+    """process_chat_message 的串流版本：逐段 yield 文字 (供 st.write_stream 使用)。"""
+    context = get_context()
+    sections = index.search(user_question)
+    contents, config = context.build_request(list(history), user_question, sections)
+    emitted = False
+    try:
+        for text in stream_chat_api(client, contents, model_name=model_name, config=config, raise_errors=True):
+            emitted = True
+            yield text
+        return
+    except Exception as e:
+        if emitted or not context.is_provider_cached:
+            yield f"\n\n❌ Error: {e}"
+            return
+    # 遠端快取可能已失效：重建上下文後再試一次
+    context.invalidate()
+    contents, config = get_context().build_request(list(history), user_question, sections)
+    yield from stream_chat_api(client, contents, model_name=model_name, config=config)
@@ -0,0 +1,306 @@
+"""
+批次 / 無介面分析：不經過 Streamlit，直接以 analysis_pipeline 處理多份財報。
+
+用法：
+    python batch_analyze.py 2308.pdf 2382.pdf 2454.pdf
+    python batch_analyze.py reports/ --out-dir batch_output --workers 4
+    python batch_analyze.py "reports/*.pdf" --model gemini-3-pro-preview --model gemini-3-flash-preview --model-limit gemini-3-pro-preview=1
+    python batch_analyze.py reports_q3/ --out-dir output_q3 --previous-dir output_q2
+    python batch_analyze.py reports/ --export parquet --export xlsx
+    python batch_analyze.py reports/ --routing hybrid --fallback
+
+每份財報 (× 每個模型) 輸出 <檔名>.<模型>.json 與 .md；--export 另外輸出結構化檔案 (見 report_export，
+輸出目錄中的 .parquet 可直接當作同一個資料集讀取)。已有輸出的項目會直接跳過，
+中斷後重新執行即可從上次的進度繼續；單份報告內已完成的步驟也會從結果快取取用。
+--previous-dir 指定上一期的輸出目錄時，同檔名、同模型的先前結果作為增量更新的基準
+(附註內容沒有變動的大項沿用先前的標準化表格)。
+--routing 依步驟選擇模型 (見 analysis_pipeline.ROUTING_POLICIES)，不可與 --model 同時使用；輸出檔名的模型後加上
+路由名稱 (例如 <檔名>.<模型>-hybrid.json)，每個模型的同時處理上限依步驟實際使用的模型計算。
+--fallback 讓失敗的步驟改用另一個模型重試。
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
+
+from analysis_pipeline import (
+    DEFAULT_MODEL,
+    MODEL_FALLBACK,
+    MODEL_ROUTING,
+    RESULT_CACHE_DIR,
+    ROUTING_GROUPS,
+    ROUTING_POLICIES,
+    RESULT_CACHE_MAX_BYTES,
+    AnalysisResultCache,
+    PdfFileRegistry,
+    analyze_pdf,
+    render_report_markdown,
+    routing_policy,
+)
+from lazy_import import LazyModule
+from report_export import available_formats, export_bytes
+
+# SDK 只在實際執行批次時才匯入 (sample_reports 等工具匯入本模組的輔助函數時不需要)
+genai = LazyModule("google.genai")
+types = LazyModule("google.genai.types")
+
+REQUIRED_RESULT_KEYS = ("company_name", "ratio", "summary", "explanation", "standardization")
+
+
+def expand_inputs(patterns):
+    """將目錄、glob 與檔案路徑展開為排序後、不重複的 PDF 清單。"""
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = glob.glob(os.path.join(pattern, "*.pdf"))
+        else:
+            matches = glob.glob(pattern) or ([pattern] if os.path.exists(pattern) else [])
+        paths.extend(m for m in matches if m.lower().endswith(".pdf"))
+    return sorted(set(os.path.abspath(p) for p in paths))
+
+
+def output_paths(out_dir, pdf_path, model_name):
+    stem = os.path.splitext(os.path.basename(pdf_path))[0]
+    base = os.path.join(out_dir, f"{stem}.{model_name}")
+    return f"{base}.json", f"{base}.md"
+
+
+def export_path(out_dir, pdf_path, model_name, fmt):
+    """結構化匯出檔 (JSON 匯出加上 .export 以免覆蓋完整結果)。"""
+    json_path, _ = output_paths(out_dir, pdf_path, model_name)
+    return json_path[:-len(".json")] + (".export.json" if fmt == "json" else f".{fmt}")
+
+
+def is_completed(json_path):
+    """已有完整輸出的項目視為完成 (用於中斷後續跑)。"""
+    try:
+        with open(json_path, encoding="utf-8") as f:
+            results = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return all(results.get(k) for k in REQUIRED_RESULT_KEYS)
+
+
+def load_previous(previous_dir, pdf_path, model_name):
+    """上一期輸出目錄中同檔名、同模型的完整結果；沒有時回傳 None。"""
+    if not previous_dir: return None
+    json_path, _ = output_paths(previous_dir, pdf_path, model_name)
+    if not is_completed(json_path): return None
+    with open(json_path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_atomic(path, data):
+    """先寫入暫存檔再改名 (data 為 str 或 bytes)。"""
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data.encode("utf-8") if isinstance(data, str) else data)
+    os.replace(tmp_path, path)
+
+
+def parse_closing_prices(values):
+    """--closing-price 2330=1045.5 → {"2330": 1045.5} (以 PDF 檔名 (不含副檔名) 對應)。"""
+    prices = {}
+    for value in values or []:
+        stem, _, price = value.partition("=")
+        try:
+            prices[stem] = float(price)
+        except ValueError:
+            raise ValueError(f"--closing-price 格式應為 檔名=價格: {value}")
+    return prices
+
+
+def parse_model_limits(values, default_limit):
+    limits = {}
+    for value in values or []:
+        model, _, limit = value.partition("=")
+        if not limit.isdigit() or int(limit) < 1:
+            raise ValueError(f"--model-limit 格式應為 MODEL=N: {value}")
+        limits[model] = int(limit)
+    return lambda model: limits.get(model, default_limit)
+
+
+class BatchRunner:
+    """以有上限的工作池執行批次分析，並限制每個模型同時處理的報告數。"""
+
+    def __init__(self, client, out_dir, workers, model_limit, cache, closing_prices=None, previous_dir=None,
+                 export_formats=(), routing=None, fallback=False):
+        self.client = client
+        self.routing = routing  # ROUTING_POLICIES 的名稱 (None 為單一模型)
+        self.fallback = fallback
+        self.closing_prices = closing_prices or {}
+        self.previous_dir = previous_dir
+        self.export_formats = tuple(export_formats)
+        self.out_dir = out_dir
+        self.workers = workers
+        self.cache = cache
+        self.registry = PdfFileRegistry()
+        self._model_limit = model_limit
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def _semaphore(self, model_name):
+        with self._lock:
+            if model_name not in self._semaphores:
+                self._semaphores[model_name] = threading.BoundedSemaphore(self._model_limit(model_name))
+            return self._semaphores[model_name]
+
+    def job_models(self, model_name):
+        """工作的步驟會使用的模型 (依路由；未列出的群組使用 model_name)，依名稱排序以固定取得上限的順序。"""
+        routing = routing_policy(self.routing) or {}
+        return sorted({routing.get(group) or model_name for group in ROUTING_GROUPS})
+
+    def output_name(self, model_name):
+        """輸出檔名中的模型部分 (使用路由時加上路由名稱，避免覆蓋單一模型的結果)。"""
+        return f"{model_name}-{self.routing}" if self.routing else model_name
+
+    def _get_pdf_part(self, holder):
+        def get_part(pdf_bytes, document=None):
+            try:
+                return self.registry.get_part(self.client, pdf_bytes, holder, document)
+            except Exception:
+                return types.Part.from_bytes(data=pdf_bytes, mime_type="application/pdf")
+        return get_part
+
+    def run_job(self, pdf_path, model_name):
+        name = self.output_name(model_name)
+        json_path, md_path = output_paths(self.out_dir, pdf_path, name)
+        holder = f"batch-{uuid.uuid4().hex}"
+        started = time.time()
+        with ExitStack() as limits:
+            for model in self.job_models(model_name):
+                limits.enter_context(self._semaphore(model))
+            with open(pdf_path, "rb") as f:
+                pdf_bytes = f.read()
+            try:
+                results = analyze_pdf(
+                    self.client,
+                    pdf_bytes,
+                    model_name=model_name,
+                    cache=self.cache,
+                    get_pdf_part=self._get_pdf_part(holder),
+                    closing_price=self.closing_prices.get(os.path.splitext(os.path.basename(pdf_path))[0]),
+                    previous=load_previous(self.previous_dir, pdf_path, name),
+                    record_sections=True,  # 輸出目錄是下一期 --previous-dir 的基準
+                    routing=routing_policy(self.routing),
+                    fallback=self.fallback
+                )
+            finally:
+                self.registry.release(self.client, holder)
+
+        results["source_file"] = os.path.basename(pdf_path)
+        write_atomic(md_path, render_report_markdown(results))
+        for fmt in self.export_formats:
+            write_atomic(export_path(self.out_dir, pdf_path, name, fmt), export_bytes(results, fmt))
+        # 完整結果最後寫入：中斷時不會留下「已完成」但缺少匯出檔的項目
+        write_atomic(json_path, json.dumps(results, ensure_ascii=False, indent=2))
+        return time.time() - started
+
+    def export_completed(self, json_path, pdf_path, name):
+        """已完成的項目只補上缺少的匯出檔 (由既有結果產生，不重新分析；name 見 output_name)。"""
+        missing = [fmt for fmt in self.export_formats if not os.path.exists(export_path(self.out_dir, pdf_path, name, fmt))]
+        if not missing: return
+        with open(json_path, encoding="utf-8") as f:
+            results = json.load(f)
+        for fmt in missing:
+            write_atomic(export_path(self.out_dir, pdf_path, name, fmt), export_bytes(results, fmt))
+
+    def log(self, record):
+        record["time"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+        with self._lock:
+            with open(os.path.join(self.out_dir, "manifest.jsonl"), "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def run(self, pdf_paths, model_names, force=False):
+        jobs = []
+        for pdf_path in pdf_paths:
+            for model_name in model_names:
+                json_path, _ = output_paths(self.out_dir, pdf_path, self.output_name(model_name))
+                if not force and is_completed(json_path):
+                    print(f"⏭️  跳過 (已完成): {os.path.basename(pdf_path)} [{self.output_name(model_name)}]", flush=True)
+                    self.export_completed(json_path, pdf_path, self.output_name(model_name))
+                    continue
+                jobs.append((pdf_path, model_name))
+
+        failures = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self.run_job, *job): job for job in jobs}
+            for future in as_completed(futures):
+                pdf_path, model_name = futures[future]
+                name = os.path.basename(pdf_path)
+                try:
+                    seconds = future.result()
+                except Exception as e:
+                    failures += 1
+                    print(f"❌ 失敗: {name} [{model_name}]: {e}", flush=True)
+                    self.log({"file": name, "model": model_name, "status": "error", "error": str(e)})
+                else:
+                    print(f"✅ 完成: {name} [{model_name}] ({seconds:.1f}s)", flush=True)
+                    self.log({"file": name, "model": model_name, "status": "ok", "seconds": round(seconds, 2)})
+        return len(jobs), failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="批次分析財務報告 PDF (不需啟動 Streamlit)")
+    parser.add_argument("inputs", nargs="+", help="PDF 檔案、目錄或 glob 樣式")
+    parser.add_argument("--out-dir", default="batch_output", help="輸出目錄 (預設: batch_output)")
+    parser.add_argument("--model", action="append", dest="models", help=f"使用的模型，可重複指定 (預設: {DEFAULT_MODEL})")
+    parser.add_argument("--workers", type=int, default=4, help="同時處理的報告數上限 (預設: 4)")
+    parser.add_argument("--max-per-model", type=int, default=2, help="每個模型同時處理的報告數上限 (預設: 2)")
+    parser.add_argument("--model-limit", action="append", help="個別模型的上限，格式 MODEL=N")
+    parser.add_argument("--closing-price", action="append", help="計算本益比用的收盤價，格式 檔名=價格 (例如 2330=1045)")
+    parser.add_argument("--previous-dir", help="上一期的輸出目錄 (增量更新：沿用附註內容沒有變動的大項)")
+    parser.add_argument("--export", action="append", dest="exports", choices=available_formats(),
+                        help="另外輸出的結構化格式，可重複指定 (parquet / json / xlsx)")
+    parser.add_argument("--routing", choices=list(ROUTING_POLICIES),
+                        help="依步驟選擇模型 (hybrid：標準化提取使用 Pro，其餘使用 Flash)，不可與 --model 同時使用"
+                             " (預設: 環境變數 MODEL_ROUTING；指定 --model 時為單一模型)")
+    parser.add_argument("--fallback", action="store_true", default=MODEL_FALLBACK,
+                        help="步驟失敗時改用另一個模型重試")
+    parser.add_argument("--force", action="store_true", help="忽略已有輸出，全部重新執行")
+    args = parser.parse_args(argv)
+
+    api_key = os.getenv("GEMINI_API_KEY")
+    if not api_key:
+        parser.error("GEMINI_API_KEY 未設定")
+
+    pdf_paths = expand_inputs(args.inputs)
+    if not pdf_paths:
+        parser.error("找不到任何 PDF 檔案")
+
+    if args.routing and args.models:
+        parser.error("--routing 依步驟決定模型，不可與 --model 同時使用")
+    routing = args.routing or (None if args.models else MODEL_ROUTING or None)
+
+    try:
+        model_limit = parse_model_limits(args.model_limit, max(1, args.max_per_model))
+        closing_prices = parse_closing_prices(args.closing_price)
+    except ValueError as e:
+        parser.error(str(e))
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    runner = BatchRunner(
+        client=genai.Client(api_key=api_key),
+        out_dir=args.out_dir,
+        workers=max(1, args.workers),
+        model_limit=model_limit,
+        cache=AnalysisResultCache(RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES),
+        closing_prices=closing_prices,
+        previous_dir=args.previous_dir,
+        export_formats=args.exports or (),
+        routing=routing,
+        fallback=args.fallback
+    )
+    total, failures = runner.run(pdf_paths, args.models or [DEFAULT_MODEL], force=args.force)
+    print(f"📦 共 {total} 項，成功 {total - failures} 項，失敗 {failures} 項。輸出目錄: {args.out_dir}", flush=True)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,261 @@
+"""
+離線基準測試：以替身後端 (stub_backend) 重播錄製的回應，對隨附的 PDF 執行完整分析流程
+(analyze_pdf，與 Streamlit 的 run_analysis_flow 相同的步驟圖、串流與 PDF 上傳) 與聊天
+(process_chat_message)，回報端到端延遲、各步驟耗時、送出位元組數與記憶體峰值。不需網路與 API 金鑰。
+
+用法：
+    python benchmarks/bench_pipeline.py
+    python benchmarks/bench_pipeline.py --latency 1.0 --error-rate 0.2 --passes 2 --result-cache
+    python benchmarks/bench_pipeline.py --json bench.json                         # 儲存結果
+    python benchmarks/bench_pipeline.py --baseline bench.json --tolerance 0.2     # 與基準比較，退步時回傳 1
+    GEMINI_API_KEY=... python benchmarks/bench_pipeline.py --record benchmarks/recordings/new.json
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_ROOT)
+
+# 呼叫紀錄寫到暫存檔，避免混入應用程式的診斷資料 (須在匯入 analysis_pipeline 前設定)
+_LOG_DIR = tempfile.mkdtemp(prefix="bench-log-")
+os.environ["API_CALL_LOG"] = os.path.join(_LOG_DIR, "api_calls.jsonl")
+
+from analysis_pipeline import (
+    DEFAULT_MODEL,
+    AnalysisResultCache,
+    ChatContextRegistry,
+    PdfFileRegistry,
+    SectionIndex,
+    analysis_steps,
+    analyze_pdf,
+    chat_context_key,
+    create_chat_context,
+    process_chat_message,
+)
+from stub_backend import RecordingClient, StubBackend, StubClient, load_recording
+
+DEFAULT_RECORDING = os.path.join(BENCH_DIR, "recordings", "sample.json")
+DEFAULT_QUESTIONS = [
+    "這家公司的負債比率高嗎？",
+    "請說明關係人交易的情況",
+    "營業活動現金流量與淨利是否一致？",
+]
+# 與基準比較的指標，以及時間指標允許的絕對誤差 (秒)，避免極短的測量因排程抖動誤判
+COMPARED_METRICS = ("e2e_s", "bytes_total", "peak_mem_mb")
+TIME_SLACK_SECONDS = 0.05
+
+
+def step_prompts():
+    return {step["prompt"]: step["key"] for step in analysis_steps() if step["prompt"]}
+
+
+def run_one(client, pdf_path, model_name, questions, cache, stream):
+    """分析一份 PDF 並依序提出聊天問題，回傳耗時與資料量 (不含記憶體)。"""
+    with open(pdf_path, "rb") as f:
+        pdf_bytes = f.read()
+    registry = PdfFileRegistry()
+    holder = "bench"
+
+    def get_pdf_part(data, document=None):
+        return registry.get_part(client, data, holder, document)
+
+    step_started, step_seconds = {}, {}
+
+    def on_start(step):
+        step_started[step["key"]] = time.perf_counter()
+
+    def on_done(step, completed, from_cache=False):
+        started = step_started.get(step["key"])
+        step_seconds[step["key"]] = 0.0 if from_cache else round(time.perf_counter() - started, 3)
+
+    started = time.perf_counter()
+    results = analyze_pdf(
+        client, pdf_bytes,
+        model_name=model_name,
+        cache=cache,
+        get_pdf_part=get_pdf_part,
+        on_start=on_start,
+        on_done=on_done,
+        on_progress=(lambda step, text: None) if stream else None
+    )
+    analysis_seconds = time.perf_counter() - started
+
+    contexts = ChatContextRegistry()
+    index = SectionIndex(results["standardization"])
+
+    def get_context():
+        return contexts.get(
+            chat_context_key(results, model_name),
+            lambda: create_chat_context(client, results, model_name, pdf_part=get_pdf_part(pdf_bytes))
+        )
+
+    history, chat_seconds = [], []
+    for question in questions:
+        chat_started = time.perf_counter()
+        answer = process_chat_message(client, question, get_context, index, history, model_name=model_name)
+        chat_seconds.append(round(time.perf_counter() - chat_started, 3))
+        if answer.startswith("❌"):
+            raise Exception(f"聊天失敗: {answer}")
+        history += [{"role": "user", "content": question}, {"role": "assistant", "content": answer}]
+
+    registry.release(client, holder)
+    return {
+        "e2e_s": round(time.perf_counter() - started, 3),
+        "analysis_s": round(analysis_seconds, 3),
+        "steps": step_seconds,
+        "chat_s": chat_seconds,
+    }
+
+
+def run_benchmark(client, pdf_paths, model_name, questions, passes, cache, stream):
+    runs = []
+    tracemalloc.start()
+    try:
+        for pass_no in range(1, passes + 1):
+            for pdf_path in pdf_paths:
+                before = client.backend.stats.snapshot()
+                tracemalloc.reset_peak()
+                run = run_one(client, pdf_path, model_name, questions, cache, stream)
+                peak = tracemalloc.get_traced_memory()[1]
+                after = client.backend.stats.snapshot()
+                delta = {k: after[k] - before[k] for k in after}
+                run.update({
+                    "pass": pass_no,
+                    "pdf": os.path.basename(pdf_path),
+                    "requests": delta["requests"],
+                    "errors_injected": delta["errors_injected"],
+                    "bytes_sent": delta["bytes_sent"],
+                    "bytes_uploaded": delta["bytes_uploaded"],
+                    "bytes_total": delta["bytes_sent"] + delta["bytes_uploaded"],
+                    "peak_mem_mb": round(peak / 1024 / 1024, 2),
+                })
+                runs.append(run)
+                print_run(run)
+    finally:
+        tracemalloc.stop()
+    return runs
+
+
+def print_run(run):
+    steps = " ".join(f"{k}={v:.2f}" for k, v in run["steps"].items())
+    chat = " ".join(f"{s:.2f}" for s in run["chat_s"])
+    print(
+        f"[pass {run['pass']}] {run['pdf']}: e2e {run['e2e_s']:.2f}s (分析 {run['analysis_s']:.2f}s) · "
+        f"請求 {run['requests']} (注入錯誤 {run['errors_injected']}) · "
+        f"送出 {run['bytes_sent'] / 1024:.1f} KB + 上傳 {run['bytes_uploaded'] / 1024:.1f} KB · "
+        f"記憶體峰值 {run['peak_mem_mb']:.2f} MB\n    步驟: {steps}\n    聊天: {chat}",
+        flush=True
+    )
+
+
+def compare_with_baseline(runs, baseline_runs, tolerance):
+    """回傳退步項目的說明清單 (同一 pass、同一 PDF 的指標超過基準 × (1 + tolerance))。"""
+    baseline = {(r["pass"], r["pdf"]): r for r in baseline_runs}
+    regressions = []
+    for run in runs:
+        base = baseline.get((run["pass"], run["pdf"]))
+        if base is None: continue
+        for metric in COMPARED_METRICS:
+            if metric not in base: continue
+            limit = base[metric] * (1 + tolerance)
+            if metric.endswith("_s"): limit += TIME_SLACK_SECONDS
+            if run[metric] > limit:
+                regressions.append(f"[pass {run['pass']}] {run['pdf']} {metric}: {base[metric]} → {run[metric]}")
+    return regressions
+
+
+def record(pdf_paths, model_name, questions, out_path):
+    """以真實 API 執行一次分析與聊天，並把回應存成錄製檔。"""
+    import google.genai as genai
+
+    api_key = os.getenv("GEMINI_API_KEY")
+    if not api_key:
+        raise SystemExit("錄製需要 GEMINI_API_KEY")
+    client = RecordingClient(genai.Client(api_key=api_key), step_prompts())
+    registry = PdfFileRegistry()
+    for pdf_path in pdf_paths[:1]:
+        with open(pdf_path, "rb") as f:
+            pdf_bytes = f.read()
+        results = analyze_pdf(client, pdf_bytes, model_name=model_name,
+                              get_pdf_part=lambda data, document=None: registry.get_part(client, data, "record", document))
+        context = create_chat_context(client, results, model_name)
+        index = SectionIndex(results["standardization"])
+        for question in questions:
+            process_chat_message(client, question, lambda: context, index, model_name=model_name)
+    registry.release(client, "record")
+    client.save(out_path)
+    print(f"💾 已錄製 {os.path.basename(pdf_paths[0])} 的回應: {out_path}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="以替身後端離線測量分析流程與聊天的效能")
+    parser.add_argument("pdfs", nargs="*", help="PDF 檔案 (預設: 專案根目錄隨附的 PDF)")
+    parser.add_argument("--recording", default=DEFAULT_RECORDING, help="錄製的回應檔 (JSON)")
+    parser.add_argument("--model", default=DEFAULT_MODEL, help=f"模型名稱 (決定速率限制；預設: {DEFAULT_MODEL})")
+    parser.add_argument("--latency", type=float, default=0.5, help="首個 token 前的延遲秒數 (預設: 0.5)")
+    parser.add_argument("--chars-per-second", type=float, default=2000.0, help="輸出速度 (預設: 2000 字元/秒)")
+    parser.add_argument("--jitter", type=float, default=0.1, help="延遲的隨機浮動比例 (預設: 0.1)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="每個請求注入錯誤的機率 (預設: 0)")
+    parser.add_argument("--error-code", type=int, default=503, help="注入錯誤的狀態碼 (預設: 503)")
+    parser.add_argument("--retry-delay", type=float, default=0.2, help="注入錯誤建議的重試間隔秒數 (預設: 0.2)")
+    parser.add_argument("--seed", type=int, default=0, help="隨機種子 (預設: 0)")
+    parser.add_argument("--passes", type=int, default=1, help="重複執行次數 (預設: 1)")
+    parser.add_argument("--result-cache", action="store_true", help="啟用結果快取 (暫存目錄，跨 pass 共用)")
+    parser.add_argument("--no-provider-cache", action="store_true", help="模擬不支援上下文快取的模型")
+    parser.add_argument("--no-stream", action="store_true", help="分析步驟不使用串流 (同批次模式)")
+    parser.add_argument("--json", dest="json_path", help="將結果寫入 JSON 檔")
+    parser.add_argument("--baseline", help="與先前的 JSON 結果比較")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允許的退步比例 (預設: 0.2)")
+    parser.add_argument("--record", metavar="PATH", help="以真實 API 錄製回應並存到 PATH (需要 GEMINI_API_KEY)")
+    args = parser.parse_args(argv)
+
+    pdf_paths = [os.path.abspath(p) for p in args.pdfs] or sorted(glob.glob(os.path.join(REPO_ROOT, "*.pdf")))
+    if not pdf_paths:
+        parser.error("找不到任何 PDF 檔案")
+
+    if args.record:
+        record(pdf_paths, args.model, DEFAULT_QUESTIONS, args.record)
+        return 0
+
+    backend = StubBackend(
+        load_recording(args.recording),
+        step_prompts(),
+        first_token_latency=args.latency,
+        chars_per_second=args.chars_per_second,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        error_code=args.error_code,
+        retry_delay=args.retry_delay,
+        seed=args.seed
+    )
+    client = StubClient(backend, provider_cache=not args.no_provider_cache)
+    cache = None
+    if args.result_cache:
+        cache = AnalysisResultCache(tempfile.mkdtemp(prefix="bench-cache-"), 200 * 1024 * 1024)
+
+    runs = run_benchmark(client, pdf_paths, args.model, DEFAULT_QUESTIONS, max(1, args.passes), cache, not args.no_stream)
+
+    if args.json_path:
+        config = {k: v for k, v in vars(args).items() if k not in ("json_path", "baseline", "record")}
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump({"config": config, "runs": runs}, f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare_with_baseline(runs, json.load(f)["runs"], args.tolerance)
+        if regressions:
+            print("⚠️ 相較基準退步:\n  " + "\n  ".join(regressions))
+            return 1
+        print(f"✅ 未超過基準 (容許 {args.tolerance:.0%})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
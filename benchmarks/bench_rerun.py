@@ -0,0 +1,165 @@
+"""
+Streamlit 重新執行 (rerun) 延遲基準測試：以 streamlit.testing 的 AppTest 在無瀏覽器的環境執行 streamlit_app.py，
+對各頁面 (首頁、報告、聊天、比較) 重複觸發 rerun，回報每次 rerun 的耗時 (實際時間與 CPU 時間；
+包含 AppTest 本身的處理) 與送出的 Markdown/HTML 字元數 (每次 rerun 都會重新送到瀏覽器的內容)。報告頁使用錄製檔的回應組成的分析結果，不需網路與 API 金鑰。
+
+用法：
+    python benchmarks/bench_rerun.py
+    python benchmarks/bench_rerun.py --reruns 50 --theme "極致黑金 (Dark)"
+    python benchmarks/bench_rerun.py --json rerun.json
+    python benchmarks/bench_rerun.py --baseline rerun.json --tolerance 0.2     # 與基準比較，退步時回傳 1
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_ROOT)
+
+# 呼叫紀錄與快取寫到暫存目錄，避免混入應用程式的資料 (須在匯入 analysis_pipeline 前設定)
+_TMP_DIR = tempfile.mkdtemp(prefix="bench-rerun-")
+os.environ["API_CALL_LOG"] = os.path.join(_TMP_DIR, "api_calls.jsonl")
+os.environ["ANALYSIS_CACHE_DIR"] = os.path.join(_TMP_DIR, "analysis_results")
+os.environ["DOCUMENT_STORE_DIR"] = os.path.join(_TMP_DIR, "documents")
+os.environ.setdefault("GEMINI_API_KEY", "bench-rerun")  # 只用於建立 CLIENT，基準測試不會呼叫 API
+
+from streamlit.testing.v1 import AppTest
+
+from analysis_pipeline import DEFAULT_MODEL, STANDARDIZATION_SHARDS, merge_standardization_shards
+from report_tables import parse_results_tables
+from stub_backend import load_recording
+
+APP_PATH = os.path.join(REPO_ROOT, "streamlit_app.py")
+DEFAULT_RECORDING = os.path.join(BENCH_DIR, "recordings", "sample.json")
+PAGES = ("Home", "Report", "Chat", "Compare")
+THEMES = ("跟隨系統", "極致黑金 (Dark)", "皇家白金 (Light)")
+# 與基準比較的指標，以及時間指標允許的絕對誤差 (毫秒)
+COMPARED_METRICS = ("p50_ms", "cpu_p50_ms", "markdown_chars")
+TIME_SLACK_MS = 5.0
+
+
+def recorded_results(recording):
+    """以錄製的回應組成分析結果 (與 analyze_pdf 的輸出格式相同)。"""
+    responses = load_recording(recording)
+    results = {
+        "pdf_sha256": "bench-rerun",
+        "model_name": DEFAULT_MODEL,
+        "closing_price": None,
+        "company_name": responses.get("company_name", "").strip() or "範例公司",
+        "ratio": responses.get("ratio", ""),
+        "summary": responses.get("summary", ""),
+        "explanation": responses.get("explanation", ""),
+        "standardization": merge_standardization_shards(
+            [(shard, responses.get(shard["key"], "")) for shard in STANDARDIZATION_SHARDS]),
+    }
+    results["tables"] = parse_results_tables(results)
+    chat = responses.get("chat") or []
+    return results, chat
+
+
+def markdown_chars(at):
+    """本次 rerun 送出的 Markdown / HTML 字元數。"""
+    return sum(len(element.value or "") for element in at.markdown)
+
+
+def bench_page(page, theme, results, chat, reruns):
+    """對單一頁面重複 rerun，回傳耗時統計 (第一次執行為暖機，不列入統計)。"""
+    at = AppTest.from_file(APP_PATH, default_timeout=60)
+    at.session_state["ui_theme"] = theme
+    at.session_state["current_page"] = page
+    if page != "Home":
+        at.session_state["analysis_results"] = results
+        at.session_state["report_library"] = {f"{results['company_name']} ({DEFAULT_MODEL})": results}
+    if page == "Chat":
+        at.session_state["chat_history"] = [
+            {"role": role, "content": text}
+            for question, answer in zip(("這家公司的負債比率高嗎？", "請說明關係人交易的情況"), chat)
+            for role, text in (("user", question), ("assistant", answer))
+        ]
+    at.run()
+    if at.exception:
+        raise RuntimeError(f"{page}: {at.exception[0].value}")
+
+    timings, cpu_timings = [], []
+    for _ in range(reruns):
+        started, cpu_started = time.perf_counter(), time.process_time()
+        at.run()
+        timings.append((time.perf_counter() - started) * 1000)
+        cpu_timings.append((time.process_time() - cpu_started) * 1000)
+    timings.sort()
+    cpu_timings.sort()
+    return {
+        "page": page,
+        "theme": theme,
+        "reruns": reruns,
+        "p50_ms": round(timings[len(timings) // 2], 2),
+        "p95_ms": round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 2),
+        "mean_ms": round(sum(timings) / len(timings), 2),
+        "cpu_p50_ms": round(cpu_timings[len(cpu_timings) // 2], 2),
+        "markdown_chars": markdown_chars(at),
+    }
+
+
+def print_run(run):
+    print(
+        f"{run['page']:<8} [{run['theme']}] p50 {run['p50_ms']:.1f} ms · p95 {run['p95_ms']:.1f} ms · "
+        f"平均 {run['mean_ms']:.1f} ms · CPU p50 {run['cpu_p50_ms']:.1f} ms · Markdown {run['markdown_chars']} 字元",
+        flush=True
+    )
+
+
+def compare_with_baseline(runs, baseline_runs, tolerance):
+    """回傳退步項目的說明清單 (同一頁面、同一主題的指標超過基準 × (1 + tolerance))。"""
+    baseline = {(r["page"], r["theme"]): r for r in baseline_runs}
+    regressions = []
+    for run in runs:
+        base = baseline.get((run["page"], run["theme"]))
+        if base is None: continue
+        for metric in COMPARED_METRICS:
+            limit = base[metric] * (1 + tolerance)
+            if metric.endswith("_ms"): limit += TIME_SLACK_MS
+            if run[metric] > limit:
+                regressions.append(f"{run['page']} [{run['theme']}] {metric}: {base[metric]} → {run[metric]}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="測量 Streamlit 各頁面的 rerun 延遲")
+    parser.add_argument("--page", action="append", dest="pages", choices=PAGES, help="只測量指定頁面，可重複指定 (預設: 全部)")
+    parser.add_argument("--theme", action="append", dest="themes", choices=THEMES, help=f"介面主題，可重複指定 (預設: {THEMES[0]})")
+    parser.add_argument("--reruns", type=int, default=30, help="每個頁面的 rerun 次數 (預設: 30)")
+    parser.add_argument("--recording", default=DEFAULT_RECORDING, help="錄製的回應檔 (JSON)")
+    parser.add_argument("--json", dest="json_path", help="將結果寫入 JSON 檔")
+    parser.add_argument("--baseline", help="與先前的 JSON 結果比較")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允許的退步比例 (預設: 0.2)")
+    args = parser.parse_args(argv)
+
+    results, chat = recorded_results(args.recording)
+    runs = []
+    for theme in args.themes or [THEMES[0]]:
+        for page in args.pages or PAGES:
+            run = bench_page(page, theme, results, chat, max(1, args.reruns))
+            runs.append(run)
+            print_run(run)
+
+    if args.json_path:
+        config = {k: v for k, v in vars(args).items() if k not in ("json_path", "baseline")}
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump({"config": config, "runs": runs}, f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare_with_baseline(runs, json.load(f)["runs"], args.tolerance)
+        if regressions:
+            print("⚠️ 相較基準退步:\n  " + "\n  ".join(regressions))
+            return 1
+        print(f"✅ 未超過基準 (容許 {args.tolerance:.0%})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,139 @@
+"""
+冷啟動基準測試：在全新的子行程中匯入各模組 (以及以 AppTest 執行 streamlit_app.py 的第一次繪製)，
+回報匯入耗時的中位數，以及匯入後是否已載入 google.genai / pypdf 等較慢的套件
+(這些套件應在第一次呼叫 API 或處理 PDF 時才匯入)。
+
+用法：
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --runs 9 --target analysis_pipeline
+    python benchmarks/bench_startup.py --json startup.json
+    python benchmarks/bench_startup.py --baseline startup.json --tolerance 0.2     # 與基準比較，退步時回傳 1
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+
+# 測量目標：名稱 -> 子行程中執行的程式碼 (app 為 streamlit_app.py 首頁的第一次繪製，含 streamlit 本身的匯入)
+TARGETS = {
+    "analysis_pipeline": "import analysis_pipeline",
+    "pdf_pages": "import pdf_pages",
+    "report_tables": "import report_tables",
+    "batch_analyze": "import batch_analyze",
+    "sample_reports": "import sample_reports",
+    "app": (
+        "from streamlit.testing.v1 import AppTest\n"
+        "at = AppTest.from_file('streamlit_app.py', default_timeout=60)\n"
+        "at.run()\n"
+        "assert not at.exception, at.exception[0].value"
+    ),
+}
+# 不應在啟動時載入的套件
+HEAVY_MODULES = ("google.genai", "pypdf", "pandas")
+# 與基準比較的指標，以及時間允許的絕對誤差 (毫秒)
+COMPARED_METRICS = ("p50_ms",)
+TIME_SLACK_MS = 20.0
+
+_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+exec(compile({code!r}, "<startup>", "exec"))
+elapsed = (time.perf_counter() - started) * 1000
+print(json.dumps({{"ms": elapsed, "loaded": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def measure(code, env):
+    """在全新的子行程執行一次，回傳 (耗時毫秒, 已載入的較慢套件)。"""
+    probe = _PROBE.format(code=code, heavy=HEAVY_MODULES)
+    out = subprocess.run([sys.executable, "-c", probe], cwd=REPO_ROOT, env=env,
+                         capture_output=True, text=True, check=True)
+    data = json.loads(out.stdout.strip().splitlines()[-1])
+    return data["ms"], data["loaded"]
+
+
+def bench_target(name, runs, env):
+    """重複測量單一目標 (第一次為暖機：讓 .pyc 與檔案系統快取就緒，不列入統計)。"""
+    code = TARGETS[name]
+    measure(code, env)
+    timings, loaded = [], []
+    for _ in range(runs):
+        ms, loaded = measure(code, env)
+        timings.append(ms)
+    timings.sort()
+    return {
+        "target": name,
+        "runs": runs,
+        "p50_ms": round(timings[len(timings) // 2], 2),
+        "min_ms": round(timings[0], 2),
+        "loaded": loaded,
+    }
+
+
+def print_run(run):
+    loaded = "、".join(run["loaded"]) or "無"
+    print(f"{run['target']:<18} p50 {run['p50_ms']:.1f} ms · 最短 {run['min_ms']:.1f} ms · 已載入: {loaded}", flush=True)
+
+
+def compare_with_baseline(runs, baseline_runs, tolerance):
+    """回傳退步項目的說明清單 (耗時超過基準 × (1 + tolerance)，或多載入了較慢的套件)。"""
+    baseline = {r["target"]: r for r in baseline_runs}
+    regressions = []
+    for run in runs:
+        base = baseline.get(run["target"])
+        if base is None: continue
+        for metric in COMPARED_METRICS:
+            if run[metric] > base[metric] * (1 + tolerance) + TIME_SLACK_MS:
+                regressions.append(f"{run['target']} {metric}: {base[metric]} → {run[metric]}")
+        extra = sorted(set(run["loaded"]) - set(base["loaded"]))
+        if extra:
+            regressions.append(f"{run['target']} 啟動時多載入: {'、'.join(extra)}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="測量各模組的冷啟動匯入時間")
+    parser.add_argument("--target", action="append", dest="targets", choices=list(TARGETS),
+                        help="只測量指定目標，可重複指定 (預設: 全部)")
+    parser.add_argument("--runs", type=int, default=5, help="每個目標的子行程次數 (預設: 5)")
+    parser.add_argument("--json", dest="json_path", help="將結果寫入 JSON 檔")
+    parser.add_argument("--baseline", help="與先前的 JSON 結果比較")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允許的退步比例 (預設: 0.2)")
+    args = parser.parse_args(argv)
+
+    # 呼叫紀錄與快取寫到暫存目錄，避免混入應用程式的資料
+    tmp_dir = tempfile.mkdtemp(prefix="bench-startup-")
+    env = dict(os.environ,
+               API_CALL_LOG=os.path.join(tmp_dir, "api_calls.jsonl"),
+               ANALYSIS_CACHE_DIR=os.path.join(tmp_dir, "analysis_results"),
+               DOCUMENT_STORE_DIR=os.path.join(tmp_dir, "documents"))
+    env.setdefault("GEMINI_API_KEY", "bench-startup")  # 只用於建立 CLIENT，基準測試不會呼叫 API
+
+    runs = []
+    for name in args.targets or TARGETS:
+        run = bench_target(name, max(1, args.runs), env)
+        runs.append(run)
+        print_run(run)
+
+    if args.json_path:
+        config = {k: v for k, v in vars(args).items() if k not in ("json_path", "baseline")}
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump({"config": config, "runs": runs}, f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare_with_baseline(runs, json.load(f)["runs"], args.tolerance)
+        if regressions:
+            print("⚠️ 相較基準退步:\n  " + "\n  ".join(regressions))
+            return 1
+        print(f"✅ 未超過基準 (容許 {args.tolerance:.0%})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,284 @@
+"""
+離線基準測試用的 Gemini 替身 (stub) 後端：介面與 genai.Client 相同 (models / files / caches)，
+以錄製的回應取代實際 API，並可設定延遲、吞吐量與錯誤注入。所有送出的資料量都會累計。
+
+錄製檔格式 (JSON)：
+    {"responses": {"company_name": "...", "standardization_assets": "...", (其餘標準化分片 ...)
+                   "ratio": "...", "summary": "...", "explanation": "...", "chat": ["...", "..."]}}
+鍵為 analysis_steps() 的步驟 key (不呼叫模型的步驟，例如標準化合併，不需要錄製)。
+"""
+import json
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from google.genai import errors, types
+
+
+def load_recording(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)["responses"]
+
+
+def payload_bytes(value):
+    """估算一個請求內容實際送出的位元組數 (文字以 UTF-8 計算，內嵌檔案以原始大小計算)。"""
+    if value is None:
+        return 0
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    if isinstance(value, (list, tuple)):
+        return sum(payload_bytes(v) for v in value)
+    if isinstance(value, types.Content):
+        return payload_bytes(list(value.parts or []))
+    if isinstance(value, types.Part):
+        if value.text is not None: return payload_bytes(value.text)
+        if value.inline_data is not None: return len(value.inline_data.data or b"")
+        if value.file_data is not None: return payload_bytes(value.file_data.file_uri)
+    return 0
+
+
+# 回報用量時每個 PDF Part 的 token 數 (實際約每頁 258 token；與 analysis_pipeline.PDF_TOKEN_ESTIMATE 相同)
+STUB_PDF_TOKENS = 20_000
+
+
+def prompt_tokens(value):
+    """回報給排程器的輸入 token 數：文字以 3 位元組 1 token 計算，PDF 以固定值計算 (不依檔案大小)。"""
+    if isinstance(value, (list, tuple)):
+        return sum(prompt_tokens(v) for v in value)
+    if isinstance(value, types.Content):
+        return prompt_tokens(list(value.parts or []))
+    if isinstance(value, types.Part) and value.text is None:
+        return STUB_PDF_TOKENS if value.inline_data is not None or value.file_data is not None else 0
+    return payload_bytes(value) // 3
+
+
+class StubStats:
+    """替身後端的累計數據 (執行緒安全)。"""
+
+    FIELDS = ("requests", "errors_injected", "bytes_sent", "bytes_uploaded", "uploads", "caches_created")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._values = dict.fromkeys(self.FIELDS, 0)
+
+    def add(self, **deltas):
+        with self._lock:
+            for name, delta in deltas.items():
+                self._values[name] += delta
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+
+class StubBackend:
+    """
+    回應重播與延遲模型：每個請求先等待 first_token_latency 秒 (± jitter)，
+    再依 chars_per_second 逐段輸出；error_rate 機率回傳可重試錯誤 (error_code，預設 503)。
+    """
+
+    def __init__(self, responses, step_prompts, first_token_latency=0.5, chars_per_second=2000.0,
+                 jitter=0.1, error_rate=0.0, error_code=503, retry_delay=0.2, chunk_chars=200, seed=0):
+        self.responses = responses
+        self.step_prompts = step_prompts  # 提示詞全文 -> 步驟 key
+        self.first_token_latency = first_token_latency
+        self.chars_per_second = chars_per_second
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.retry_delay = retry_delay
+        self.chunk_chars = chunk_chars
+        self.stats = StubStats()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._chat_turn = 0
+
+    def _random(self):
+        with self._lock:
+            return self._rng.random()
+
+    def identify(self, contents):
+        """依提示詞判斷請求屬於哪個分析步驟；對話 (Content 物件) 一律視為聊天。"""
+        for item in contents if isinstance(contents, list) else [contents]:
+            if not isinstance(item, str): continue
+            if item in self.step_prompts:
+                return self.step_prompts[item]
+            # 含 {欄位} 的提示詞範本 (例如比率欄位提取) 以範本開頭比對
+            for prompt, step in self.step_prompts.items():
+                if "{" in prompt and item.startswith(prompt.split("{")[0]):
+                    return step
+        return "chat"
+
+    def response_text(self, step):
+        recorded = self.responses.get(step, "")
+        if isinstance(recorded, list):
+            with self._lock:
+                self._chat_turn += 1
+                return recorded[(self._chat_turn - 1) % len(recorded)] if recorded else ""
+        return recorded
+
+    def begin(self, contents, config):
+        """記錄請求並模擬首個 token 前的延遲；依 error_rate 拋出錯誤。回傳回應全文。"""
+        self.stats.add(requests=1, bytes_sent=payload_bytes(contents) + payload_bytes(getattr(config, "system_instruction", None)))
+        time.sleep(max(0.0, self.first_token_latency * (1 + self.jitter * (2 * self._random() - 1))))
+        if self.error_rate and self._random() < self.error_rate:
+            self.stats.add(errors_injected=1)
+            raise errors.APIError(self.error_code, {"error": {
+                "code": self.error_code,
+                "message": "stub: injected error",
+                "status": "UNAVAILABLE",
+                "details": [{"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": f"{self.retry_delay}s"}],
+            }})
+        return self.response_text(self.identify(contents))
+
+    def chunks(self, text):
+        for start in range(0, len(text), self.chunk_chars):
+            chunk = text[start:start + self.chunk_chars]
+            time.sleep(len(chunk) / self.chars_per_second)
+            yield chunk
+
+    @staticmethod
+    def make_response(text, contents=None, final=True):
+        usage = None
+        if final:
+            input_tokens = prompt_tokens(contents)
+            usage = types.GenerateContentResponseUsageMetadata(
+                prompt_token_count=input_tokens,
+                candidates_token_count=len(text) // 2,
+                total_token_count=input_tokens + len(text) // 2
+            )
+        return types.GenerateContentResponse(
+            candidates=[types.Candidate(content=types.Content(role="model", parts=[types.Part(text=text)]))],
+            usage_metadata=usage
+        )
+
+
+class _StubModels:
+    def __init__(self, backend, caches):
+        self._backend = backend
+        self._caches = caches
+
+    def _check_cache(self, config):
+        name = getattr(config, "cached_content", None)
+        if name and not self._caches.exists(name):
+            raise errors.APIError(404, {"error": {"code": 404, "message": f"stub: {name} not found", "status": "NOT_FOUND"}})
+
+    def generate_content(self, model, contents, config=None):
+        self._check_cache(config)
+        text = self._backend.begin(contents, config)
+        time.sleep(len(text) / self._backend.chars_per_second)
+        return self._backend.make_response(text, contents)
+
+    def generate_content_stream(self, model, contents, config=None):
+        self._check_cache(config)
+        text = self._backend.begin(contents, config)
+        pieces = list(self._backend.chunks(text)) if text else [""]
+        for i, piece in enumerate(pieces):
+            yield self._backend.make_response(piece, contents, final=i == len(pieces) - 1)
+
+
+class _StubFiles:
+    def __init__(self, backend):
+        self._backend = backend
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def upload(self, file, config=None):
+        data = file.read() if hasattr(file, "read") else open(file, "rb").read()
+        self._backend.stats.add(uploads=1, bytes_uploaded=len(data))
+        name = f"files/stub-{uuid.uuid4().hex[:12]}"
+        uploaded = types.File(
+            name=name,
+            uri=f"https://stub.invalid/{name}",
+            mime_type=getattr(config, "mime_type", None) or "application/pdf",
+            expiration_time=datetime.now(timezone.utc) + timedelta(hours=48)
+        )
+        with self._lock:
+            self._files[name] = uploaded
+        return uploaded
+
+    def get(self, name):
+        with self._lock:
+            return self._files[name]
+
+    def delete(self, name):
+        with self._lock:
+            self._files.pop(name, None)
+
+
+class _StubCaches:
+    def __init__(self, backend, enabled=True):
+        self._backend = backend
+        self._enabled = enabled
+        self._names = set()
+        self._lock = threading.Lock()
+
+    def exists(self, name):
+        with self._lock:
+            return name in self._names
+
+    def create(self, model, config=None):
+        if not self._enabled:
+            raise errors.APIError(400, {"error": {"code": 400, "message": "stub: caching disabled", "status": "INVALID_ARGUMENT"}})
+        self._backend.stats.add(caches_created=1, bytes_sent=payload_bytes(config.contents) + payload_bytes(config.system_instruction))
+        name = f"cachedContents/stub-{uuid.uuid4().hex[:12]}"
+        with self._lock:
+            self._names.add(name)
+        ttl_seconds = float(str(config.ttl or "3600s").rstrip("s"))
+        return types.CachedContent(name=name, model=model, expire_time=datetime.now(timezone.utc) + timedelta(seconds=ttl_seconds))
+
+
+class StubClient:
+    """可直接取代 genai.Client 傳入 analysis_pipeline 的替身用戶端。"""
+
+    def __init__(self, backend, provider_cache=True):
+        self.backend = backend
+        self.files = _StubFiles(backend)
+        self.caches = _StubCaches(backend, enabled=provider_cache)
+        self.models = _StubModels(backend, self.caches)
+
+
+class RecordingClient:
+    """
+    包裝真正的 genai.Client，把各步驟的回應文字記錄下來 (供之後離線重播)。
+    同一步驟只保留第一次的回應；聊天回應依序累積。
+    """
+
+    def __init__(self, client, step_prompts):
+        self._client = client
+        self.files = client.files
+        self.caches = client.caches
+        self.models = self
+        self._identify = StubBackend({}, step_prompts).identify
+        self._lock = threading.Lock()
+        self.responses = {"chat": []}
+
+    def _record(self, contents, text):
+        step = self._identify(contents)
+        with self._lock:
+            if step == "chat":
+                self.responses["chat"].append(text)
+            else:
+                self.responses.setdefault(step, text)
+
+    def generate_content(self, model, contents, config=None):
+        response = self._client.models.generate_content(model=model, contents=contents, config=config)
+        self._record(contents, response.text or "")
+        return response
+
+    def generate_content_stream(self, model, contents, config=None):
+        text = ""
+        for chunk in self._client.models.generate_content_stream(model=model, contents=contents, config=config):
+            text += chunk.text or ""
+            yield chunk
+        self._record(contents, text)
+
+    def save(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"responses": self.responses}, f, ensure_ascii=False, indent=2)
@@ -0,0 +1,34 @@
+"""
+延遲匯入：第一次使用模組的屬性時才真正 import。
+
+google.genai (含 pydantic 型別定義) 與 pypdf 的匯入約需 0.1~0.7 秒；分析流程、批次工具與 Streamlit 頁面在模組頂層
+只建立代理物件，只有實際呼叫 API 或處理 PDF 時才付出匯入成本 (Streamlit 冷啟動與只需解析器的工具不受影響)。
+"""
+import importlib
+import importlib.util
+
+
+class LazyModule:
+    """模組代理：存取任何屬性時匯入目標模組 (只匯入一次)；模組不存在時照常拋出 ImportError。"""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def is_available(self):
+        """模組是否已安裝 (不匯入；供選用套件判斷)。"""
+        return self._module is not None or importlib.util.find_spec(self._name) is not None
+
+    def is_loaded(self):
+        return self._module is not None
+
+    def __repr__(self):
+        return f"<LazyModule {self._name} ({'loaded' if self._module is not None else 'not loaded'})>"
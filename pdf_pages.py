@@ -0,0 +1,175 @@
+"""
+本地 PDF 前處理：逐頁擷取文字並找出各步驟需要的頁面 (封面、四大表、附註)，
+產生只含這些頁面的精簡 PDF，以減少送給模型的輸入量。
+
+需要 pypdf；未安裝或無法辨識頁面 (例如掃描檔沒有文字層) 時回傳 None，呼叫端改送完整 PDF。
+頁面分類與附註章節切段結果以文件 SHA-256 為鍵快取於記憶體 (附註切段供增量更新比對章節內容)。
+"""
+import logging
+import re
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+from lazy_import import LazyModule
+
+# 選用套件：未安裝時不做頁面篩選；第一次處理 PDF 時才匯入 (含加密模組，約 0.1 秒)
+pypdf = LazyModule("pypdf")
+
+# 加密 (僅限制權限) 的財報 PDF 會產生大量無害的警告
+logging.getLogger("pypdf").setLevel(logging.ERROR)
+
+# 頁面群組：封面 (步驟 1)、四大表 (比率欄位提取)、附註與附表 (步驟 2 標準化)
+PAGE_GROUPS = ("cover", "statements", "notes")
+
+# 只掃描前幾頁尋找四大表與附註起始頁 (附註之後的頁面不需擷取文字)
+MAX_SCAN_PAGES = 40
+# 頁首判斷範圍 (去除空白後的字元數)：報表標題都在頁面最上方
+HEADER_CHARS = 120
+PAGE_INDEX_CACHE_SIZE = 64
+# 精簡後仍超過原檔此比例時不值得另外內嵌，直接使用完整 PDF (可重用已上傳的檔案)
+TRIM_MAX_RATIO = 0.9
+
+STATEMENT_TITLES = ("資產負債表", "綜合損益表", "權益變動表", "現金流量表")
+# 附註頁標題 (報表頁的欄位名稱「附註」與頁尾「後附合併財務報表附註…」不算)
+NOTES_TITLE = re.compile(r"(財務報告|財務報表)附[註注]")
+# 目錄與會計師報告也會提到報表名稱，不可視為報表頁
+NON_STATEMENT_MARKERS = ("目錄", "會計師", "公鑒")
+
+# 附註中的標題行：第一層「六、重要會計項目之說明」、第二層「(一)現金及約當現金」
+NOTE_HEADING = re.compile(r"^(?:([一二三四五六七八九十]+、)|[（(][一二三四五六七八九十]+[)）])\s*(.+)$")
+# 頁碼行 (例如「~ 23 ~」、「- 23 -」) 與各頁重複的附註頁首，不屬於章節內容
+PAGE_NUMBER_LINE = re.compile(r"^[~～\-－—\s]*\d+[~～\-－—\s]*$")
+
+_index_caches = {}  # 名稱 -> OrderedDict (digest -> 結果)
+_index_lock = threading.Lock()
+_index_pending = {}  # (名稱, digest) -> Lock：同一份文件同時只處理一次
+
+
+def page_header(page):
+    try:
+        text = page.extract_text() or ""
+    except Exception:
+        return ""
+    return re.sub(r"\s+", "", text)[:HEADER_CHARS]
+
+
+def classify_pages(pdf_bytes):
+    """
+    回傳 {"page_count": N, "cover": [...], "statements": [...], "notes": [...]} (頁碼從 0 開始)；
+    找不到的群組為空 list。無法讀取 PDF 時回傳 None。
+    """
+    if not pypdf.is_available(): return None
+    try:
+        reader = pypdf.PdfReader(BytesIO(pdf_bytes))
+        page_count = len(reader.pages)
+    except Exception:
+        return None
+
+    first_statement, notes_start = None, None
+    for i in range(min(page_count, MAX_SCAN_PAGES)):
+        header = page_header(reader.pages[i])
+        if any(marker in header for marker in NON_STATEMENT_MARKERS): continue
+        is_statement = any(title in header for title in STATEMENT_TITLES)
+        if first_statement is not None and not is_statement and NOTES_TITLE.search(header):
+            notes_start = i
+            break
+        if first_statement is None and is_statement:
+            first_statement = i
+
+    statements, notes = [], []
+    if first_statement is not None:
+        statements = list(range(first_statement, notes_start if notes_start is not None else first_statement + 1))
+    if notes_start is not None:
+        notes = list(range(notes_start, page_count))
+    return {"page_count": page_count, "cover": [0] if page_count else [], "statements": statements, "notes": notes}
+
+
+def _cached(name, digest, compute):
+    """以文件 SHA-256 為鍵的 LRU 快取 (跨 session 共用)；同一份文件同時只計算一次。"""
+    with _index_lock:
+        cache = _index_caches.setdefault(name, OrderedDict())
+        digest_lock = _index_pending.setdefault((name, digest), threading.Lock())
+    with digest_lock:
+        with _index_lock:
+            if digest in cache:
+                cache.move_to_end(digest)
+                return cache[digest]
+        value = compute()
+        with _index_lock:
+            cache[digest] = value
+            _index_pending.pop((name, digest), None)
+            while len(cache) > PAGE_INDEX_CACHE_SIZE:
+                cache.popitem(last=False)
+    return value
+
+
+def get_page_index(pdf_bytes, digest):
+    """classify_pages 的快取版本。"""
+    return _cached("pages", digest, lambda: classify_pages(pdf_bytes))
+
+
+def extract_note_chunks(pdf_bytes, index=None):
+    """
+    擷取附註頁的全文並依標題行切段，回傳 [(層級, 標題, 內容)] (層級 1 為「一、」，2 為「(一)」；
+    內容已去除空白、頁碼與頁首)。第一個標題之前的文字為 (0, "", 內容)。無法讀取或找不到附註時回傳 None。
+    """
+    index = index or classify_pages(pdf_bytes)
+    if index is None or not index["notes"]: return None
+    try:
+        reader = pypdf.PdfReader(BytesIO(pdf_bytes))
+        pages = [reader.pages[i].extract_text() or "" for i in index["notes"]]
+    except Exception:
+        return None
+
+    chunks = [[0, "", []]]
+    for text in pages:
+        for line in text.splitlines():
+            line = re.sub(r"\s+", "", line)
+            if not line or PAGE_NUMBER_LINE.match(line) or NOTES_TITLE.search(line): continue
+            match = NOTE_HEADING.match(line)
+            if match:
+                chunks.append([1 if match.group(1) else 2, match.group(2), []])
+            else:
+                chunks[-1][2].append(line)
+    return [(level, title, "".join(lines)) for level, title, lines in chunks]
+
+
+def get_note_chunks(pdf_bytes, digest):
+    """extract_note_chunks 的快取版本。"""
+    return _cached("notes", digest, lambda: extract_note_chunks(pdf_bytes, get_page_index(pdf_bytes, digest)))
+
+
+def select_pages(index, groups):
+    """合併多個頁面群組 (例如 ("cover", "notes"))；任一群組找不到時回傳 None (改送完整 PDF)。"""
+    if index is None: return None
+    pages = set()
+    for group in groups:
+        if not index.get(group): return None
+        pages.update(index[group])
+    return sorted(pages)
+
+
+def trim_pdf(pdf_bytes, pages):
+    """只保留指定頁面的 PDF 位元組；失敗時回傳 None。"""
+    if not pypdf.is_available() or not pages: return None
+    try:
+        reader = pypdf.PdfReader(BytesIO(pdf_bytes))
+        writer = pypdf.PdfWriter()
+        for i in pages:
+            writer.add_page(reader.pages[i])
+        out = BytesIO()
+        writer.write(out)
+        return out.getvalue()
+    except Exception:
+        return None
+
+
+def trimmed_pdf(pdf_bytes, digest, groups):
+    """
+    只含指定頁面群組的 PDF 位元組；無法分類、找不到群組或精簡效果不明顯時回傳 None
+    (呼叫端改用完整 PDF)。
+    """
+    trimmed = trim_pdf(pdf_bytes, select_pages(get_page_index(pdf_bytes, digest), groups))
+    if trimmed is None or len(trimmed) > len(pdf_bytes) * TRIM_MAX_RATIO: return None
+    return trimmed
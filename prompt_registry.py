@@ -0,0 +1,103 @@
+"""
+提示詞登記表：從提示詞目錄 (prompts/) 載入各步驟的提示詞檔案，啟動時載入一次，檔案修改後自動重新載入，
+並提供每個提示詞的內容雜湊。結果快取鍵與檢查點依提示詞內容計算，因此修改某個提示詞檔案時
+只有使用它的步驟 (與其下游) 需要重新執行，不必重新部署或清除所有快取。
+"""
+import hashlib
+import os
+import threading
+import time
+
+
+def text_digest(text):
+    """字串內容的短雜湊：提示詞雜湊與 analysis_pipeline 的步驟快取鍵共用此函數。"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+
+
+class PromptRegistry:
+    """
+    名稱 -> 提示詞檔案的登記表 (跨 session 共用)。
+    get(name) 回傳目前的內容，digest(name) 回傳內容雜湊，version 為所有提示詞的合併雜湊。
+    每次讀取時最多每 reload_interval 秒比對一次檔案的修改時間與大小，有變動時重新載入；
+    重新載入失敗 (檔案被刪除、內容空白或未通過 validators 的檢查) 時保留先前的內容，原因記錄於 errors。
+    啟動時缺少檔案或檢查失敗則直接拋出例外。
+    """
+
+    def __init__(self, directory, files, reload_interval=2.0, validators=None):
+        self.directory = directory
+        self.files = dict(files)
+        self.reload_interval = reload_interval
+        self.validators = dict(validators or {})
+        self.reloads = 0
+        self.errors = {}  # 名稱 -> 最近一次重新載入失敗的原因
+        self._lock = threading.Lock()
+        self._entries = {name: self._load(name) for name in self.files}
+        self._version = self._compute_version()
+        self._checked_at = time.monotonic()
+
+    def path(self, name):
+        return os.path.join(self.directory, self.files[name])
+
+    def _load(self, name):
+        path = self.path(name)
+        stat = os.stat(path)
+        with open(path, encoding='utf-8') as f:
+            text = f.read().replace("\r\n", "\n")
+        if not text.strip():
+            raise ValueError(f"提示詞檔案為空白: {path}")
+        validator = self.validators.get(name)
+        if validator is not None:
+            validator(text)
+        return {"stamp": (stat.st_mtime_ns, stat.st_size), "text": text, "digest": text_digest(text)}
+
+    def _compute_version(self):
+        return text_digest("|".join(f"{name}={self._entries[name]['digest']}" for name in sorted(self._entries)))
+
+    def refresh(self, force=False):
+        """檢查檔案是否有變動並重新載入；回傳是否有提示詞改變。"""
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._checked_at < self.reload_interval:
+                return False
+            self._checked_at = now
+            changed = False
+            for name, entry in self._entries.items():
+                try:
+                    stat = os.stat(self.path(name))
+                    if (stat.st_mtime_ns, stat.st_size) == entry["stamp"]: continue
+                    loaded = self._load(name)
+                except (OSError, ValueError) as e:
+                    self.errors[name] = str(e)
+                    continue
+                self.errors.pop(name, None)
+                if loaded["digest"] != entry["digest"]:
+                    changed = True
+                self._entries[name] = loaded
+            if changed:
+                self._version = self._compute_version()
+                self.reloads += 1
+            return changed
+
+    def get(self, name):
+        self.refresh()
+        return self._entries[name]["text"]
+
+    def digest(self, name):
+        self.refresh()
+        return self._entries[name]["digest"]
+
+    def snapshot(self):
+        """回傳 (version, {名稱: 內容})，同一次分析應使用同一份快照。"""
+        self.refresh()
+        with self._lock:
+            return self._version, {name: entry["text"] for name, entry in self._entries.items()}
+
+    @property
+    def version(self):
+        self.refresh()
+        return self._version
+
+    def digests(self):
+        self.refresh()
+        with self._lock:
+            return {name: entry["digest"] for name, entry in self._entries.items()}
@@ -0,0 +1,362 @@
+"""
+本地財務比率引擎：以標準化數據 (或少量欄位的輕量提取) 計算七項關鍵比率，取代步驟 3 的模型計算。
+公式與限制依照 analysis_pipeline.PROMPT_RATIO_CONTENT：
+    ROE = 歸屬於母公司業主之本期淨利 (當期累計) / 平均歸屬於母公司業主之權益
+          (期初取上年度期末餘額；缺少時以期末權益替代並註明)
+    本益比 = 收盤價 / 年化基本每股盈餘 (本期累計 EPS：Q1 ×4、H1 ×2、Q3 ÷3×4、全年 ×1；收盤價由呼叫端提供)
+    淨利率 = 本期淨利 / 營業收入；毛利率 = 營業毛利 / 營業收入 (單季數據)
+    負債比率 = 負債總計 / 資產總計；流動比率 = 流動資產合計 / 流動負債合計
+    速動比率 = (流動資產合計 - 存貨 - 預付款項) / 流動負債合計 (缺預付款項時無法計算)
+每個欄位以 [本期, 比較期] 兩期向量表示，比率逐期計算；缺少資料的期間標示為「無法計算」並註明原因。
+損益欄位依 FIELD_BASIS 取單季或累計期間的欄位 (期中財報的損益表同時列出兩者，見 classify_period)；
+期末餘額的比較期取上年同一日期的欄位 (期中財報的資產負債表另列上年度期末，見 select_periods)。
+"""
+import re
+
+from report_tables import is_change_period, parse_report_tables
+
+# 比率計算所需欄位：代碼 -> (提取時使用的標準名稱, 標準化數據中可接受的項目名稱)
+# (提取名稱括號內的期間說明在比對時會被 normalize_item 移除)
+RATIO_INPUT_FIELDS = {
+    "revenue": ("營業收入 (單季)", ("營業收入", "營業收入淨額", "營業收入合計")),
+    "gross_profit": ("營業毛利 (單季)", ("營業毛利", "營業毛利淨額")),
+    "net_income": ("本期淨利 (單季)", ("本期淨利", "本期淨利合計")),
+    "net_income_parent": ("歸屬於母公司業主之本期淨利 (累計)", ("歸屬於母公司業主之本期淨利", "本期淨利歸屬於母公司業主")),
+    "equity_parent": ("歸屬於母公司業主之權益", ("歸屬於母公司業主之權益", "歸屬於母公司業主之權益合計")),
+    "equity_parent_opening": ("期初歸屬於母公司業主之權益", ("期初歸屬於母公司業主之權益",)),
+    "total_assets": ("資產總計", ("資產總計", "資產總額")),
+    "total_liabilities": ("負債總計", ("負債總計", "負債總額")),
+    "current_assets": ("流動資產合計", ("流動資產合計",)),
+    "current_liabilities": ("流動負債合計", ("流動負債合計",)),
+    "inventory": ("存貨", ("存貨", "存貨合計", "存貨淨額")),
+    "prepayments": ("預付款項", ("預付款項", "預付款項合計")),
+    "eps": ("基本每股盈餘 (累計)", ("基本每股盈餘",)),
+}
+
+# 損益欄位的期間基礎：毛利率與淨利率以單季數據計算，ROE 以當期 (累計) 淨利、本益比以本期累計 EPS 年化；
+# 其餘欄位為期末餘額 ("balance")
+FIELD_BASIS = {
+    "revenue": "quarter",
+    "gross_profit": "quarter",
+    "net_income": "quarter",
+    "net_income_parent": "cumulative",
+    "eps": "cumulative",
+}
+# 各比率的期間基礎 (決定比率表格的期間標籤)
+RATIO_BASIS = {"ROE": "cumulative", "PE": "cumulative", "NPM": "quarter", "GPM": "quarter",
+               "DR": "balance", "CR": "balance", "QR": "balance"}
+BASES = ("quarter", "cumulative", "balance")
+
+# 年化每股盈餘的乘數 (依財報期間)
+EPS_ANNUALIZATION = {"Q1": 4.0, "H1": 2.0, "Q3": 4.0 / 3.0, "FY": 1.0}
+
+# 由期間文字判斷財報期間類型 (依序比對)
+PERIOD_TYPE_PATTERNS = [
+    ("Q1", r"第一季|Q1|1\s*[-~至]\s*3\s*月|/0?3/31|\.0?3\.31"),
+    ("H1", r"上半年|半年度|第二季|Q2|H1|1\s*[-~至]\s*6\s*月|/0?6/30|\.0?6\.30"),
+    ("Q3", r"前三季|第三季|Q3|1\s*[-~至]\s*9\s*月|/0?9/30|\.0?9\.30"),
+    ("FY", r"全年|年度|FY|1\s*[-~至]\s*12\s*月|/12/31|\.12\.31"),
+]
+
+# 欄標題的期間：日期區間 (起訖月份)、月份區間與關鍵字
+_DATE_RANGE = re.compile(r"\d{2,4}[/.\-年]\s*(\d{1,2})[/.\-月]\s*\d{1,2}日?\s*[~～至到\-]\s*(?:\d{2,4}[/.\-年])?\s*(\d{1,2})[/.\-月]\s*\d{1,2}")
+_DAY_RANGE = re.compile(r"(\d{1,2})月\s*\d{1,2}日\s*[~～至到\-]\s*(?:\d{2,4}年)?\s*(\d{1,2})月\s*\d{1,2}日")
+_MONTH_RANGE = re.compile(r"(\d{1,2})\s*月?\s*[~～至到\-]\s*(\d{1,2})\s*月")
+_FIRST_QUARTER = re.compile(r"第[一1]季|Q1", re.IGNORECASE)
+_QUARTER = re.compile(r"單季|第[二三四2-4]季|Q[2-4]", re.IGNORECASE)
+_CUMULATIVE = re.compile(r"累計|前三季|上半年|半年度|全年|年度|FY|H1", re.IGNORECASE)
+_DATE = re.compile(r"\d{2,4}\s*[/.年]\s*\d{1,2}\s*[/.月]\s*\d{1,2}|期末|期初")
+_BALANCE_DATE = re.compile(r"(\d{2,4})\s*[/.年]\s*(\d{1,2})\s*[/.月]\s*(\d{1,2})")
+
+_PAREN = re.compile(r"[（(][^)）]*[)）]")
+
+
+def normalize_item(name):
+    """移除空白與括號說明，例如「基本每股盈餘 (元)」→「基本每股盈餘」。"""
+    return re.sub(r"\s+", "", _PAREN.sub("", name or "")).replace("*", "")
+
+
+_ALIASES = {normalize_item(alias): field for field, (_, aliases) in RATIO_INPUT_FIELDS.items() for alias in aliases}
+
+
+def empty_inputs():
+    return {field: [None, None] for field in RATIO_INPUT_FIELDS}
+
+
+def empty_labels():
+    return {basis: [None, None] for basis in BASES}
+
+
+def classify_period(label):
+    """
+    欄標題的期間類型："quarter" (單季，例如 7-9 月)、"cumulative" (自年初累計，例如 1-9 月、全年度)、
+    "both" (第一季：單季即累計)、"balance" (時點，例如 113/09/30)；無法判斷時回傳 None。
+    """
+    text = label or ""
+    for pattern in (_DATE_RANGE, _DAY_RANGE, _MONTH_RANGE):
+        match = pattern.search(text)
+        if match:
+            start, end = int(match.group(1)), int(match.group(2))
+            if start == 1: return "both" if end == 3 else "cumulative"
+            return "quarter" if end - start == 2 else None
+    if _FIRST_QUARTER.search(text): return "both"
+    if _QUARTER.search(text): return "quarter"
+    if _CUMULATIVE.search(text): return "cumulative"
+    if _DATE.search(text): return "balance"
+    return None
+
+
+def balance_date(label):
+    """期末日 (年, 月, 日)，例如「113/06/30」→ (113, 6, 30)；無法判斷時回傳 None。"""
+    match = _BALANCE_DATE.search(label or "")
+    return tuple(int(g) for g in match.groups()) if match else None
+
+
+def select_periods(periods, basis):
+    """
+    從同一列的期間 [(標籤, 數值)] 選出本期與比較期，回傳 (選出的期間, 實際的期間基礎)。
+    單季欄位優先取單季欄 (沒有時依序取無法判斷的欄位、累計欄，例如年度財報)；累計欄位不會取單季欄；
+    期末餘額的本期為第一個期間，比較期取上年同一日期的欄位 (與比較期損益的期間一致)，沒有時取第二個期間。
+    實際基礎無法判斷時為 None。
+    """
+    if basis == "balance":
+        current = balance_date(periods[0][0]) if periods else None
+        if current is not None:
+            same_date = (current[0] - 1,) + current[1:]
+            match = next((p for p in periods[1:] if balance_date(p[0]) == same_date), None)
+            if match is not None: return [periods[0], match], "balance"
+        return periods[:2], "balance"
+    kinds = [classify_period(label) for label, _ in periods]
+    preferred = ("quarter", "both") if basis == "quarter" else ("cumulative", "both")
+    fallbacks = ((None, None), ("cumulative", "cumulative")) if basis == "quarter" else ((None, None),)
+    chosen = [p for p, kind in zip(periods, kinds) if kind in preferred]
+    if chosen: return chosen[:2], basis
+    for kind, used in fallbacks:
+        chosen = [p for p, k in zip(periods, kinds) if k == kind]
+        if chosen: return chosen[:2], used
+    return [], basis
+
+
+def resolve_inputs(columns):
+    """
+    從標準化數據的欄式紀錄找出比率所需欄位 (項目名稱需完全符合)，回傳 (欄位值, 期間標籤, 期間基礎)。
+    同一欄位以最先出現的表格為準；排除變動欄位後依 FIELD_BASIS 選出本期與比較期 (見 select_periods)。
+    沒有期初權益時，以權益列中上年度期末 (例如 113/06/30 的 112/12/31) 的餘額作為各期的期初權益。
+    期間標籤為 {基礎: [本期, 比較期]}；期間基礎為 {欄位: 實際使用的基礎} (只含找到的欄位)。
+    """
+    rows = {}
+    for i, item in enumerate(columns["item"]):
+        field = _ALIASES.get(normalize_item(item))
+        period = columns["period"][i]
+        if field is None or is_change_period(period): continue
+        key = (columns["source"][i], columns["table"][i])
+        row = rows.setdefault(field, {"key": key, "periods": {}})
+        if row["key"] != key: continue
+        row["periods"].setdefault(period, columns["value"][i])
+
+    values, labels, bases = empty_inputs(), empty_labels(), {}
+    chosen_labels = {}
+    for field in RATIO_INPUT_FIELDS:
+        if field not in rows: continue
+        basis = FIELD_BASIS.get(field, "balance")
+        chosen, used = select_periods(list(rows[field]["periods"].items()), basis)
+        if not any(value is not None for _, value in chosen): continue
+        bases[field] = used
+        chosen_labels[field] = [label for label, _ in chosen]
+        for j, (label, value) in enumerate(chosen):
+            values[field][j] = value
+            if labels[basis][j] is None: labels[basis][j] = label
+
+    # 期初權益即上年度期末餘額
+    by_date = {balance_date(label): value for label, value in rows.get("equity_parent", {}).get("periods", {}).items()}
+    for j, label in enumerate(chosen_labels.get("equity_parent", [])):
+        date = balance_date(label)
+        year_end = by_date.get((date[0] - 1, 12, 31)) if date else None
+        if values["equity_parent_opening"][j] is None and year_end is not None:
+            values["equity_parent_opening"][j] = year_end
+            bases["equity_parent_opening"] = "balance"
+    return values, labels, bases
+
+
+def missing_fields(values):
+    return [field for field, pair in values.items() if any(v is None for v in pair)]
+
+
+def merge_inputs(primary, secondary):
+    """以 secondary 補上 primary 中缺少的期間值。"""
+    return {field: [p if p is not None else s for p, s in zip(primary[field], secondary.get(field, [None, None]))]
+            for field in primary}
+
+
+def merge_extraction(values, labels, bases, text):
+    """
+    以輕量提取的輸出補上缺少的欄位與期間標籤，回傳 (欄位值, 期間標籤, 期間基礎, 期間類型)。
+    提取時已指定各欄位的期間基礎，因此補上的欄位以 FIELD_BASIS 為準 (全年度財報沒有單季數，單季欄位為全年數)。
+    """
+    extracted, extracted_labels, period_type = parse_extraction(text)
+    merged = merge_inputs(values, extracted)
+    bases = dict(bases)
+    for field, pair in merged.items():
+        if field not in bases and any(v is not None for v in pair):
+            basis = FIELD_BASIS.get(field, "balance")
+            bases[field] = "cumulative" if basis == "quarter" and period_type == "FY" else basis
+    labels = {basis: [label or other for label, other in zip(labels[basis], extracted_labels[basis])] for basis in BASES}
+    return merged, labels, bases, period_type
+
+
+def extraction_field_list(fields):
+    return "\n".join(f"- {RATIO_INPUT_FIELDS[field][0]}" for field in fields)
+
+
+def parse_extraction(text):
+    """
+    解析輕量提取的輸出 (| 項目 | 本期 | 比較期 | 表格)，回傳 (欄位值, 期間標籤, 期間類型)。
+    「報告期間」列提供累計期間與期末日的標籤，「單季期間」列提供單季的標籤，「期間類型」列為 Q1 / H1 / Q3 / FY。
+    """
+    columns = parse_report_tables(text, "extraction")
+    values, labels, period_type = empty_inputs(), empty_labels(), None
+    names = {normalize_item(name): field for field, (name, _) in RATIO_INPUT_FIELDS.items()}
+    for i, item in enumerate(columns["item"]):
+        slot = 0 if "本期" in columns["period"][i] else 1 if "比較" in columns["period"][i] else None
+        if slot is None: continue
+        raw = columns["raw"][i].strip()
+        name = normalize_item(item)
+        if name in ("報告期間", "單季期間"):
+            if raw and raw not in ("無", "-"):
+                for basis in (("quarter",) if name == "單季期間" else ("cumulative", "balance")):
+                    labels[basis][slot] = raw
+        elif name == "期間類型":
+            if slot == 0 and raw.upper() in EPS_ANNUALIZATION: period_type = raw.upper()
+        elif name in names and columns["value"][i] is not None:
+            values[names[name]][slot] = columns["value"][i]
+    return values, labels, period_type
+
+
+def infer_period_type(labels):
+    """由期間標籤 ({基礎: [本期, 比較期]}) 判斷財報期間；依序參考累計期間、期末日與單季的本期標籤。"""
+    for basis in ("cumulative", "balance", "quarter"):
+        text = labels[basis][0] or ""
+        for period_type, pattern in PERIOD_TYPE_PATTERNS:
+            if re.search(pattern, text, re.IGNORECASE): return period_type
+    return None
+
+
+def _divide(numerators, denominators, scale=1.0):
+    """逐期相除；任一值缺少或分母為零時該期為 None。"""
+    return [n / d * scale if n is not None and d not in (None, 0) else None for n, d in zip(numerators, denominators)]
+
+
+def _reason(values, fields):
+    missing = [normalize_item(RATIO_INPUT_FIELDS[f][0]) for f in fields if any(v is None for v in values[f])]
+    return f"缺少{'、'.join(missing)}" if missing else "資料不足"
+
+
+def _basis_notes(bases, fields, expected):
+    """實際使用的期間基礎與規則不同時的說明。"""
+    used = {bases[f] for f in fields if f in bases}
+    if expected == "quarter" and "cumulative" in used:
+        return ["缺少單季數據，以累計期間數據計算"]
+    if None in used:
+        return [f"無法由欄位標題確認為{'單季' if expected == 'quarter' else '累計'}數據"]
+    return []
+
+
+def compute_ratios(values, closing_price=None, period_type=None, bases=None):
+    """
+    計算七項比率，回傳 [{"key", "name", "values": [本期, 比較期], "unit", "basis", "notes": [...]}]。
+    本益比只有本期一欄。bases 為 resolve_inputs 回傳的期間基礎 (未提供時視為符合 FIELD_BASIS)。
+    """
+    bases = bases or {}
+    ratios = []
+
+    def add(key, name, result, unit, fields, notes=()):
+        notes = list(notes)
+        if any(v is None for v in result):
+            notes.append(f"無法計算的期間：{_reason(values, fields)}")
+        ratios.append({"key": key, "name": name, "values": result, "unit": unit, "basis": RATIO_BASIS[key], "notes": notes})
+
+    # ROE：當期平均權益 = (期初 + 期末) / 2，期初為上年度期末餘額 (見 resolve_inputs)。
+    # 缺期初時，全年度財報的本期以比較期期末 (即上年度期末) 替代，其餘以期末權益替代 (依比率計算規則明確註明)
+    opening = values["equity_parent_opening"]
+    closing = values["equity_parent"]
+    roe_notes = _basis_notes(bases, ["net_income_parent"], "cumulative")
+    average_equity = [None, None]
+    for slot, label in enumerate(("本期", "比較期")):
+        if closing[slot] is None: continue
+        start = opening[slot]
+        if start is None and slot == 0 and period_type == "FY" and closing[1] is not None:
+            start = closing[1]
+            roe_notes.append("本期缺少期初權益，以比較期期末 (上年度期末) 權益替代")
+        elif start is None:
+            start = closing[slot]
+            roe_notes.append(f"{label}缺少期初權益，以期末權益替代平均權益 (近似處理)")
+        average_equity[slot] = (start + closing[slot]) / 2
+    add("ROE", "股東權益報酬率 (ROE)", _divide(values["net_income_parent"], average_equity, 100), "%",
+        ["net_income_parent", "equity_parent"], roe_notes)
+
+    eps = values["eps"][0]
+    pe_notes = []
+    pe = None
+    if closing_price is None:
+        pe_notes.append("未提供收盤價")
+    elif period_type is None:
+        pe_notes.append("無法判斷財報期間，無法年化每股盈餘")
+    elif eps is None:
+        pe_notes.append("缺少基本每股盈餘")
+    elif eps <= 0:
+        pe_notes.append("每股盈餘為負或零，本益比不具意義")
+    else:
+        annualized = eps * EPS_ANNUALIZATION[period_type]
+        pe = closing_price / annualized
+        pe_notes.append(f"收盤價 {closing_price:g} 元 / 年化每股盈餘 {annualized:.2f} 元 ({period_type}，本期累計 EPS)")
+        pe_notes += _basis_notes(bases, ["eps"], "cumulative")
+    ratios.append({"key": "PE", "name": "本益比 (P/E Ratio)", "values": [pe], "unit": "倍", "basis": RATIO_BASIS["PE"],
+                   "notes": pe_notes})
+
+    add("NPM", "淨利率 (Net Profit Margin)", _divide(values["net_income"], values["revenue"], 100), "%",
+        ["net_income", "revenue"], _basis_notes(bases, ["net_income", "revenue"], "quarter"))
+    add("GPM", "毛利率 (Gross Profit Margin)", _divide(values["gross_profit"], values["revenue"], 100), "%",
+        ["gross_profit", "revenue"], _basis_notes(bases, ["gross_profit", "revenue"], "quarter"))
+    add("DR", "負債比率 (Debt Ratio)", _divide(values["total_liabilities"], values["total_assets"], 100), "%",
+        ["total_liabilities", "total_assets"])
+    add("CR", "流動比率 (Current Ratio)", _divide(values["current_assets"], values["current_liabilities"], 100), "%",
+        ["current_assets", "current_liabilities"])
+
+    # 速動比率採保守定義：缺少預付款項的期間無法計算 (沒有此科目時提取結果為 0)
+    quick_assets = [a - i - p if None not in (a, i, p) else None
+                    for a, i, p in zip(values["current_assets"], values["inventory"], values["prepayments"])]
+    add("QR", "速動比率 (Quick Ratio)", _divide(quick_assets, values["current_liabilities"], 100), "%",
+        ["current_assets", "inventory", "prepayments", "current_liabilities"])
+    return ratios
+
+
+def format_ratio(value, unit):
+    return "無法計算" if value is None else f"{value:.2f}{unit}"
+
+
+def ratio_labels(labels, basis):
+    """比率表格的期間標籤：取該比率期間基礎的標籤，缺少時依序改用累計期間、期末日與單季的標籤。"""
+    pair = [None, None]
+    for candidate in (basis, "cumulative", "balance", "quarter"):
+        pair = [label or other for label, other in zip(pair, labels[candidate])]
+    return [pair[0] or "本期", pair[1] or "比較期"]
+
+
+def render_ratio_markdown(ratios, labels):
+    """
+    輸出與原本步驟 3 相同格式的七個 Markdown 表格 (本益比為 2 欄)，附註寫在表格下方。
+    labels 為 {基礎: [本期, 比較期]}，各表格使用其比率期間基礎的標籤 (見 ratio_labels)。
+    """
+    blocks = []
+    for ratio in ratios:
+        periods = ["本年度"] if ratio["key"] == "PE" else ratio_labels(labels, ratio["basis"])
+        cells = [format_ratio(v, ratio["unit"]) for v in ratio["values"]]
+        lines = [
+            "| " + " | ".join([ratio["name"]] + periods) + " |",
+            "| " + " | ".join([":---"] * (len(periods) + 1)) + " |",
+            "| " + " | ".join(["比率"] + cells) + " |",
+        ]
+        if ratio["notes"]:
+            lines += ["", "註：" + "；".join(ratio["notes"])]
+        blocks.append("\n".join(lines))
+    return "\n\n".join(blocks) + "\n"
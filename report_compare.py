@@ -0,0 +1,74 @@
+"""
+多份報告比較：把多份分析結果的欄式紀錄 (report_tables) 依章節、項目與期間對齊成一張表，
+並以向量化運算計算各報告相對於基準報告的差異。只使用已解析的結果，不呼叫模型。
+
+各公司的財報日期可能不同，期間以「本期 / 比較期」對齊：同一表格同一項目排除變動欄位後的前兩個期間。
+單位不同的項目 (例如仟元與元) 不會對齊在同一列。需要 pandas (Streamlit 已內含)。
+"""
+from ratio_engine import normalize_item
+from report_tables import RATIO_KEYWORDS, is_change_period, ratio_key, ratio_tables, results_tables
+
+PERIOD_SLOTS = ("本期", "比較期")
+INDEX_COLUMNS = ("source", "section", "item", "unit", "slot")
+RATIO_SECTION = "關鍵財務比率"
+# 比率以代碼對齊 (不同版本的比率表格名稱可能不同)，顯示時使用第一個關鍵字
+RATIO_LABELS = {key: keywords[0] for key, keywords in RATIO_KEYWORDS}
+
+
+def comparison_records(label, results):
+    """單份報告的可比較紀錄 (欄式 dict)：INDEX_COLUMNS 加上 period、value、report。"""
+    columns = results_tables(results)
+    records = {name: [] for name in INDEX_COLUMNS + ("period", "value", "report")}
+    slots = {}
+    for i, value in enumerate(columns["value"]):
+        period = columns["period"][i]
+        if value is None or is_change_period(period): continue
+        source = columns["source"][i]
+        if source == "ratio":
+            key = ratio_key(columns["item"][i])
+            section, item = RATIO_SECTION, RATIO_LABELS.get(key) or normalize_item(columns["item"][i])
+        else:
+            section, item = normalize_item(columns["section"][i]), normalize_item(columns["item"][i])
+        group = (source, columns["table"][i], section, item)
+        slot = slots.get(group, 0)
+        if slot >= len(PERIOD_SLOTS): continue
+        slots[group] = slot + 1
+        for name, cell in zip(records, (source, section, item, columns["unit"][i] or "", PERIOD_SLOTS[slot],
+                                         period, value, label)):
+            records[name].append(cell)
+    return records
+
+
+def comparison_frame(reports):
+    """
+    reports: [(名稱, analysis_results)]。回傳 DataFrame：索引為 INDEX_COLUMNS，每份報告一欄數值
+    (欄位順序同 reports；某報告沒有的項目為 NaN)。同一項目出現在多個表格時取第一個。
+    """
+    import pandas as pd
+
+    records = pd.concat([pd.DataFrame(comparison_records(label, results)) for label, results in reports],
+                        ignore_index=True)
+    labels = [label for label, _ in reports]
+    if records.empty:
+        return pd.DataFrame(columns=labels)
+    frame = records.pivot_table(index=list(INDEX_COLUMNS), columns="report", values="value",
+                                aggfunc="first", sort=False)
+    return frame.reindex(columns=labels)
+
+
+def comparison_deltas(frame, base):
+    """各報告相對於 base 欄的差額與差異百分比 (向量化；基準為 0 或缺值時百分比為 NaN)。"""
+    others = [column for column in frame.columns if column != base]
+    delta = frame[others].sub(frame[base], axis=0)
+    pct = delta.div(frame[base].abs().where(frame[base] != 0), axis=0) * 100
+    return delta, pct
+
+
+def period_labels(reports):
+    """每份報告本期 / 比較期的實際期間標籤 (取自第一個兩期比率表格)：{名稱: [本期, 比較期]}。"""
+    labels = {}
+    for label, results in reports:
+        tables = ratio_tables(results_tables(results))
+        periods = next((t["periods"] for t in tables.values() if len(t["periods"]) >= 2), [])
+        labels[label] = (periods + [None, None])[:2]
+    return labels
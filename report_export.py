@@ -0,0 +1,127 @@
+"""
+分析結果匯出：把已解析的表格紀錄 (report_tables 的欄式紀錄) 轉為結構化檔案，
+下游儀表板可直接大量讀取 (不必重新解析 Markdown)，分析師也可以用試算表 (Excel / Google 試算表) 開啟。
+
+格式 (EXPORT_FORMATS)：
+    parquet  單一扁平表：報告欄位 (REPORT_COLUMNS) + 表格紀錄欄位 (RECORD_COLUMNS)，欄位型別固定，
+             多份報告的檔案可直接串接或當作同一個資料集讀取 (需要 pyarrow；Streamlit 已內含)
+    json     報告資訊、總結與講解文字、比率表格與欄式表格紀錄
+    xlsx     「摘要」、「關鍵比率」、「標準化數據」三個工作表 (需要 openpyxl)
+缺少選用套件的格式不會出現在 available_formats()。
+"""
+import json
+import re
+from io import BytesIO
+
+from lazy_import import LazyModule
+from report_tables import RECORD_COLUMNS, ratio_tables, results_tables, select_records
+
+# 選用套件：只在實際匯出時才匯入
+pa = LazyModule("pyarrow")
+pq = LazyModule("pyarrow.parquet")
+openpyxl = LazyModule("openpyxl")
+
+REPORT_COLUMNS = ("report_id", "company_name", "model_name", "closing_price")
+
+EXPORT_FORMATS = {
+    "parquet": {"label": "Parquet", "extension": "parquet", "mime": "application/vnd.apache.parquet", "requires": pa},
+    "json": {"label": "JSON", "extension": "json", "mime": "application/json", "requires": None},
+    "xlsx": {"label": "Excel", "extension": "xlsx",
+             "mime": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "requires": openpyxl},
+}
+
+# 試算表的工作表：(工作表名稱, 紀錄來源)，欄位標題與 RECORD_COLUMNS 對應
+XLSX_SHEETS = (("關鍵比率", "ratio"), ("標準化數據", "standardization"))
+XLSX_COLUMNS = (("section", "章節"), ("item", "項目"), ("period", "期間"), ("value", "數值"), ("unit", "單位"), ("raw", "原始文字"))
+
+PARQUET_COMPRESSION = "zstd"
+
+
+def available_formats():
+    """目前環境可用的匯出格式 (依 EXPORT_FORMATS 的順序)。"""
+    return [fmt for fmt, spec in EXPORT_FORMATS.items() if spec["requires"] is None or spec["requires"].is_available()]
+
+
+def report_fields(results):
+    return {
+        "report_id": results.get("pdf_sha256", ""),
+        "company_name": results.get("company_name", ""),
+        "model_name": results.get("model_name", ""),
+        "closing_price": results.get("closing_price"),
+    }
+
+
+def export_records(reports):
+    """多份分析結果的扁平紀錄 (欄式 dict)：每筆表格紀錄前面加上所屬報告的欄位。"""
+    records = {name: [] for name in REPORT_COLUMNS + RECORD_COLUMNS}
+    for results in reports:
+        columns = results_tables(results)
+        count = len(columns["source"])
+        for name, value in report_fields(results).items():
+            records[name].extend([value] * count)
+        for name in RECORD_COLUMNS:
+            records[name].extend(columns[name])
+    return records
+
+
+def to_arrow_table(reports):
+    """export_records() 的 pyarrow.Table (欄位型別固定，沒有紀錄時仍保留欄位)。"""
+    schema = pa.schema([
+        (name, pa.float64() if name in ("closing_price", "value") else pa.int32() if name == "table" else pa.string())
+        for name in REPORT_COLUMNS + RECORD_COLUMNS
+    ])
+    return pa.Table.from_pydict(export_records(reports), schema=schema)
+
+
+def to_parquet(reports):
+    out = BytesIO()
+    pq.write_table(to_arrow_table(reports), out, compression=PARQUET_COMPRESSION)
+    return out.getvalue()
+
+
+def to_json(results):
+    columns = results_tables(results)
+    payload = dict(
+        report_fields(results),
+        summary=results.get("summary", ""),
+        explanation=results.get("explanation", ""),
+        ratios=ratio_tables(columns),
+        tables=columns,
+    )
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def to_xlsx(results):
+    """以 write_only 模式逐列寫入 (不在記憶體中保留整份試算表)。"""
+    workbook = openpyxl.Workbook(write_only=True)
+    summary = workbook.create_sheet("摘要")
+    fields = report_fields(results)
+    for label, name in (("公司名稱", "company_name"), ("模型", "model_name"), ("收盤價", "closing_price"), ("報告 ID", "report_id")):
+        summary.append([label, fields[name]])
+
+    columns = results_tables(results)
+    for title, source in XLSX_SHEETS:
+        sheet = workbook.create_sheet(title)
+        sheet.append([label for _, label in XLSX_COLUMNS])
+        records = select_records(columns, source=source)
+        for i in range(len(records["item"])):
+            sheet.append([records[name][i] for name, _ in XLSX_COLUMNS])
+
+    out = BytesIO()
+    workbook.save(out)
+    return out.getvalue()
+
+
+def export_bytes(results, fmt):
+    """單份分析結果的匯出內容 (bytes)；fmt 見 EXPORT_FORMATS。"""
+    if fmt == "parquet": return to_parquet([results])
+    if fmt == "json": return to_json(results)
+    if fmt == "xlsx": return to_xlsx(results)
+    raise ValueError(f"不支援的匯出格式: {fmt}")
+
+
+def export_filename(results, fmt):
+    """例如「台灣積體電路製造股份有限公司_gemini-3-flash-preview_1a2b3c4d.xlsx」。"""
+    company = re.sub(r'[\\/:*?"<>|\s]+', "_", results.get("company_name") or "財報分析").strip("_")
+    parts = [company, results.get("model_name") or "", (results.get("pdf_sha256") or "")[:8]]
+    return "_".join(part for part in parts if part) + "." + EXPORT_FORMATS[fmt]["extension"]
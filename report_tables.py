@@ -0,0 +1,202 @@
+"""
+模型輸出的 Markdown 表格解析：把比率與標準化結果轉為具型別的欄式 (columnar) 紀錄，
+之後的呈現、匯出、比較與檢索都直接使用解析結果，不必每次重新掃描字串。
+
+欄位 (每欄一個等長 list，可直接傳給 st.dataframe 或 pandas.DataFrame)：
+    source   "ratio" / "standardization"
+    table    表格在該來源中的序號 (從 0 開始)
+    section  所屬章節 ('## ' 標題；比率表格為比率名稱)
+    item     項目 (列標題；比率表格的「比率」列以比率名稱代替)
+    period   期間 (欄標題)
+    value    數值 (float；無法解析時為 None)
+    unit     單位 (仟元、%、倍、次、元…；無法判斷時為 None)
+    raw      原始儲存格文字
+"""
+import re
+
+RECORD_COLUMNS = ("source", "table", "section", "item", "period", "value", "unit", "raw")
+
+# 台灣財報慣例：未標示單位的金額為新台幣仟元
+STANDARDIZATION_DEFAULT_UNIT = "仟元"
+
+# 關鍵財務比率的辨識關鍵字 (依序比對，先符合者優先；例如「本益比」表格也可能提到淨利)
+RATIO_KEYWORDS = [
+    ("PE", ("本益比", "P/E")),
+    ("NPM", ("淨利率",)),
+    ("GPM", ("毛利率",)),
+    ("ROE", ("ROE", "股東權益報酬率")),
+    ("CR", ("流動比率",)),
+    ("DR", ("負債比率", "負債比")),
+    ("QR", ("速動比率", "速動比")),
+]
+
+# 非期間的欄位 (變動金額、變動比率等)
+_CHANGE_COLUMN = re.compile(r"變動|增減|差異|比率|%|說明|備註")
+
+_UNIT_ALIASES = {"千元": "仟元", "％": "%"}
+_UNITS = r"%|％|倍|次|仟元|千元|萬元|億元|元|天|日"
+_CELL_UNIT = re.compile(rf"^(.*?)\s*(?:新台幣|NT\$)?\s*({_UNITS})$")
+_HEADER_UNIT = re.compile(rf"[（(]\s*(?:單位\s*[:：]\s*)?(?:新台幣|NT\$)?\s*({_UNITS})\s*[)）]")
+_SECTION_UNIT = re.compile(rf"單位\s*[:：]\s*(?:新台幣|NT\$)?\s*({_UNITS})")
+_NUMBER = re.compile(r"^[-+−△▲]?\$?\d{1,3}(?:,\d{3})*(?:\.\d+)?$|^[-+−△▲]?\$?\d+(?:\.\d+)?$")
+_SEPARATOR_CELL = re.compile(r"^:?-{3,}:?$")
+
+
+def normalize_unit(unit):
+    return _UNIT_ALIASES.get(unit, unit) if unit else None
+
+
+def parse_value(cell):
+    """
+    解析單一儲存格：回傳 (數值, 單位)。支援千分位、括號或負號表示的負數與 %、倍、仟元等單位後綴；
+    日期 (113/12/31)、文字與「無法計算」等回傳 (None, None)。
+    """
+    text = cell.replace("*", "").replace(" ", "").strip()
+    if not text: return None, None
+    unit = None
+    match = _CELL_UNIT.match(text)
+    if match and match.group(1):
+        text, unit = match.group(1), normalize_unit(match.group(2))
+    negative = text.startswith("(") and text.endswith(")") or text.startswith("（") and text.endswith("）")
+    if negative: text = text[1:-1]
+    if not _NUMBER.match(text): return None, None
+    if text[0] in "-−△": negative = not negative
+    value = float(text.lstrip("-+−△▲$").replace(",", ""))
+    return (-value if negative else value), unit
+
+
+def header_unit(text):
+    """標題中的單位說明，例如「金額 (仟元)」、「比率(%)」。"""
+    match = _HEADER_UNIT.search(text)
+    return normalize_unit(match.group(1)) if match else None
+
+
+def is_change_period(period):
+    """欄標題是否為變動金額、變動比率或說明等非期間欄位。"""
+    return bool(_CHANGE_COLUMN.search(period or ""))
+
+
+def split_row(line):
+    cells = line.strip().strip("|").split("|")
+    return [c.strip() for c in cells]
+
+
+def ratio_key(name):
+    """比率名稱對應的代碼 (PE / NPM / GPM / ROE / CR / DR / QR)，無法辨識時回傳 None。"""
+    for key, keywords in RATIO_KEYWORDS:
+        if any(k in name for k in keywords): return key
+    return None
+
+
+def parse_report_tables(markdown_text, source, default_unit=None):
+    """
+    一次掃描 Markdown，回傳欄式紀錄 dict (欄位見 RECORD_COLUMNS)。
+    單位依序取自：儲存格後綴 > 欄標題 > 列標題 > 章節中的「單位：」說明 > default_unit (僅限數值)。
+    """
+    columns = {name: [] for name in RECORD_COLUMNS}
+    section, section_unit = None, None
+    header, header_units, table_index = None, None, -1
+    pending_header = None
+    row_start, last_cells = 0, None
+
+    for line in (markdown_text or "").splitlines():
+        stripped = line.strip()
+        if not stripped.startswith("|"):
+            header = pending_header = None
+            if stripped.startswith("#"):
+                section, section_unit = stripped.lstrip("#").strip(), None
+            unit_match = _SECTION_UNIT.search(stripped)
+            if unit_match: section_unit = normalize_unit(unit_match.group(1))
+            continue
+
+        cells = split_row(stripped)
+        filled = [c for c in cells if c]
+        is_separator = bool(filled) and all(_SEPARATOR_CELL.match(c) for c in filled)
+        if header is not None and is_separator:
+            # 兩個表格之間沒有空行：上一列其實是新表格的標題列，撤回已加入的紀錄
+            for name in RECORD_COLUMNS:
+                del columns[name][row_start:]
+            header, pending_header = None, last_cells
+        if header is None:
+            # 表格第一列為標題列，第二列必須是分隔列 (| :--- |)
+            if pending_header is not None and is_separator:
+                header, pending_header = pending_header, None
+                header_units = [header_unit(h) for h in header]
+                table_index += 1
+            else:
+                pending_header = cells
+            continue
+
+        row_start, last_cells = len(columns["source"]), cells
+        row_name = cells[0] if cells else ""
+        item = header[0] if row_name == "比率" else row_name
+        item_unit = header_unit(row_name)
+        for j in range(1, min(len(cells), len(header))):
+            raw = cells[j]
+            value, unit = parse_value(raw)
+            if value is not None and unit is None:
+                unit = header_units[j] or item_unit or section_unit or default_unit
+            columns["source"].append(source)
+            columns["table"].append(table_index)
+            columns["section"].append(header[0] if source == "ratio" else (section or header[0]))
+            columns["item"].append(item)
+            columns["period"].append(header[j])
+            columns["value"].append(value)
+            columns["unit"].append(unit)
+            columns["raw"].append(raw)
+    return columns
+
+
+def parse_results_tables(results):
+    """解析 analysis_results 的比率與標準化輸出，回傳合併後的欄式紀錄。"""
+    ratio = parse_report_tables(results.get("ratio", ""), "ratio")
+    standardization = parse_report_tables(results.get("standardization", ""), "standardization",
+                                          default_unit=STANDARDIZATION_DEFAULT_UNIT)
+    return {name: ratio[name] + standardization[name] for name in RECORD_COLUMNS}
+
+
+def results_tables(results):
+    """取得 analysis_results 的欄式紀錄；舊版結果 (尚未解析) 會在此補上並存回。"""
+    if results.get("tables") is None:
+        results["tables"] = parse_results_tables(results)
+    return results["tables"]
+
+
+def select_records(columns, **filters):
+    """篩選欄式紀錄 (例如 source="ratio")，回傳同樣格式的 dict。"""
+    count = len(columns.get("source", []))
+    keep = [i for i in range(count) if all(columns[k][i] == v for k, v in filters.items())]
+    return {name: [columns[name][i] for i in keep] for name in RECORD_COLUMNS}
+
+
+def ratio_tables(columns):
+    """
+    依比率代碼整理比率表格：{代碼: {"name": 比率名稱, "periods": [期間], "values": [原始文字]}}。
+    同一代碼出現多次時保留第一個表格。
+    """
+    tables = {}
+    ratio = select_records(columns, source="ratio")
+    for i, table in enumerate(ratio["table"]):
+        name = ratio["item"][i]
+        key = ratio_key(name)
+        if key is None: continue
+        entry = tables.setdefault(key, {"table": table, "name": name, "periods": [], "values": []})
+        if entry["table"] != table: continue
+        entry["periods"].append(ratio["period"][i])
+        entry["values"].append(ratio["raw"][i])
+    return tables
+
+
+def ratio_table_markdown(table):
+    """把 ratio_tables() 的單一項目組回 Markdown 表格 (報告頁的比率卡片)。"""
+    header = "| " + " | ".join([table["name"]] + table["periods"]) + " |"
+    separator = "| " + " | ".join([":---"] * (len(table["periods"]) + 1)) + " |"
+    row = "| " + " | ".join(["比率"] + table["values"]) + " |"
+    return "\n".join([header, separator, row])
+
+
+def to_dataframe(columns):
+    """轉為 pandas.DataFrame (需要 pandas；Streamlit 已內含)。"""
+    import pandas as pd
+
+    return pd.DataFrame(columns, columns=list(RECORD_COLUMNS))
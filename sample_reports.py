@@ -0,0 +1,167 @@
+"""
+內建範例財報的預先計算結果：快速分析按鈕直接載入，不必每次點擊都執行完整分析流程。
+
+建置 (需要 GEMINI_API_KEY；每份範例 × 每個模型輸出一個 JSON)：
+    python sample_reports.py
+    python sample_reports.py --model gemini-3-pro-preview --model gemini-3-flash-preview --closing-price 2330=1045
+
+輸出為 samples/<檔名>.<模型>.<提示詞版本>.json。提示詞版本取自 analysis_pipeline.prompt_version()，
+提示詞或步驟設定改變後舊版本自動失效 (載入時找不到對應檔案即改為即時分析)，重新建置時會移除舊版本。
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import uuid
+
+from analysis_pipeline import (
+    DEFAULT_MODEL,
+    RESULT_CACHE_DIR,
+    RESULT_CACHE_MAX_BYTES,
+    AnalysisResultCache,
+    PdfFileRegistry,
+    analyze_pdf,
+    prompt_version,
+)
+from batch_analyze import REQUIRED_RESULT_KEYS, parse_closing_prices, write_atomic
+from lazy_import import LazyModule
+
+# Streamlit 首頁只讀取預先計算的結果；SDK 只在建置範例時才匯入
+genai = LazyModule("google.genai")
+types = LazyModule("google.genai.types")
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SAMPLE_ARTIFACT_DIR = os.getenv('SAMPLE_ARTIFACT_DIR', os.path.join(BASE_DIR, 'samples'))
+
+# 首頁快速分析按鈕對應的範例財報 (檔案位於專案根目錄)
+SAMPLE_REPORTS = [
+    {"stem": "2330", "label": "📊 2330 (台積電)", "file": "2330.pdf"},
+    {"stem": "2382", "label": "📈 2382 (廣達)", "file": "2382.pdf"},
+    {"stem": "2308", "label": "📉 2308 (台達電)", "file": "2308.pdf"},
+    {"stem": "2454", "label": "💻 2454 (聯發科)", "file": "2454.pdf"},
+]
+
+
+def sample_path(sample):
+    return os.path.join(BASE_DIR, sample["file"])
+
+
+def missing_samples():
+    """找不到 PDF 檔案的範例 (啟動時檢查，對應按鈕停用)。"""
+    return [sample for sample in SAMPLE_REPORTS if not os.path.exists(sample_path(sample))]
+
+
+def artifact_path(stem, model_name, version=None):
+    return os.path.join(SAMPLE_ARTIFACT_DIR, f"{stem}.{model_name}.{version or prompt_version()}.json")
+
+
+_artifact_cache = {}  # 路徑 -> (修改時間, 結果)：首頁每次 rerun 都會查詢，檔案未變動時不重新解析
+
+
+def read_artifact(stem, model_name):
+    """
+    讀取目前提示詞版本的預先計算結果；不存在或不完整時回傳 None。
+    結果依檔案修改時間快取並由所有 session 共用 (呼叫端不可修改)。
+    """
+    path = artifact_path(stem, model_name)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    cached = _artifact_cache.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    try:
+        with open(path, encoding="utf-8") as f:
+            results = json.load(f)
+    except (OSError, ValueError):
+        return None
+    results = results if all(results.get(k) for k in REQUIRED_RESULT_KEYS) else None
+    _artifact_cache[path] = (mtime, results)
+    return results
+
+
+def load_sample_results(stem, model_name, closing_price=None):
+    """快速分析用的預先計算結果；收盤價不同 (本益比需重新計算) 時回傳 None。"""
+    results = read_artifact(stem, model_name)
+    if results is None or results.get("closing_price") != closing_price: return None
+    return results
+
+
+def precomputed_samples(model_name):
+    """所有已建置的範例結果 (不限收盤價；供多份報告比較)：[(範例, 結果)]。"""
+    found = [(sample, read_artifact(sample["stem"], model_name)) for sample in SAMPLE_REPORTS]
+    return [(sample, results) for sample, results in found if results is not None]
+
+
+def build_samples(client, model_names, closing_prices=None, force=False):
+    """為每份範例 × 每個模型產生目前版本的結果，並移除同一範例與模型的舊版本。回傳失敗數。"""
+    os.makedirs(SAMPLE_ARTIFACT_DIR, exist_ok=True)
+    closing_prices = closing_prices or {}
+    cache = AnalysisResultCache(RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES)
+    registry = PdfFileRegistry()
+    version = prompt_version()
+    failures = 0
+    for sample in SAMPLE_REPORTS:
+        if not os.path.exists(sample_path(sample)):
+            print(f"⚠️  找不到範例檔案，略過: {sample['file']}", flush=True)
+            continue
+        for model_name in model_names:
+            path = artifact_path(sample["stem"], model_name, version)
+            closing_price = closing_prices.get(sample["stem"])
+            if not force and load_sample_results(sample["stem"], model_name, closing_price) is not None:
+                print(f"⏭️  跳過 (已是最新版本): {sample['file']} [{model_name}]", flush=True)
+                continue
+            with open(sample_path(sample), "rb") as f:
+                pdf_bytes = f.read()
+            holder = f"samples-{uuid.uuid4().hex}"
+
+            def get_pdf_part(data, document=None):
+                try:
+                    return registry.get_part(client, data, holder, document)
+                except Exception:
+                    return types.Part.from_bytes(data=data, mime_type="application/pdf")
+
+            try:
+                # 範例結果可作為增量更新的基準，需記錄附註章節雜湊
+                results = analyze_pdf(client, pdf_bytes, model_name=model_name, cache=cache,
+                                      get_pdf_part=get_pdf_part, closing_price=closing_price, record_sections=True)
+            except Exception as e:
+                failures += 1
+                print(f"❌ 失敗: {sample['file']} [{model_name}]: {e}", flush=True)
+                continue
+            finally:
+                registry.release(client, holder)
+
+            results["source_file"] = sample["file"]
+            results["prompt_version"] = version
+            write_atomic(path, json.dumps(results, ensure_ascii=False, indent=2))
+            for old in glob.glob(os.path.join(SAMPLE_ARTIFACT_DIR, f"{sample['stem']}.{model_name}.*.json")):
+                if old != path: os.remove(old)
+            print(f"✅ 完成: {sample['file']} [{model_name}] → {os.path.basename(path)}", flush=True)
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="預先計算內建範例財報的分析結果")
+    parser.add_argument("--model", action="append", dest="models", help=f"使用的模型，可重複指定 (預設: {DEFAULT_MODEL})")
+    parser.add_argument("--closing-price", action="append", help="計算本益比用的收盤價，格式 檔名=價格 (例如 2330=1045)")
+    parser.add_argument("--force", action="store_true", help="忽略已有的結果，全部重新執行")
+    args = parser.parse_args(argv)
+
+    api_key = os.getenv("GEMINI_API_KEY")
+    if not api_key:
+        parser.error("GEMINI_API_KEY 未設定")
+    try:
+        closing_prices = parse_closing_prices(args.closing_price)
+    except ValueError as e:
+        parser.error(str(e))
+
+    failures = build_samples(genai.Client(api_key=api_key), args.models or [DEFAULT_MODEL], closing_prices, force=args.force)
+    print(f"📦 提示詞版本 {prompt_version()}，輸出目錄: {SAMPLE_ARTIFACT_DIR}", flush=True)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,18 +1,47 @@
 import streamlit as st
 import streamlit.components.v1 as components
 import os
-import textwrap
 import time 
-from io import BytesIO
-import re 
+import uuid
+
+# 分析核心流程 (提示詞、API 呼叫、步驟依賴圖、快取；可在無 Streamlit 環境下匯入)
+from analysis_pipeline import (
+    DEFAULT_MODEL,
+    MODEL_FALLBACK,
+    MODEL_ROUTING,
+    ROUTING_GROUPS,
+    ROUTING_POLICIES,
+    RESULT_CACHE_DIR,
+    RESULT_CACHE_MAX_BYTES,
+    DOCUMENT_STORE_DIR,
+    AnalysisJob,
+    AnalysisJobQueue,
+    AnalysisResultCache,
+    DocumentStore,
+    PdfFileRegistry,
+    ChatContextRegistry,
+    SectionIndex,
+    chat_context_key,
+    create_chat_context,
+    get_call_logger,
+    get_prompt_registry,
+    get_scheduler,
+    routing_policy,
+    stream_chat_message as pipeline_stream_chat_message,
+    summarize_call_log,
+    summarize_routing,
+    text_digest,
+)
+from report_tables import ratio_table_markdown, ratio_tables, results_tables, select_records
+from report_export import EXPORT_FORMATS, available_formats, export_bytes, export_filename
+from report_compare import PERIOD_SLOTS, comparison_deltas, comparison_frame, period_labels
+from sample_reports import SAMPLE_REPORTS, load_sample_results, missing_samples, precomputed_samples, sample_path
+from ui_assets import DEFAULT_THEME, THEMES, page_chrome
+from lazy_import import LazyModule
 
-# =============================================================================
-# Google Generative AI 導入
-# =============================================================================
-import google.genai as genai
-from google.genai import types
-from google.genai import errors
-from google.genai.errors import APIError 
+# Google Generative AI：SDK 匯入約需 0.6 秒，延遲到第一次建立 CLIENT 或請求內容時 (首頁冷啟動不需要)
+genai = LazyModule("google.genai")
+types = LazyModule("google.genai.types")
 
 # =============================================================================
 # 0. 全域設定 & 模型定義
@@ -24,206 +53,10 @@ MODEL_OPTIONS = {
     "入門版 (Gemini 3 Flash)": "gemini-3-flash-preview"
 }
 
-# 預設模型 (已修改為入門版 Flash)
-DEFAULT_MODEL = "gemini-3-flash-preview"
-
 # =============================================================================
-# 1. 核心規則與 API Key 設置 (嚴禁更動)
+# 1. API Key 設置 (核心規則提示詞見 analysis_pipeline.py)
 # =============================================================================
 
-# 步驟 1：抓取公司名稱
-PROMPT_COMPANY_NAME = textwrap.dedent("""
-請從這份 PDF 財務報告的第一頁或封面頁中，提取出完整的、官方的公司法定全名 (例如 "台灣積體電路製造股份有限公司")。
-
-限制：
-1. 僅輸出公司名稱的純文字字串。
-2. 禁止包含任何 Markdown、引號、標籤或任何 "公司名稱：" 之類的前綴。
-3. 禁止包含任何其他文字或問候語。
-""")
-
-# 步驟 2：標準化提取
-PROMPT_BIAO_ZHUN_HUA_CONTENT = textwrap.dedent("""
-**請以以下標準來對財報四大表後有項目標號的數十項內容提取資料，並將以下 37 個大項各自生成獨立的 Markdown 表格** (溫度為0)
-**限制0：禁止包含任何前言、開場白、問候語或免責聲明 (例如 "好的，這..."). 您的回答必須直接開始於所要求的第一個 Markdown 表格 (例如 '## 公司沿革')。**
-限制1：如果標準化之規則財報中無該分類，跳過該分類
-**限制2：輸出時嚴禁包含編號 (例如 '一、' 或 '1.')。請直接以 Markdown 標題 (例如 '## 公司沿革') 開始，絕對不要輸出 37 項規則的編號。**
-限制3：與變動金額有關的內容，橫軸為時間線與變動比率，縱軸為項目，如果橫軸
-限制4：只能使用我們提供的檔案，不能使用外部資訊
-限制5：計算時在內部進行雙重核對，確保兩組計算，只使用提供資料且結果完全一致後，才可以輸出內容
-限制6：如果有資料缺漏導致無法計算，缺漏的部分不做計算
-**限制7.：每一個大項 (例如 '公司沿革', '現金及約當現金') 都必須是一個獨立的 Markdown 表格。如果一個大項下有多個要求事項 (例如 '應收票據及帳款淨額' 下有 '應收帳款淨額三期變動' 和 '帳齡分析表三期變動')，請在同一個表格中用多行來呈現，或生成多個表格。**
-限制8：禁止提供任何外部資訊
-一、公司沿革,公司名稱,成立日期[yyy/mm/dd],從事業務
-二、通過財務報告之日期及程序,核准日期[yyy/mm/dd]
-三、新發布及修訂準則及解釋之適用,新發布及修訂準則及解釋之適用對本公司之影響
-四、重大會計政策之彙總說明,會計政策對公司之影響
-五、重大會計判斷、估計及假設不確定性之主要來源,重大會計判斷、估計及假設不確定性之主要來源之變動
-六、現金及約當現金,現金及約當現金合計之變動
-七、透過損益按公允價值衡量之金融資產及金融負債,金融資產與金融負債之三期變動
-八、透過其他綜合損益按公允價值衡量之金融資產,透過其他綜合損益按公允價值衡量之金融資產之三期變動
-九、按攤銷後成本衡量之金融資產,金融資產合計之三期變動
-十、避險之金融工具,公允價值避險之方式及當期影響,現金流量避險之方式及當期影響,國外營運機構淨投資避險
-十一、應收票據及帳款淨額,應收帳款淨額三期變動,帳齡分析表三期變動,
-十二、存貨,製成品之三期變動金額,在製品之三期變動金額,原料之兩期變動金額,如有其餘獨立項目歸類進前三大項,
-十三、採用權益法之投資,子公司與關聯企業之名單及其控股百分比三期變動
-十四、不動產、廠房及設備,拆分自用與營業租賃後進行三期比較
-十五、租賃協議,三期變動
-十六、無形資產,三期變動
-十七、應付公司債,公司債項目性質,本期日期(YYY/MM/DD),上期日期(YYY/MM/DD),去年同期(YYY/MM/DD),
-十八、長期銀行借款,長期銀行借款,本期日期(YYY/MM/DD),上期日期(YYY/MM/DD),去年同期(YYY/MM/DD),
-十九、權益,已發行股本本期日期(YYY/MM/DD),上期日期(YYY/MM/DD),去年同期(YYY/MM/DD),本期日期(YYY/MM/DD),股本變動,盈餘分配,
-二十、營業收入,客戶合約之收入(應用領域別之兩期變動，如無應用領域別則讀取營業收入總額),合約負債三期變動,暫收款三期變動
-二一、利息收入,利息收入總額之兩期變動
-二二、財務成本,利息費用總額兩期變動
-二三、其他利益及損失淨額,其他利益及損失淨額兩期比較
-二四、所得稅,認列於損益之所得稅費用兩期變動
-二五、每股盈餘,基本每股盈餘兩期變動,稀釋每股盈餘兩期變動,
-二六、股份基礎給付協議,股份基礎給付計畫金額
-二七、費用性質之額外資訊,兩期比較
-二八、政府補助,兩期比較
-二九、現金流量資訊,營業活動之淨現金流入之兩期變動,投資活動之淨現金流出之兩期變動,本期現金及約當現金淨增加數之兩期變動
-三十、金融工具,金融資產三期變動,金融負債三期變動,非衍生金融負債三期變動,非衍生金融資產三期變動,衍生金融工具之三期變動,租賃負債之三期變動,透過損益按公允價值衡量之金融資產之三期變動,透過其他綜合損益按公允價值衡量之金融資產之三期變動,避險之金融資產之三期變動,文字部分之總結,
-三一、關係人交易,營業收入兩期變動,進貨三期變動,應收關係人款項三期變動,應付關係人款項三期變動,應付費用及其他流動負債三期變動,其他關係人交易三期變動,
-三二、質押之資產,質押之資產金額三期變動
-三三、重大或有負債及未認列之合約承諾,背書保證金額,或有負債總結,
-三四、重大之災害損失,發生原因,日期[yyy/mm],金額[仟元]
-三五、外幣金融資產及負債之匯率資訊,金融資產三期變動,金融負債三期變動,
-三六、附註揭露事項,請對我提供給你的資料中的附註揭露事項及其提及的附表進行分析
-三七、營運部門資訊,擁有哪些營運部門
-""")
-
-# 步驟 3：比率計算 (P/E 修正版)
-PROMPT_RATIO_CONTENT = textwrap.dedent("""
-請根據以下計算公式及限制，計算股東權益報酬率 (ROE)、本益比 (P/E Ratio)、淨利率 (Net Profit Margin)、毛利率 (Gross Profit Margin)、負債比率 (Debt Ratio)、流動比率 (Current Ratio)、速動比率 (Quick Ratio) 之兩期數據。
-
-**注意：您必須輸出七個獨立的 Markdown 表格。**
-
-**除了本益比以外每個表格必須遵循以下嚴格的 3x2 格式要求 (3 欄 x 2 行)，本益比則只需 2x2 格式要求 (2 欄 x 2 行，無須比較期日期或期間的欄位第二欄名稱為本年度)：**
-
-| 財務比率名稱 (例如: 股東權益報酬率(ROE)) | [最近一期日期或期間] | [比較期日期或期間] |
-| :--- | :--- | :--- |
-| 比率 | [計算結果及單位，例如: 15.25%] | [計算結果及單位，例如: 12.80%] |
-
-**請嚴格遵守：**
-1. 輸出結果**必須是 7 個獨立的 Markdown 表格**，且只包含您計算出的數據和單位。
-2. 表格內容**只能是數字和單位** (例如 %、倍、次)。
-3. 表格的第一格**必須是比率名稱**，第二行第一格**必須是「比率」**這兩個字。
-**4. 禁止包含任何前言、開場白或問候語。您的回答必須直接從第一個 Markdown 表格 (股東權益報酬率) 開始。**
-
-計算公式：
-財務比率 (Financial Ratio),計算公式 (Formula),備註 (Notes)
-1. 股東權益報酬率 (ROE),(歸屬於母公司業主之本期淨利) / (歸屬於母公司業主之平均權益),當期（例如半年）數據計算。,其中，平均權益 = (期初歸屬於母公司業主之權益 + 期末歸屬於母公司業主之權益) / 2,
-2. 本益比 (P/E Ratio) (以當日收盤價格為基準), **(收盤價) / (年化每股盈餘)**。
-   **年化每股盈餘 (Annualized EPS) 計算規則 (必須嚴格遵守)：**
-   - 步驟 A: 判斷財報期間。
-   - 步驟 B: 根據期間調整 EPS：
-     - 若為第一季 (Q1, 1-3月): 年化 EPS = 本期 EPS x 4
-     - 若為上半年 (H1, 1-6月): 年化 EPS = 本期累計 EPS x 2
-     - 若為前三季 (Q3, 1-9月): 年化 EPS = (本期累計 EPS / 3) x 4
-     - 若為全年度 (Annual, 1-12月): 年化 EPS = 本期累計 EPS x 1
-   - 步驟 C: 使用指定的收盤價除以算出的年化 EPS。
-   *注意：使用基本每股盈餘。指定收盤價請使用 Google Search 搜尋使用本分析系統當日或前一日的收盤價格。*
-3. 淨利率 (Net Profit Margin),(本期淨利) / (營業收入),單季數據計算。
-4. 毛利率 (Gross Profit Margin),(營業毛利) / (營業收入),單季數據計算。
-5. 負債比率 (Debt Ratio),(負債總計) / (資產總計),期末時點數據計算。
-6. 流動比率 (Current Ratio),(流動資產合計) / (流動負債合計),期末時點數據計算。
-7. 速動比率 (Quick Ratio),(流動資產合計 - 存貨 - 預付款項) / (流動負債合計),期末時點數據計算，採保守定義。
-限制：
-唯一數據來源：除了公司的收盤價外所有的計算僅能使用您所提供的PDF財務報告檔案，除收盤價需上網絡查詢外，不得引用任何外部資訊。
-計算時間基準：毛利率、淨利率、本益比皆以「單季」數據進行計算；需要平均餘額的比率（ROE）以「當期」期間為基礎。
-平均餘額計算：分母的平均餘額必須採用該「當期」期間的期初餘額與期末餘額之平均。
-數據替換原則：若缺乏當期「期初」數據，則採用可取得的最近一期餘額來替代期初數據，並在報告中明確註明此近似處理。
-不進行年化處理：所有的比率計算結果直接呈現該期間的數據，不轉換為年化率，除非計算式有特別要求進行年化 (如 P/E)。
-內部驗證機制：在生成最終報告前，會進行內部雙重計算與核對。
-處理資料缺漏：若因缺乏必要的數據而無法計算，將明確標示為**「無法計算」**並註明原因。
-""")
-
-# 步驟 4：總結
-PROMPT_ZONG_JIE_CONTENT = textwrap.dedent("""
-核心規則與限制
-限制部分：
-**格式限制：禁止包含任何前言、開場白、問候語或免責聲明 (例如 "好的，這是一份..."）。您的回答必須直接開始於總結的第一句話。**
-資料來源限制：僅能使用標準化後的內容表格及財報附註中已提取的文字資訊進行分析,排除對合併資產負債表、合併綜合損益表、合併權益變動表及合併現金流量表四大表本身數據的直接讀取與分析。
-數據提取限制：所有分析所需的原始數據與金額，必須從標準化表格中已計算或已提取的結果取得,確保分析的立論點是基於前一步驟的數據整理成果。
-分析深度限制：分析內容僅限於揭露與觀察事實與數據變動，禁止提供任何形式的投資或經營建議或評價,恪守中立客觀的立場，僅對資訊進行解讀與歸納。
-**內部驗證限制：在輸出總結前，必須進行內部雙重核對，確保所有分析論點均來自標準化表格或附註原文，且完全遵守所有分析規則與限制。**
-分析規則部分：
-會計基礎分析：關注「公司沿革」、「會計政策」及「重大會計判斷」等項目,用於建立對公司營運範圍、會計處理連續性及潛在風險（如暫定公允價值）的初步認識。
-經營細項分析：側重「營業收入結構細分」、「費用性質」、「營業外損益細項」的兩期變動,深入了解營收暴增的驅動力（例如新業務：佣金、廣告）與成本費用的結構性變化（例如折舊、攤銷的增加）。
-財務結構細項分析：關注「金融工具」、「質押之資產」、「租賃負債」等項目的三期變動,衡量公司在風險暴露（匯率、利率）、資產擔保情況以及長期承諾（租賃、未計價合約）的變化趨勢。
-關係人交易分析：著重於「營業收入」、「應收帳款」、「資金貸與」及「承包工程合約」等項目的類型與金額集中度,識別關係人交易在公司營運中的比重和性質，特別是資金流向與合約承諾。
-流動性與承諾分析：關注「流動性風險到期日」分析和「重大或有負債/合約承諾」的總額與結構,判斷公司短期現金壓力、合同義務以及潛在的表外風險。
-期後事項分析：僅羅列已發生的重大期後交易。,作為公司未來發展方向和策略變動的客觀資訊補充。
-計算規則部分
-變動數據呈現：對於金額變動，必須呈現變動金額及變動比率,突顯數據的相對變化幅度，作為分析論點的支撐。
-比率計算依據,變動比率計算方式為：,(本期金額−比較期金額)/比較期金額,統一所有分析中的比率計算方法。
-N/A 處理：若比較期金額為零，則變動比率標示為 N/A 或以文字描述為「無法計算」。,避免除以零的錯誤，並準確描述從無到有的巨大變化。
-幣別一致性：所有金額單位必須保持一致（新台幣千元），並在分析開始前註明。,確保數據的可讀性與準準確性。
-""")
-
-# 步驟 5：講解
-PROMPT_JIAN_JIE_CONTENT = textwrap.dedent("""
-**格式限制：禁止包含任何前言、開場白、問候語或免責聲明。您的回答必須直接開始於講解的第一句話。**
-
-一、 核心目標與受眾設定 (Analysis Goal and Audience)
-
-目標: 對單一公司已標準化的財務數據（四大表附註）進行深度分析。
-受眾: 專為「非專業人士」設計，假設讀者可能不具備基礎會計知識，無法理解融資、邊際貢獻等概念。易讀性（Readability）優先，確保報告內容可以轉化為白話文進行溝通。
-風格: 採用「翻譯」和「白話解釋」的語氣，將專業名詞逐一轉化為生活化語言。
-
-二、 數據來源與引用限制 (Data Integrity and Citation)
-
-數據來源: 嚴格依賴已提供的標準化後數據和原始財務報告內容。禁止使用或臆測外部資訊（例如產業新聞、股價、未來預測等）。
-資料時間軸: 核心數據對比必須聚焦於「 (本期)」與「(去年同期)」的兩期比較，以呈現經營成果的變化。資產負債表項目則需呈現三期數據對比分別是（(本期)」與「(去年同期)與「(去年底)）。
-單位統一: 所有金額必須統一標註為新台幣仟元，除非原始數據或特殊情況另有說明。
-限制輸出: 分析結果中禁止包含任何主觀建議、投資判斷或價值評估，僅陳述數據事實、計算出的比率及趨勢。
-**內部驗證要求：在輸出講解前，必須進行內部雙重核對，確保所有「白話轉譯」均準確對應「名詞解釋標準 (Glossary)」，且所有引用的數據事實均與標準化表格一致。**
-
-三、 報告結構與內容要求 (Structure and Content Mandates)
-
-分析報告必須涵蓋以下五個主要區塊，並針對每個數據點提供詳細的解釋：
-
-1. 公司基礎資訊 (Basic Information)
-分析點：公司沿革、財務報告核准日、會計準則適用、重大會計估計穩定性。
-要求：需將會計政策的穩定性（如 IFRS 適用）解讀為「記帳規則穩定」或「報表可靠」。
-
-2. 資產負債表項目分析 (Statement of Financial Position)
-分析點：現金、存貨、PPE、應付公司債、負債總額等。
-要求：必須解釋 PPE 的增長趨G勢為「資本支出（CapEx）」，並將其轉譯為「砸錢買新設備和蓋廠」。
-要求：必須將存貨中的「在製品」解讀為「產線忙碌」。
-
-3. 綜合損益表項目分析 (Statement of Comprehensive Income)
-分析點：營業收入、毛利、淨利、每股盈餘（EPS）、所得稅費用。
-要求：強調「營業淨利」的增長率是否高於「營業收入」的增長率，並解釋這代表公司「管錢效率提高」。
-要求：需將 EPS 解釋為「平均每一股賺了多少錢」。
-
-4. 現金流量表項目分析 (Statement of Cash Flows)
-分析點：營業活動現金流 (CFO)、投資活動現金流 (CFI)、籌資活動現金流 (CFF)。
-要求：CFO 必須被稱為「賣晶片收到的現金總額」，並強調其為「核心業務收錢能力」。
-要求：必須對比 CFO 和 CFI 的大小關係，並解釋若 CFO > CFI，則公司能「靠自己賺來的錢來支付所有蓋廠和投資的費用」。
-
-5. 特別關注項目 (Special Focus Items)
-分析點：政府補助、應收帳款淨額、外幣資產、重大災害損失等。
-要求：將政府補助解釋為「海外子公司獲得的當地政府獎勵或補貼」。
-要求：將應收帳款的未逾期比例解讀為客戶的「信用質量」。
-
-四、 名詞解釋標準 (Glossary Simplification Standard)
-
-報告中使用的所有專業術術語必須在第一次出現時或在專門的註釋區塊中，按照以下「淺顯易懂」的標準進行轉譯：
-
-專業術語 (Jargon) / 轉譯標準 (Simplified Translation)
-資本支出 (CapEx) / 砸錢買新設備和蓋廠、買長期家當
-流動性 (Liquidity) / 救命錢或隨時能動用的錢
-在製品 (Work in Process) / 正在生產中的晶片、產線非常忙碌
-籌資活動 / 向股東或銀行「付錢」的活動
-淨利 / 獲利能力 / 最終賺到的利潤、賺錢能力
-應付公司債 / 長期大筆借款
-營業淨利 / 扣掉所有費用後，純粹靠本業賺到的錢
-EPS / 平均每一股股票賺了多少錢
-CFO / 公司靠「賣晶片」和「日常營運」收到的現金總額
-""")
-
-
 # API Key 設置
 try:
     API_KEY = os.getenv('GEMINI_API_KEY')
@@ -237,18 +70,27 @@ if 'current_page' not in st.session_state:
     st.session_state['current_page'] = 'Home'
 if 'analysis_results' not in st.session_state:
     st.session_state['analysis_results'] = None
-if 'current_pdf_bytes' not in st.session_state:
-    st.session_state['current_pdf_bytes'] = None
+if 'current_pdf_digest' not in st.session_state:
+    st.session_state['current_pdf_digest'] = None
 if "chat_history" not in st.session_state:
     st.session_state.chat_history = []
 if 'ui_theme' not in st.session_state:
-    st.session_state['ui_theme'] = '跟隨系統'
+    st.session_state['ui_theme'] = DEFAULT_THEME
 if 'pending_question' not in st.session_state:
     st.session_state['pending_question'] = None
+if 'session_id' not in st.session_state:
+    st.session_state['session_id'] = uuid.uuid4().hex
+if 'report_library' not in st.session_state:
+    st.session_state['report_library'] = {}  # 本 session 完成的分析 (多份報告比較用)
 
 # 新增：模型設定 State
 if 'model_name' not in st.session_state:
     st.session_state['model_name'] = DEFAULT_MODEL
+# 模型路由 ({群組: 模型}，None 為單一模型) 與失敗時是否改用另一個模型
+if 'model_routing' not in st.session_state:
+    st.session_state['model_routing'] = routing_policy(MODEL_ROUTING)
+if 'model_fallback' not in st.session_state:
+    st.session_state['model_fallback'] = MODEL_FALLBACK
 
 # =============================================================================
 # 2. CLIENT 初始化
@@ -261,15 +103,17 @@ def get_gemini_client(api_key):
         return None
     try:
         return genai.Client(api_key=api_key)
-    except Exception as e:
+    except Exception:
         return None
 
-CLIENT = get_gemini_client(API_KEY)
+def get_client():
+    """共用的 Gemini Client：第一次實際需要時才匯入 SDK 並建立 (之後由 cache_resource 取用)。"""
+    return get_gemini_client(API_KEY)
+
+CLIENT_INIT_ERROR = "❌ 錯誤：CLIENT 初始化失敗，請檢查 API Key 是否有效。"
 GLOBAL_CONFIG_ERROR = None
-if CLIENT is None and API_KEY is None:
+if API_KEY is None:
     GLOBAL_CONFIG_ERROR = "❌ 錯誤：GEMINI_API_KEY 未設定，無法連線至 Gemini API。"
-elif CLIENT is None:
-    GLOBAL_CONFIG_ERROR = "❌ 錯誤：CLIENT 初始化失敗，請檢查 API Key 是否有效。"
 
 
 # --- 頁面配置與主頁導航 ---
@@ -279,264 +123,12 @@ st.set_page_config(
     layout="wide",
 )
 
-# =============================================================================
-# CSS 樣式系統 (修復背景全白問題 + Messenger/IG 風格)
-# =============================================================================
-
-CSS_BASE = """
-    /* 1. 強制覆蓋 Streamlit 預設背景，確保漸層不被白色覆蓋 */
-    [data-testid="stAppViewContainer"] {
-        background: transparent !important; 
-    }
-    
-    /* 隱藏預設元素 */
-    header[data-testid="stHeader"] {display: none;}
-    footer {display: none;}
-    .stDeployButton {display: none;}
-    hr { display: none !important; }
-    
-    /* 設定按鈕樣式 */
-    .settings-btn {
-        border: none; background: transparent; font-size: 1.5rem; cursor: pointer;
-        transition: transform 0.3s ease;
-    }
-    .settings-btn:hover { transform: rotate(90deg); }
-
-    /* 進度條置頂 */
-    .processing-indicator {
-        color: #d4af37; font-weight: bold; font-family: monospace; animation: pulse 1.5s infinite;
-        text-align: center; padding: 10px; border: 1px solid #d4af37; border-radius: 10px;
-    }
-    @keyframes pulse { 0% { opacity: 0.5; } 50% { opacity: 1; } 100% { opacity: 0.5; } }
-
-    /* 左下角浮水印 */
-    .fixed-watermark {
-        position: fixed; bottom: 20px; left: 25px; font-size: 20px;
-        font-family: 'Times New Roman', serif; font-weight: 900; 
-        z-index: 9999; pointer-events: none; letter-spacing: 2px;
-        opacity: 0.1 !important; 
-    }
-
-    /* 動畫 */
-    @keyframes sheen { 0% { background-position: 0% 50%; } 100% { background-position: 100% 50%; } }
-    
-    /* 表單按鈕強制樣式 (皇家紫金) */
-    div[data-testid="stForm"] button[kind="primary"] {
-        background: linear-gradient(135deg, #7B2CBF 0%, #9D4EDD 100%) !important;
-        color: #ffffff !important;
-        border: 2px solid #FFD700 !important;
-        box-shadow: 0 4px 10px rgba(123, 44, 191, 0.3) !important;
-        border-radius: 8px !important;
-        height: 46px !important;
-        width: 100% !important;
-        margin-top: 0px !important;
-    }
-    div[data-testid="stForm"] button[kind="primary"]:hover {
-        transform: scale(1.02) !important;
-        box-shadow: 0 6px 15px rgba(123, 44, 191, 0.5) !important;
-    }
-
-    /* 強制對齊 Form 內的元件底部 */
-    div[data-testid="stForm"] [data-testid="column"] {
-        align-items: flex-end !important;
-    }
-    
-    /* -------------------------------------------
-       聊天室 Messenger/IG/Line 風格優化
-       ------------------------------------------- */
-    
-    /* 移除 Streamlit 預設對話框的背景與邊框 */
-    .stChatMessage {
-        background-color: transparent !important;
-        border: none !important;
-        padding: 0.5rem 0 !important;
-    }
-
-    /* 使用者氣泡 (右側 + 藍/紫漸層 + 圓角尖角) */
-    div[data-testid="stChatMessage"]:has(div[data-testid="stChatMessageUserAvatar"]) {
-        flex-direction: row-reverse;
-        text-align: right;
-    }
-    div[data-testid="stChatMessage"]:has(div[data-testid="stChatMessageUserAvatar"]) div[data-testid="stChatMessageContent"] {
-        background: linear-gradient(135deg, #00B2FF 0%, #006AFF 100%);
-        color: white !important;
-        border-radius: 18px 18px 4px 18px !important;
-        box-shadow: 0 1px 2px rgba(0,0,0,0.1);
-        padding: 10px 15px !important;
-        margin-left: 20% !important;
-        margin-right: 10px !important;
-        display: inline-block;
-        text-align: left; 
-    }
-    div[data-testid="stChatMessageUserAvatar"] { display: none !important; }
-
-    /* AI 氣泡 (左側 + 圓角尖角) */
-    div[data-testid="stChatMessage"]:has(div[data-testid="stChatMessageAvatar"]) div[data-testid="stChatMessageContent"] {
-        border-radius: 18px 18px 18px 4px !important;
-        box-shadow: 0 1px 2px rgba(0,0,0,0.05);
-        padding: 10px 15px !important;
-        margin-right: 20% !important;
-        margin-left: 10px !important;
-        display: inline-block;
-    }
-    
-    /* AI 頭像美化 */
-    div[data-testid="stChatMessageAvatar"] {
-        background-color: transparent !important;
-        border: 2px solid #FFD700;
-        border-radius: 50%;
-        overflow: hidden;
-        padding: 2px;
-    }
-"""
-
-CSS_DARK = """
-    /* 🌑 暗色模式 - 強制鎖定背景 */
-    [data-testid="stAppViewContainer"] {
-        background-color: #05020a !important;
-        background-image: 
-            radial-gradient(circle at 20% 30%, rgba(123, 44, 191, 0.2) 0%, transparent 50%),
-            radial-gradient(circle at 80% 70%, rgba(255, 215, 0, 0.15) 0%, transparent 50%),
-            linear-gradient(135deg, rgba(10, 5, 20, 0.95) 0%, rgba(25, 10, 40, 0.95) 100%) !important;
-        background-attachment: fixed !important;
-        background-size: cover !important;
-    }
-    
-    .stApp { color: #e0e0e0 !important; }
-
-    h1, h2, h3, .big-title {
-        background: linear-gradient(to right, #FFD700, #FFC300, #D4AF37, #9D4EDD, #7B2CBF) !important;
-        background-size: 200% auto !important; -webkit-background-clip: text !important; -webkit-text-fill-color: transparent !important;
-        text-shadow: 0 2px 15px rgba(157, 78, 221, 0.6) !important; animation: sheen 3s linear infinite !important;
-    }
-    div[data-testid="stVerticalBlock"] > div[style*="flex-direction: column;"] > div[data-testid="stVerticalBlock"] {
-        background: rgba(40, 20, 60, 0.4) !important; backdrop-filter: blur(10px) !important;
-        border: 2px solid rgba(255, 215, 0, 0.3) !important; border-radius: 20px !important; padding: 30px !important;
-        box-shadow: 0 0 0 1px rgba(157, 78, 221, 0.3) inset, 0 10px 30px rgba(0, 0, 0, 0.5), 0 0 40px rgba(123, 44, 191, 0.2) !important;
-        margin-bottom: 25px !important;
-    }
-    /* 非 Form 的普通按鈕 */
-    .stButton>button:not([kind="primary"]) {
-        background: linear-gradient(135deg, #4a1a88 0%, #7B2CBF 100%) !important; color: #FFD700 !important; border: none !important;
-        box-shadow: 0 5px 15px rgba(123, 44, 191, 0.5) !important;
-    }
-    .stTextInput input, .stChatInput textarea, .stFileUploader {
-        background-color: rgba(20, 10, 30, 0.6) !important; border: 2px solid #9D4EDD !important; color: #FFD700 !important;
-    }
-    .fixed-watermark {
-        background: linear-gradient(to right, #FFD700, #FFF, #9D4EDD) !important; -webkit-background-clip: text !important; -webkit-text-fill-color: transparent !important;
-    }
-    .royal-divider::before, .royal-divider::after { background: linear-gradient(to right, transparent, #FFD700, #9D4EDD, transparent) !important; }
-    .royal-divider-icon { color: #FFD700; }
-    .stTabs [aria-selected="true"] { color: #FFD700 !important; border-bottom: 3px solid #9D4EDD !important; }
-
-    /* AI 氣泡 (暗黑模式) */
-    div[data-testid="stChatMessage"]:has(div[data-testid="stChatMessageAvatar"]) div[data-testid="stChatMessageContent"] {
-        background: #2A2A2A !important; 
-        color: #E4E6EB !important;
-        border: 1px solid #3A3A3A;
-    }
-    /* 輸入框美化 */
-    .stChatInput textarea {
-        background-color: #1A1A1A !important;
-        border: 1px solid #333 !important;
-        color: white !important;
-    }
-"""
-
-CSS_LIGHT = """
-    /* ☀️ 亮色模式 - 強制鎖定背景 */
-    [data-testid="stAppViewContainer"] {
-        background-color: #fdfbf7 !important;
-        background-image: 
-            linear-gradient(120deg, #fdfbf7 0%, #f3e5f5 100%),
-            radial-gradient(at 0% 0%, rgba(255, 215, 0, 0.15) 0px, transparent 50%), 
-            radial-gradient(at 100% 100%, rgba(157, 78, 221, 0.15) 0px, transparent 50%) !important;
-        background-attachment: fixed !important;
-        background-size: cover !important;
-    }
-
-    .stApp { color: #2e1065 !important; }
-
-    h1, h2, h3, .big-title {
-        background: linear-gradient(45deg, #4a1a88, #7b2cbf, #b8860b, #4a1a88) !important;
-        background-size: 300% auto !important; -webkit-background-clip: text !important; -webkit-text-fill-color: transparent !important;
-        font-weight: 900 !important; padding-bottom: 10px !important; animation: sheen 8s ease infinite !important;
-    }
-    div[data-testid="stVerticalBlock"] > div[style*="flex-direction: column;"] > div[data-testid="stVerticalBlock"] {
-        background: rgba(255, 255, 255, 0.75) !important; backdrop-filter: blur(15px) !important;
-        border: 1px solid rgba(157, 78, 221, 0.2) !important; border-radius: 20px !important; padding: 25px !important;
-        box-shadow: 0 10px 30px rgba(100, 50, 150, 0.05), inset 0 0 20px rgba(255, 255, 255, 0.8) !important;
-        margin-bottom: 20px !important;
-    }
-    /* 非 Form 的普通按鈕 */
-    .stButton>button:not([kind="primary"]) {
-        background: linear-gradient(135deg, #7b2cbf 0%, #9d4edd 100%) !important; color: #ffffff !important; border: none !important;
-        border-radius: 12px !important; box-shadow: 0 5px 15px rgba(123, 44, 191, 0.3) !important;
-    }
-    button[kind="secondary"] {
-        background: transparent !important; border: 2px solid #7b2cbf !important; color: #7b2cbf !important;
-    }
-    .stTextInput input, .stChatInput textarea, .stFileUploader {
-        background-color: rgba(255,255,255,0.8) !important; border: 2px solid #dcdcdc !important; color: #4a1a88 !important; border-radius: 12px !important;
-    }
-    .royal-divider::before, .royal-divider::after { background: linear-gradient(to right, transparent, #b8860b, transparent) !important; }
-    .royal-divider-icon { color: #b8860b; }
-    .fixed-watermark {
-        background: linear-gradient(to right, #4a1a88, #b8860b) !important; -webkit-background-clip: text !important; -webkit-text-fill-color: transparent !important;
-    }
-    .stTabs [aria-selected="true"] { color: #7B1FA2 !important; border-bottom: 3px solid #7B1FA2 !important; }
-    
-    /* 使用者氣泡 (IG Style) */
-    div[data-testid="stChatMessage"]:has(div[data-testid="stChatMessageUserAvatar"]) div[data-testid="stChatMessageContent"] {
-        background: linear-gradient(135deg, #833AB4 0%, #FD1D1D 50%, #FCAF45 100%) !important;
-    }
-    
-    /* AI 氣泡 (Messenger Gray) */
-    div[data-testid="stChatMessage"]:has(div[data-testid="stChatMessageAvatar"]) div[data-testid="stChatMessageContent"] {
-        background: #F0F2F5 !important;
-        color: #050505 !important;
-        border: none !important;
-    }
-    /* 輸入框美化 */
-    .stChatInput textarea {
-        background-color: #ffffff !important;
-        border: 1px solid #ddd !important;
-        color: black !important;
-        box-shadow: 0 2px 10px rgba(0,0,0,0.05);
-    }
-"""
-
-CSS_STRUCTURE = """
-    .stTabs [data-baseweb="tab-list"] { background: transparent !important; gap: 15px !important; }
-    .stTabs [data-baseweb="tab"] { border: none !important; font-weight: 800 !important; font-size: 1.1rem !important; }
-    .royal-divider { display: flex; align-items: center; margin: 40px 0; justify-content: center; }
-    .royal-divider::before, .royal-divider::after { content: ""; width: 40%; height: 2px; display: block; }
-    .royal-divider-icon { padding: 0 15px; font-size: 1.5rem; }
-    div[data-testid="column"] { display: flex; flex-direction: column; justify-content: center; }
-"""
-
-# 決定 CSS 注入邏輯
-theme_selection = st.session_state.get('ui_theme', '跟隨系統')
-final_css = CSS_BASE + CSS_STRUCTURE
-
-if theme_selection == '極致黑金 (Dark)':
-    final_css += CSS_DARK 
-elif theme_selection == '皇家白金 (Light)':
-    final_css += CSS_LIGHT
-else: # 跟隨系統
-    final_css += f"@media (prefers-color-scheme: dark) {{ {CSS_DARK} }} @media (prefers-color-scheme: light) {{ {CSS_LIGHT} }}"
-
-st.markdown(f"<style>{final_css}</style>", unsafe_allow_html=True)
-st.markdown('<div class="fixed-watermark">⚜️ (K.R.)</div>', unsafe_allow_html=True)
+# 主題樣式與浮水印依主題快取於 ui_assets (每個程序只組合一次)，每次 rerun 只送出同一個元素
+st.markdown(page_chrome(st.session_state.get('ui_theme', DEFAULT_THEME)), unsafe_allow_html=True)
 
 def royal_divider(icon="⚜️"):
     st.markdown(f"""<div class="royal-divider"><span class="royal-divider-icon">{icon}</span></div>""", unsafe_allow_html=True)
 
-st.markdown("""<style>html { lang: "zh-Hant"; }</style>""", unsafe_allow_html=True)
-keep_alive = """<script>setInterval(() => { fetch(window.location.href, {mode: 'no-cors'}); }, 300000);</script>"""
-st.markdown(keep_alive, unsafe_allow_html=True)
-
 
 # =============================================================================
 # 3. 設定對話框 (新增模型選擇)
@@ -545,16 +137,14 @@ st.markdown(keep_alive, unsafe_allow_html=True)
 @st.dialog("⚙️ 系統設定")
 def open_settings_dialog():
     """彈窗設定介面"""
-    tab_gen, tab_data, tab_about = st.tabs(["⚙️ 一般設定", "🧹 資料管理", "ℹ️ 關於系統"])
+    tab_gen, tab_data, tab_diag, tab_about = st.tabs(["⚙️ 一般設定", "🧹 資料管理", "📈 診斷", "ℹ️ 關於系統"])
     
     with tab_gen:
         # 主題設定
-        current_theme_index = ["跟隨系統", "極致黑金 (Dark)", "皇家白金 (Light)"].index(
-            st.session_state.get('ui_theme', '跟隨系統')
-        )
+        current_theme_index = THEMES.index(st.session_state.get('ui_theme', DEFAULT_THEME))
         new_theme = st.radio(
             "🎨 介面主題", 
-            ["跟隨系統", "極致黑金 (Dark)", "皇家白金 (Light)"],
+            THEMES,
             index=current_theme_index,
             horizontal=True
         )
@@ -592,18 +182,101 @@ def open_settings_dialog():
             st.toast(f"✅ 模型已切換為：{selected_model_label}")
             time.sleep(0.5)
             st.rerun()
+
+        # 模型路由：依步驟選擇模型 (例如只有標準化提取使用 Pro)，可逐項覆寫
+        st.write("🔀 模型路由")
+        routing = st.session_state.get('model_routing')
+        hybrid = st.radio(
+            "模型路由",
+            ["單一模型", "混合路由"],
+            index=1 if routing else 0,
+            horizontal=True,
+            label_visibility="collapsed",
+            help="混合路由：標準化提取使用進階版，其餘步驟使用入門版 (可逐項調整)"
+        ) == "混合路由"
+        new_routing = None
+        if hybrid:
+            routing = routing or ROUTING_POLICIES["hybrid"]
+            model_labels = {value: label for label, value in MODEL_OPTIONS.items()}
+            new_routing = {}
+            for group, (group_label, _) in ROUTING_GROUPS.items():
+                current = model_labels.get(routing.get(group), model_options_list[0])
+                selected = st.selectbox(group_label, model_options_list, index=model_options_list.index(current), key=f"route_{group}")
+                new_routing[group] = MODEL_OPTIONS[selected]
+        st.session_state['model_routing'] = new_routing
+        st.session_state['model_fallback'] = st.checkbox(
+            "🛟 失敗時改用另一個模型重試",
+            value=st.session_state.get('model_fallback', False),
+            help="某個步驟的模型發生錯誤、排隊逾時或暫停時，改用另一個模型重新執行該步驟"
+        )
         
     with tab_data:
+        cache_stats = get_result_cache().stats()
+        st.write("📦 分析結果快取")
+        st.caption(
+            f"命中 {cache_stats['hits']} 次 / 未命中 {cache_stats['misses']} 次 · "
+            f"{cache_stats['entries']} 筆 ({cache_stats['bytes'] / 1024 / 1024:.1f} MB)"
+        )
+        if st.button("🧹 清除分析結果快取"):
+            get_result_cache().clear()
+            st.toast("✅ 已清除分析結果快取")
+
+        doc_stats = get_document_store().stats()
+        st.write("🗂️ 共用文件儲存區")
+        st.caption(
+            f"{doc_stats['documents']} 份文件 · {doc_stats['holders']} 個 session 使用中 · "
+            f"記憶體 {doc_stats['memory_bytes'] / 1024 / 1024:.1f} MB / 磁碟 {doc_stats['disk_bytes'] / 1024 / 1024:.1f} MB"
+        )
+
+        job_stats = get_analysis_jobs().stats()
+        st.write("🧵 背景分析佇列")
+        st.caption(f"執行中 {job_stats['running']} / 上限 {job_stats['max_workers']} · 排隊 {job_stats['queued']} · 平均耗時 {format_seconds(get_analysis_jobs().average_seconds())}")
+
+        st.write("🚦 API 請求排程")
+        for model, model_stats in get_scheduler().stats().items():
+            circuit = "⛔ 暫停中" if model_stats["circuit_open"] else "🟢 正常"
+            st.caption(
+                f"{model}：排隊 {model_stats['queued']} · 進行中 {model_stats['in_flight']} · "
+                f"速率 {model_stats['rpm']} 次/分 · {circuit}"
+            )
+
+        st.markdown("---")
         st.warning("⚠️ 清除資料將無法復原")
         if st.button("🗑️ 清除所有分析紀錄", type="primary"):
             st.session_state['analysis_results'] = None
             st.session_state['chat_history'] = []
-            st.session_state['current_pdf_bytes'] = None
+            st.session_state['current_pdf_digest'] = None
             st.session_state['pending_question'] = None
+            st.session_state['std_index'] = None
+            st.session_state['report_library'] = {}
+            get_pdf_file_registry().release(get_client(), st.session_state['session_id'])
+            get_document_store().release(st.session_state['session_id'])
+            get_document_store().release(baseline_holder())
+            get_analysis_jobs().discard(st.session_state['session_id'])
             st.success("✅ 已清除所有暫存資料！")
             time.sleep(1)
             st.rerun()
             
+    with tab_diag:
+        step_rows, report_rows = summarize_call_log(get_call_logger().read())
+        if not step_rows:
+            st.info("尚無 API 呼叫紀錄。")
+        else:
+            st.write("⏱️ 各步驟延遲與 token 用量")
+            st.dataframe(step_rows, hide_index=True, use_container_width=True)
+            st.write("🧾 每份報告 token 用量")
+            st.dataframe(report_rows, hide_index=True, use_container_width=True)
+            st.caption(f"紀錄檔：{get_call_logger().path}")
+
+        prompts = get_prompt_registry()
+        st.write("📝 提示詞版本 (修改 prompts/ 的檔案後自動重新載入)")
+        st.dataframe(
+            [{"提示詞": name, "檔案": prompts.files[name], "雜湊": digest} for name, digest in prompts.digests().items()],
+            hide_index=True, use_container_width=True
+        )
+        for name, error in prompts.errors.items():
+            st.warning(f"⚠️ {name} 重新載入失敗，沿用先前的版本：{error}")
+
     with tab_about:
         st.markdown("### 🤖 AI 財報分析系統")
         st.write("**版本：** v2.1.0 (Model Selection Added)")
@@ -637,84 +310,140 @@ def render_custom_header(title="AI 智能財報分析系統", show_nav=False):
 # 5. 核心分析邏輯
 # =============================================================================
 
-def run_analysis_flow(file_content_to_send, status_container):
+@st.cache_resource
+def get_result_cache():
+    return AnalysisResultCache(RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES)
+
+# 分析進度中每個步驟即時預覽的輸出長度 (只顯示最新的尾段)
+STREAM_PREVIEW_CHARS = 600
+
+@st.cache_resource
+def get_analysis_jobs():
+    return AnalysisJobQueue()
+
+# 輪詢背景分析進度的間隔 (秒；st.fragment 只重新執行進度區塊)
+JOB_POLL_SECONDS = 1.0
+
+def run_analysis_flow(pdf_digest, closing_price=None, previous=None):
     """
-    執行 5 步驟分析流程，並將 PDF 存入 session_state 供對話使用。
+    把 5 步驟分析流程 (依賴圖並行) 排入背景工作佇列。PDF 已存入共用文件儲存區，session_state 只記錄 digest 供對話使用。
+    closing_price 為計算本益比用的收盤價 (選填)。已完成的步驟會寫入結果快取，失敗後重新執行時從缺少的步驟繼續。
+    previous 為增量更新的基準 (同一公司先前的分析結果；附註內容沒有變動的大項沿用其標準化表格)。
+    進度由首頁的 analysis_job_panel() 輪詢顯示。
     """
-    company_name = None
-    standardization_data = None
-    ratio_data = None
-    summary_data = None
-    explanation_data = None
-    
-    st.session_state['current_pdf_bytes'] = file_content_to_send
+    st.session_state['current_pdf_digest'] = pdf_digest
     st.session_state['chat_history'] = []
-    
-    # 獲取當前模型名稱 (用於顯示)
-    current_model = st.session_state.get('model_name', DEFAULT_MODEL)
-    
-    try:
-        with status_container.status(f"⏳ 正在執行 AI 分析 (核心: {current_model})...", expanded=True) as status:
-            
-            st.write("📜 步驟 1/5: 正在識別公司名稱...")
-            name_response = call_multimodal_api(
-                file_content_bytes=file_content_to_send,
-                prompt=PROMPT_COMPANY_NAME, 
-                use_search=False
-            )
-            if name_response.get("error"): raise Exception(name_response['error'])
-            company_name = name_response["content"].strip()
-            
-            st.write("🔍 步驟 2/5: 正在提取與標準化財報數據...")
-            std_response = call_multimodal_api(
-                file_content_bytes=file_content_to_send,
-                prompt=PROMPT_BIAO_ZHUN_HUA_CONTENT, 
-                use_search=False
-            )
-            if std_response.get("error"): raise Exception(std_response['error'])
-            standardization_data = std_response["content"]
-
-            st.write("🧮 步驟 3/5: 正在計算關鍵財務比率...")
-            ratio_response = call_multimodal_api(
-                file_content_bytes=file_content_to_send,
-                prompt=PROMPT_RATIO_CONTENT, 
-                use_search=True 
-            )
-            if ratio_response.get("error"): raise Exception(ratio_response['error'])
-            ratio_data = ratio_response["content"]
+    file_content_to_send = get_document_store().get(pdf_digest, st.session_state['session_id'])
+    if file_content_to_send is None:
+        st.error("❌ 找不到已上傳的檔案，請重新上傳。")
+        return
+    client = get_client()
+    if client is None:
+        st.error(CLIENT_INIT_ERROR)
+        return
 
-            st.write("⚖️ 步驟 4/5: 正在生成專業審計總結...")
-            summary_response = call_text_api(
-                input_text=standardization_data,
-                prompt=PROMPT_ZONG_JIE_CONTENT 
-            )
-            if summary_response.get("error"): raise Exception(summary_response['error'])
-            summary_data = summary_response["content"]
+    # 背景執行緒無法讀取 session_state，模型名稱與 PDF 參照函數需在此先取出
+    job = AnalysisJob(
+        pdf_digest, st.session_state.get('model_name', DEFAULT_MODEL), closing_price, previous,
+        routing=st.session_state.get('model_routing'), fallback=st.session_state.get('model_fallback', False)
+    )
+    # 基準沒有記錄附註章節雜湊時，以其 PDF (由 hold_baseline 保留) 計算
+    previous_pdf = None
+    if previous is not None and not previous.get("section_digests"):
+        previous_pdf = get_document_store().get(previous["pdf_sha256"], baseline_holder())
+    # 結果快取命中的步驟直接取用；各步驟只送出所需頁面，無法篩選頁面時才上傳完整 PDF
+    get_analysis_jobs().submit(
+        st.session_state['session_id'], job, client, file_content_to_send,
+        cache=get_result_cache(),
+        get_pdf_part=make_pdf_part_getter(),
+        previous_pdf=previous_pdf
+    )
+
+def baseline_holder():
+    """session 的增量更新基準在文件儲存區中的持有者 (與目前文件分開，放入新文件時不會被釋放)。"""
+    return f"{st.session_state['session_id']}:baseline"
+
+def hold_baseline(previous):
+    """
+    放入新文件前呼叫：基準沒有記錄附註章節雜湊時，以 baseline_holder() 保留其 PDF 供開始分析時計算；
+    不使用基準時釋放先前保留的 PDF。
+    """
+    store = get_document_store()
+    if previous is not None and not previous.get("section_digests"):
+        store.hold(previous["pdf_sha256"], baseline_holder())
+    else:
+        store.release(baseline_holder())
+
+def remember_report(results):
+    """把完成的分析加入本 session 的報告清單 (同一公司、模型與路由只保留最新一次)。"""
+    models = {model for _, group_models, _ in summarize_routing(results.get("routing")) for model in group_models}
+    model = "混合路由" if len(models) > 1 else results.get('model_name', '')
+    label = f"{results.get('company_name') or '未命名報告'} ({model})"
+    st.session_state['report_library'][label] = results
+
+def show_precomputed_results(pdf_digest, results):
+    """直接顯示預先計算的範例結果 (不經過分析流程)。"""
+    st.session_state['current_pdf_digest'] = pdf_digest
+    st.session_state['chat_history'] = []
+    st.session_state['analysis_results'] = results
+    remember_report(results)
+    get_std_index(results)
+    navigate_to('Report')
 
-            st.write("🗣️ 步驟 5/5: 正在生成白話文數據講解...")
-            explanation_response = call_text_api(
-                input_text=standardization_data,
-                prompt=PROMPT_JIAN_JIE_CONTENT 
-            )
-            if explanation_response.get("error"): raise Exception(explanation_response['error'])
-            explanation_data = explanation_response["content"]
-            
-            status.update(label="✅ 分析完成！準備生成報告...", state="complete", expanded=False)
-
-        parsed_content = {
-            "company_name": company_name,
-            "ratio": ratio_data,
-            "summary": summary_data,
-            "explanation": explanation_data,
-            "standardization": standardization_data
-        }
-        
-        st.session_state['analysis_results'] = parsed_content
-        time.sleep(0.5)
+@st.cache_resource
+def get_missing_samples():
+    """啟動時檢查一次範例檔案 (伺服器執行期間不變)。"""
+    return missing_samples()
+
+def format_seconds(seconds):
+    return f"{seconds:.0f} 秒" if seconds < 90 else f"{seconds / 60:.0f} 分鐘"
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def analysis_job_panel():
+    """
+    顯示目前 session 背景分析的排隊順位與各步驟進度 (只有此區塊定期重新執行)。
+    完成後進入報告頁；失敗時顯示錯誤並提供從中斷處繼續的按鈕。
+    """
+    jobs = get_analysis_jobs()
+    job = jobs.get(st.session_state['session_id'])
+    if job is None: return
+    snapshot = job.snapshot()
+
+    if snapshot["state"] == "done":
+        jobs.discard(st.session_state['session_id'], job.id)
+        st.session_state['analysis_results'] = snapshot["results"]
+        remember_report(snapshot["results"])
+        get_std_index(snapshot["results"])
         navigate_to('Report')
 
-    except Exception as e:
-        st.error(f"❌ 分析流程中斷：\n{e}")
+    if snapshot["state"] == "failed":
+        st.error(f"❌ 分析流程中斷：\n{snapshot['error']}")
+        st.caption(f"已完成 {snapshot['done_count']}/{snapshot['total_steps']} 個步驟並已儲存，繼續分析時會從中斷的步驟開始。")
+        if st.button("🔁 從中斷處繼續分析", type="primary", use_container_width=True):
+            run_analysis_flow(job.pdf_digest, job.closing_price, job.previous)
+            st.rerun()
+        return
+
+    if snapshot["state"] == "queued":
+        position, start_in, finish_in = jobs.position(job)
+        st.info(
+            f"⏳ 分析排隊中：第 {position} 位 (同時最多 {jobs.max_workers} 份分析)，"
+            f"預計約 {format_seconds(start_in)}後開始、{format_seconds(finish_in)}後完成。"
+        )
+        return
+
+    # 尖峰時段提示：請求會在共用排程器中排隊，而不是直接撞上配額錯誤
+    queued = get_scheduler().queue_depth(job.model_name)
+    queue_note = f" (目前有 {queued} 筆請求排隊中，可能需要較長時間)" if queued else ""
+    core = "混合路由" if job.routing else job.model_name
+    with st.status(f"⏳ 正在執行 AI 分析 (核心: {core})... {snapshot['done_count']}/{snapshot['total_steps']}{queue_note}", expanded=True):
+        # 每個步驟一行；進行中的步驟顯示最新輸出的尾段
+        for step in snapshot["steps"]:
+            if step["state"] == "done":
+                st.write(f"✔️ {step['label']} 完成" + (" (快取)" if step["from_cache"] else ""))
+            else:
+                st.write(f"{step['label']}...")
+                if step["text"]: st.caption(step["text"][-STREAM_PREVIEW_CHARS:])
 
 # =============================================================================
 # 6. 頁面內容定義
@@ -728,36 +457,69 @@ def home_page():
         st.error(GLOBAL_CONFIG_ERROR)
         return
 
-    status_container = st.empty()
-
     with st.container():
         st.markdown("### ⚡ 快速分析 (範例企業)")
-        c1, c2, c3, c4 = st.columns(4)
-        target_file = None
-        if c1.button("📊 2330 (台積電)", use_container_width=True): target_file = "2330.pdf"
-        if c2.button("📈 2382 (廣達)", use_container_width=True): target_file = "2382.pdf"
-        if c3.button("📉 2308 (台達電)", use_container_width=True): target_file = "2308.pdf"
-        if c4.button("💻 2454 (聯發科)", use_container_width=True): target_file = "2454.pdf"
+        # 範例檔案在啟動時檢查；缺少的範例按鈕停用，而不是點擊後才出錯
+        missing = {sample["stem"] for sample in get_missing_samples()}
+        target_sample = None
+        for column, sample in zip(st.columns(len(SAMPLE_REPORTS)), SAMPLE_REPORTS):
+            unavailable = sample["stem"] in missing
+            if column.button(sample["label"], use_container_width=True, disabled=unavailable,
+                             help=f"找不到範例檔案 {sample['file']}" if unavailable else None):
+                target_sample = sample
+        c_live, c_compare = st.columns([3, 1])
+        rerun_live = c_live.toggle("🔄 重新即時分析 (不使用預先計算的範例結果)", key="rerun_live")
+        if c_compare.button("🆚 多份報告比較", use_container_width=True):
+            navigate_to('Compare')
 
     royal_divider("📂")
 
     with st.container():
         st.markdown("### 📜 上傳財務報告")
         uploaded = st.file_uploader("請選擇 PDF 格式的文件...", type=["pdf"], key="uploader")
+        closing_price = st.number_input(
+            "📌 收盤價 (選填，用於計算本益比；單位：元)",
+            min_value=0.0, value=None, step=0.5, key="closing_price"
+        )
+        # 增量更新：選擇同一公司先前的分析 (例如上一季)，只重新提取附註內容有變動的大項。
+        # 沒有記錄附註章節雜湊的分析需要其 PDF 仍在文件儲存區中 (由 hold_baseline 保留到開始分析)
+        baselines = {label: results for label, results in comparison_sources().items()
+                     if results.get("standardization_shards")
+                     and (results.get("section_digests") or get_document_store().contains(results.get("pdf_sha256")))}
+        baseline = st.selectbox(
+            "🔁 增量更新基準 (選填，沿用先前分析中附註內容沒有變動的大項)",
+            ["不使用"] + list(baselines), key="incremental_baseline", disabled=not baselines
+        )
+        previous = baselines.get(baseline)
     
     royal_divider("🚀")
 
-    if target_file and os.path.exists(target_file):
-        with open(target_file, "rb") as f: 
-            run_analysis_flow(f.read(), status_container)
-    elif target_file:
-         st.error(f"❌ 找不到範例檔案: {target_file}")
+    # 排隊中、進行中 (或失敗待繼續) 的背景分析：頁面重新執行後重新接上
+    active_job = get_analysis_jobs().get(st.session_state['session_id'])
+    pdf_digest = None
+    if target_sample:
+        hold_baseline(previous)
+        pdf_digest = get_document_store().put_path(sample_path(target_sample), st.session_state['session_id'])
+        model_name = st.session_state.get('model_name', DEFAULT_MODEL)
+        # 預先計算的範例結果以單一模型產生；使用混合路由時改為即時分析
+        use_live = rerun_live or st.session_state.get('model_routing')
+        precomputed = None if use_live else load_sample_results(target_sample["stem"], model_name, closing_price)
+        if precomputed is not None:
+            show_precomputed_results(pdf_digest, precomputed)
     elif uploaded:
         if st.button("✨ 開始執行分析", type="primary", use_container_width=True):
-            run_analysis_flow(uploaded.read(), status_container)
-    else:
+            uploaded.seek(0)
+            hold_baseline(previous)
+            pdf_digest = get_document_store().put_file(uploaded, st.session_state['session_id'])
+    elif active_job is None:
         st.info("請先上傳文件或選擇範例以開始。")
 
+    if pdf_digest:
+        run_analysis_flow(pdf_digest, closing_price, previous)
+        active_job = get_analysis_jobs().get(st.session_state['session_id'])
+    if active_job is not None:
+        analysis_job_panel()
+
 
 # --- B. Report Page ---
 def report_page():
@@ -774,28 +536,29 @@ def report_page():
     st.markdown("---")
     col1, col2, col3 = st.columns([1, 2, 1])
     with col2:
-        nav1, nav2 = st.columns(2)
+        nav1, nav2, nav3 = st.columns(3)
         with nav1: st.button("📊 分析報告", use_container_width=True, disabled=True)
         with nav2: 
             if st.button("💬 進入聊天室", use_container_width=True, type="primary"):
                 navigate_to('Chat')
+        with nav3:
+            if st.button("🆚 多份報告比較", use_container_width=True):
+                navigate_to('Compare')
+    incremental = results.get("incremental")
+    if incremental:
+        st.caption(f"🔁 增量更新：沿用先前分析的 {len(incremental['reused'])} 個大項，重新提取 {len(incremental['rerun'])} 個大項。")
+    routing = summarize_routing(results.get("routing"))
+    if len({model for _, models, _ in routing for model in models}) > 1:
+        st.caption("🔀 模型路由：" + " · ".join(f"{label} {'、'.join(models)}" for label, models, _ in routing))
+    fallbacks = [label for label, _, count in routing if count]
+    if fallbacks:
+        st.warning(f"🛟 以下步驟的主要模型失敗，已改用另一個模型完成：{'、'.join(fallbacks)}")
     royal_divider()
 
     # --- 財務比率區塊 ---
     with st.container():
         st.subheader("💎 關鍵財務比率")
-        ratio_tables = results['ratio'].split('\n\n') 
-        valid_tables = [t.strip() for t in ratio_tables if t.strip().startswith('|') and '---' in t]
-        
-        ratio_map = {}
-        for t in valid_tables:
-            if '本益比' in t: ratio_map['PE'] = t
-            elif '淨利率' in t: ratio_map['NPM'] = t
-            elif '毛利率' in t: ratio_map['GPM'] = t
-            elif 'ROE' in t: ratio_map['ROE'] = t
-            elif '流動' in t: ratio_map['CR'] = t
-            elif '負債' in t: ratio_map['DR'] = t
-            elif '速動' in t: ratio_map['QR'] = t
+        ratio_map = {key: ratio_table_markdown(table) for key, table in ratio_tables(results_tables(results)).items()}
         
         c1, c2, c3 = st.columns(3)
         with c1: st.markdown(ratio_map.get('ROE', "**ROE**"))
@@ -815,7 +578,30 @@ def report_page():
     tab1, tab2, tab3 = st.tabs(["📄 財報總結", "🗣️ 數據講解", "📊 原始資訊"])
     with tab1: st.markdown(results['summary'])
     with tab2: st.markdown(results['explanation'])
-    with tab3: st.markdown(results['standardization'])
+    with tab3:
+        st.markdown(results['standardization'])
+        std_records = select_records(results_tables(results), source="standardization")
+        if std_records["item"]:
+            with st.expander(f"📋 結構化數據 ({len(std_records['item'])} 筆)"):
+                st.dataframe(
+                    {name: std_records[name] for name in ("section", "item", "period", "value", "unit")},
+                    hide_index=True,
+                    use_container_width=True
+                )
+        # 匯出檔案在點擊時才於背景產生 (不影響頁面 rerun)，下載後不重新執行頁面
+        formats = available_formats()
+        st.caption("📥 匯出比率與標準化數據 (Parquet 供資料分析、JSON 供程式讀取、Excel 可匯入 Google 試算表)")
+        for col, fmt in zip(st.columns(len(formats)), formats):
+            with col:
+                st.download_button(
+                    f"📥 {EXPORT_FORMATS[fmt]['label']}",
+                    data=lambda fmt=fmt: export_bytes(results, fmt),
+                    file_name=export_filename(results, fmt),
+                    mime=EXPORT_FORMATS[fmt]["mime"],
+                    on_click="ignore",
+                    key=f"export_{fmt}",
+                    use_container_width=True
+                )
 
     st.markdown("<br><br>", unsafe_allow_html=True)
     
@@ -868,18 +654,6 @@ def chat_page():
     if st.button("⬅️ 返回報告總覽", type="secondary", use_container_width=True):
         navigate_to('Report')
     
-    # --- 處理自動跳轉過來的問題 ---
-    if st.session_state.get('pending_question'):
-        pending_q = st.session_state['pending_question']
-        st.session_state['pending_question'] = None # 清除
-        
-        st.session_state.chat_history.append({"role": "user", "content": pending_q})
-        
-        # 立即生成回應
-        with st.spinner("AI 正在思考中..."):
-            response_text = process_chat_message(pending_q, results)
-        st.session_state.chat_history.append({"role": "assistant", "content": response_text})
-
     # --- 渲染對話歷史 ---
     # 使用 Container 確保高度自適應
     chat_container = st.container()
@@ -890,6 +664,18 @@ def chat_page():
             with st.chat_message(role, avatar=avatar):
                 st.markdown(message["content"])
 
+        # --- 處理自動跳轉過來的問題 (串流顯示回應) ---
+        if st.session_state.get('pending_question'):
+            pending_q = st.session_state['pending_question']
+            st.session_state['pending_question'] = None # 清除
+            
+            st.session_state.chat_history.append({"role": "user", "content": pending_q})
+            with st.chat_message("user", avatar="👤"):
+                st.markdown(pending_q)
+            with st.chat_message("assistant", avatar="⚜️"):
+                response_text = st.write_stream(stream_chat_message(pending_q, results, st.session_state.chat_history[:-1]))
+            st.session_state.chat_history.append({"role": "assistant", "content": response_text})
+
     # --- 底部輸入框 ---
     user_input = st.chat_input("輸入訊息...")
     
@@ -899,10 +685,7 @@ def chat_page():
             st.markdown(user_input)
         
         with st.chat_message("assistant", avatar="⚜️"):
-            message_placeholder = st.empty()
-            with st.spinner("Thinking..."):
-                full_response = process_chat_message(user_input, results)
-                message_placeholder.markdown(full_response)
+            full_response = st.write_stream(stream_chat_message(user_input, results, st.session_state.chat_history[:-1]))
         
         st.session_state.chat_history.append({"role": "assistant", "content": full_response})
         
@@ -916,90 +699,138 @@ def chat_page():
         time.sleep(0.1) # 確保 JS 有時間執行
         st.rerun()
 
-def process_chat_message(user_question, results):
-    """處理聊天訊息並呼叫 API"""
-    input_contents = []
-    
-    # (A) 原始財報 PDF
-    if st.session_state.get('current_pdf_bytes'):
-        try:
-            pdf_part = types.Part.from_bytes(
-                data=st.session_state['current_pdf_bytes'], 
-                mime_type='application/pdf'
-            )
-            input_contents.append(pdf_part)
-        except: pass
-    
-    # (B) 標準化數據 Context
-    std_data = results.get('standardization', '')
-    system_prompt_text = f"""
-    你是一位專業且靈活的財務顧問。
-    【資料來源 1】你已經閱讀了這家公司的原始財報 PDF (已附上)。
-    【資料來源 2】以下是我們已經整理好的標準化財務數據：
-    {std_data[:5000]} (節錄)
-    【任務】請根據使用者的問題進行回答。風格輕鬆專業。
-    """
-    input_contents.append(system_prompt_text)
-    input_contents.append(f"使用者問題: {user_question}")
-    
-    response = call_chat_api(input_contents)
-    if response.get("error"): return f"❌ Error: {response['error']}"
-    return response["content"]
+# --- D. Compare Page ---
+def comparison_sources():
+    """可比較的報告：本 session 完成的分析 + 目前模型已建置的範例結果 ({名稱: 結果})。"""
+    sources = dict(st.session_state['report_library'])
+    for sample, results in precomputed_samples(st.session_state.get('model_name', DEFAULT_MODEL)):
+        sources.setdefault(f"{sample['label']} (範例)", results)
+    return sources
+
+def compare_page():
+    render_custom_header("🆚 多份報告比較", show_nav=True)
+    if st.button("⬅️ 返回", type="secondary"):
+        navigate_to('Report' if st.session_state.get('analysis_results') else 'Home')
+    royal_divider()
+
+    sources = comparison_sources()
+    if len(sources) < 2:
+        st.info("需要至少兩份已完成的分析才能比較。請先分析其他財報 (或建置範例結果)。")
+        return
+
+    selected = st.multiselect("選擇要比較的報告", list(sources), default=list(sources)[:4])
+    if len(selected) < 2:
+        st.info("請至少選擇兩份報告。")
+        return
+    c_base, c_source = st.columns(2)
+    base = c_base.selectbox("基準報告 (差異 = 其他報告 - 基準)", selected)
+    source = c_source.radio("資料", ["關鍵財務比率", "標準化數據"], horizontal=True)
+
+    # 只使用已解析的欄式紀錄，不呼叫模型
+    reports = [(label, sources[label]) for label in selected]
+    frame = comparison_frame(reports)
+    if not frame.empty:
+        level = "ratio" if source == "關鍵財務比率" else "standardization"
+        frame = frame[frame.index.get_level_values("source") == level].droplevel("source")
+    if source == "標準化數據" and not frame.empty:
+        sections = list(dict.fromkeys(frame.index.get_level_values("section")))
+        chosen = st.multiselect("章節", sections, default=sections[:5])
+        frame = frame[frame.index.get_level_values("section").isin(chosen)]
+    if frame.empty:
+        st.info("所選報告沒有可比較的數值。")
+        return
+
+    st.caption("期間對齊：" + " · ".join(
+        f"{label}：{PERIOD_SLOTS[0]} {periods[0] or '-'} / {PERIOD_SLOTS[1]} {periods[1] or '-'}"
+        for label, periods in period_labels(reports).items()
+    ))
+    headers = {"section": "章節", "item": "項目", "unit": "單位", "slot": "期間"}
+    st.write("📋 數值")
+    st.dataframe(frame.reset_index().rename(columns=headers), hide_index=True, use_container_width=True)
+
+    delta, pct = comparison_deltas(frame, base)
+    st.write(f"📐 與基準 ({base}) 的差額")
+    st.dataframe(delta.reset_index().rename(columns=headers), hide_index=True, use_container_width=True)
+    st.write("📈 差異百分比 (%)")
+    st.dataframe(pct.round(2).reset_index().rename(columns=headers), hide_index=True, use_container_width=True)
+
+def get_std_index(results):
+    """取得目前報告的章節索引；每份報告只建立一次，存於 session_state 與分析結果並存。"""
+    std_data = results.get('standardization', '') or ''
+    index = st.session_state.get('std_index')
+    if index is None or index.digest != text_digest(std_data):
+        index = SectionIndex(std_data)
+        st.session_state['std_index'] = index
+    return index
+
+@st.cache_resource
+def get_chat_context_registry():
+    return ChatContextRegistry()
+
+def get_chat_context(results, model_name):
+    def create():
+        pdf_part = None
+        pdf_bytes = get_current_pdf_bytes()
+        if pdf_bytes:
+            pdf_part = get_pdf_part(pdf_bytes)
+        return create_chat_context(get_client(), results, model_name, pdf_part=pdf_part)
+    return get_chat_context_registry().get(chat_context_key(results, model_name), create)
+
+def stream_chat_message(user_question, results, history=()):
+    """處理聊天訊息並以串流方式逐段產生回應 (供 st.write_stream 使用)"""
+    touch_current_document()
+    model_name = st.session_state.get('model_name', DEFAULT_MODEL)
+    return pipeline_stream_chat_message(
+        get_client(), user_question,
+        get_context=lambda: get_chat_context(results, model_name),
+        index=get_std_index(results),
+        history=history,
+        model_name=model_name
+    )
 
 # =============================================================================
-# 7. API 呼叫函數 (已修改為動態讀取模型)
+# 7. API 資源 (跨 session 共用)
 # =============================================================================
 
-def call_multimodal_api(file_content_bytes, prompt, use_search=False):
-    global CLIENT 
-    if CLIENT is None: return {"error": GLOBAL_CONFIG_ERROR}
-    try:
-        pdf_part = types.Part.from_bytes(data=file_content_bytes, mime_type='application/pdf')
-    except Exception as e: return {"error": str(e)} 
-    
-    contents = [pdf_part, prompt] 
-    tools_config = [{"google_search": {}}] if use_search else None
-    config = types.GenerateContentConfig(temperature=0.0, tools=tools_config)
-    
-    # 動態讀取模型
-    model_to_use = st.session_state.get('model_name', DEFAULT_MODEL)
+@st.cache_resource
+def get_pdf_file_registry():
+    return PdfFileRegistry()
 
-    for attempt in range(3): 
-        try:
-            response = CLIENT.models.generate_content(model=model_to_use, contents=contents, config=config)
-            return {"status": "success", "content": response.text}
-        except Exception as e:
-            if attempt == 2: return {"error": str(e)}
-            time.sleep(2)
-
-def call_text_api(input_text, prompt):
-    global CLIENT 
-    if CLIENT is None: return {"error": GLOBAL_CONFIG_ERROR}
-    contents = [input_text, prompt] 
-    config = types.GenerateContentConfig(temperature=0.0)
-    
-    # 動態讀取模型
-    model_to_use = st.session_state.get('model_name', DEFAULT_MODEL)
+@st.cache_resource
+def get_document_store():
+    return DocumentStore(DOCUMENT_STORE_DIR)
 
-    try:
-        response = CLIENT.models.generate_content(model=model_to_use, contents=contents, config=config)
-        return {"status": "success", "content": response.text}
-    except Exception as e:
-        return {"error": str(e)}
-
-def call_chat_api(contents):
-    global CLIENT 
-    if CLIENT is None: return {"error": GLOBAL_CONFIG_ERROR}
-    config = types.GenerateContentConfig(temperature=1.2, tools=[{"google_search": {}}])
-    
-    # 動態讀取模型
-    model_to_use = st.session_state.get('model_name', DEFAULT_MODEL)
+def get_current_pdf_bytes():
+    """目前 session 所分析的 PDF 內容；文件已因閒置被移除時回傳 None。"""
+    digest = st.session_state.get('current_pdf_digest')
+    if not digest: return None
+    return get_document_store().get(digest, st.session_state['session_id'])
 
-    try:
-        response = CLIENT.models.generate_content(model=model_to_use, contents=contents, config=config)
-        return {"status": "success", "content": response.text}
-    except Exception as e:
-        return {"error": str(e)}
+def touch_current_document():
+    """聊天仍在使用目前的 PDF：更新持有時間，避免上下文已快取時文件因閒置逾時被移除。"""
+    digest = st.session_state.get('current_pdf_digest')
+    if digest: get_document_store().touch(digest, st.session_state['session_id'])
+
+def make_pdf_part_getter():
+    """
+    回傳 get_pdf_part(pdf_bytes, document=None)：上傳 (或重用) 目前 session 所用 PDF (或其精簡 PDF，document 為
+    原始 PDF 的 digest) 的 Part，上傳失敗時退回內嵌位元組。
+    registry、CLIENT 與 session_id 在此先取得，回傳的函數可在分析的背景執行緒中呼叫。
+    """
+    registry, client, holder = get_pdf_file_registry(), get_client(), st.session_state['session_id']
+
+    def get_part(pdf_bytes, document=None):
+        if client is not None:
+            try:
+                return registry.get_part(client, pdf_bytes, holder, document)
+            except Exception:
+                pass
+        return types.Part.from_bytes(data=pdf_bytes, mime_type='application/pdf')
+    return get_part
+
+def get_pdf_part(pdf_bytes):
+    """回傳目前 session 所用 PDF 的 Part (主執行緒使用)。"""
+    return make_pdf_part_getter()(pdf_bytes)
 
 # =============================================================================
 # 8. 運行主邏輯
@@ -1010,4 +841,6 @@ if st.session_state['current_page'] == 'Home':
 elif st.session_state['current_page'] == 'Report':
     report_page()
 elif st.session_state['current_page'] == 'Chat':
-    chat_page()
\ No newline at end of file
+    chat_page()
+elif st.session_state['current_page'] == 'Compare':
+    compare_page()
@@ -0,0 +1,125 @@
+import threading
+from datetime import timedelta
+
+import analysis_pipeline
+from analysis_pipeline import ChatContext, ChatContextRegistry
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_registry(monkeypatch, **kwargs):
+    clock = Clock()
+    monkeypatch.setattr(analysis_pipeline.time, "monotonic", clock)
+    created = []
+
+    def get(key):
+        return registry.get(key, lambda: created.append(key) or ChatContext([], f"prompt-{key}"))
+
+    registry = ChatContextRegistry(**kwargs)
+    return get, created, clock
+
+
+def test_reuses_context_until_stale(monkeypatch):
+    get, created, _ = make_registry(monkeypatch)
+    first = get("a")
+    assert get("a") is first
+    first.invalidate()
+    assert get("a") is not first
+    assert created == ["a", "a"]
+
+
+def test_idle_entries_are_evicted(monkeypatch):
+    get, created, clock = make_registry(monkeypatch, idle_ttl=timedelta(minutes=10))
+    get("a")
+    clock.now += 5 * 60
+    get("b")
+    clock.now += 6 * 60  # a 閒置 11 分鐘，b 閒置 6 分鐘
+    get("c")
+    get("b")
+    get("a")
+    assert created == ["a", "b", "c", "a"]
+
+
+def test_least_recently_used_entry_is_evicted(monkeypatch):
+    get, created, _ = make_registry(monkeypatch, max_entries=2)
+    get("a")
+    get("b")
+    get("a")  # b 成為最久未使用
+    get("c")
+    get("a")
+    get("b")
+    assert created == ["a", "b", "c", "b"]
+
+
+class FakeCaches:
+    def __init__(self):
+        self.deleted = []
+
+    def delete(self, name):
+        self.deleted.append(name)
+        if name == "cachedContents/broken": raise RuntimeError("已過期")
+
+
+class FakeClient:
+    def __init__(self):
+        self.caches = FakeCaches()
+
+
+def test_evicted_and_replaced_contexts_delete_provider_cache(monkeypatch):
+    client = FakeClient()
+    clock = Clock()
+    monkeypatch.setattr(analysis_pipeline.time, "monotonic", clock)
+    registry = ChatContextRegistry(idle_ttl=timedelta(minutes=10), max_entries=2)
+
+    def get(key):
+        return registry.get(key, lambda: ChatContext([], "", cached_content=f"cachedContents/{key}", client=client))
+
+    get("a")
+    get("b")
+    get("c")  # 超過上限：移除最久未使用的 a
+    assert client.caches.deleted == ["cachedContents/a"]
+    clock.now += 11 * 60
+    get("broken")  # b、c 閒置逾時；刪除失敗時忽略
+    assert sorted(client.caches.deleted) == ["cachedContents/a", "cachedContents/b", "cachedContents/c"]
+    get("broken").invalidate()
+    get("broken")  # 重建時刪除舊的快取 (失敗時忽略)
+    assert client.caches.deleted[-1] == "cachedContents/broken"
+    # 本地替代版本沒有 Gemini 端快取
+    ChatContext([], "", client=client).delete()
+    assert len(client.caches.deleted) == 4
+
+
+def test_building_a_context_does_not_block_other_keys():
+    registry = ChatContextRegistry()
+    building, release = threading.Event(), threading.Event()
+    created = []
+
+    def slow_create():
+        created.append("a")
+        building.set()
+        release.wait(5)
+        return ChatContext([], "a")
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(registry.get("a", slow_create))) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    assert building.wait(5)
+    # 其他報告的上下文不需等待 a 建立完成
+    other = []
+    lookup = threading.Thread(target=lambda: other.append(registry.get("b", lambda: ChatContext([], "b"))))
+    lookup.start()
+    lookup.join(1)
+    assert [context.system_prompt for context in other] == ["b"]
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    # 同一個鍵同時取用時只建立一次
+    assert created == ["a"]
+    assert len(results) == 2 and results[0] is results[1]
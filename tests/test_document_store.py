@@ -0,0 +1,41 @@
+import io
+
+from analysis_pipeline import DocumentStore
+
+
+def pdf(name, size=2048):
+    return io.BytesIO(b"%PDF-1.4 " + name.encode() * size)
+
+
+def test_new_upload_releases_previous_document(tmp_path):
+    store = DocumentStore(str(tmp_path), spill_bytes=1024)
+    a = store.put_file(pdf("A"), "session")
+    b = store.put_file(pdf("B"), "session")
+    assert not store.contains(a)
+    assert store.contains(b)
+
+
+def test_baseline_survives_upload_in_same_session(tmp_path):
+    """同一個 session 上傳 A，再上傳 B 並選擇 A 為增量更新基準：A 的 PDF 需保留到開始分析。"""
+    store = DocumentStore(str(tmp_path), spill_bytes=1024)
+    a = store.put_file(pdf("A"), "session")
+    assert store.hold(a, "session:baseline")
+    b = store.put_file(pdf("B"), "session")
+    assert store.get(a, "session:baseline") == pdf("A").getvalue()
+    assert store.get(b, "session") == pdf("B").getvalue()
+
+    # 改用其他基準或不使用基準時，先前保留的 PDF 即被移除
+    store.release("session:baseline")
+    assert not store.contains(a)
+    assert store.contains(b)
+
+
+def test_hold_keeps_one_document_per_holder(tmp_path):
+    store = DocumentStore(str(tmp_path))
+    a = store.put_file(pdf("A", 16), "s1")
+    b = store.put_file(pdf("B", 16), "s2")
+    assert store.hold(a, "baseline") and store.hold(b, "baseline")
+    store.release("s1")
+    assert not store.contains(a)
+    assert store.hold("missing", "baseline") is False
+    assert store.contains(b)
@@ -0,0 +1,57 @@
+import os
+import sys
+
+import pytest
+
+from analysis_pipeline import PdfFileRegistry, analysis_steps, analyze_pdf
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_ROOT, "benchmarks"))
+
+from stub_backend import StubBackend, StubClient, load_recording  # noqa: E402
+
+SAMPLE_PDF = os.path.join(REPO_ROOT, "2382.pdf")
+
+
+@pytest.fixture
+def client():
+    prompts = {step["prompt"]: step["key"] for step in analysis_steps() if step["prompt"]}
+    recording = load_recording(os.path.join(REPO_ROOT, "benchmarks", "recordings", "sample.json"))
+    return StubClient(StubBackend(recording, prompts, first_token_latency=0.0, chars_per_second=1e7, jitter=0.0))
+
+
+@pytest.mark.skipif(not os.path.exists(SAMPLE_PDF), reason="缺少範例 PDF")
+def test_each_page_group_is_uploaded_once(client):
+    with open(SAMPLE_PDF, "rb") as f:
+        pdf_bytes = f.read()
+    registry = PdfFileRegistry()
+
+    def get_pdf_part(data, document=None):
+        return registry.get_part(client, data, "session", document)
+
+    analyze_pdf(client, pdf_bytes, get_pdf_part=get_pdf_part)
+    stats = client.backend.stats.snapshot()
+    # 比率步驟只有標準化數據缺少欄位時才取用其頁面群組
+    groups = {step["pages"] for step in analysis_steps() if step.get("pages")}
+    # 5 個標準化分片共用同一個 ("cover", "notes") 上傳，請求中只有檔案參照
+    assert 1 < stats["uploads"] <= len(groups)
+    assert stats["bytes_uploaded"] < len(pdf_bytes) * stats["uploads"]
+    assert stats["bytes_sent"] < len(pdf_bytes) / 10
+
+    # 再次分析同一份文件時沿用已上傳的檔案
+    analyze_pdf(client, pdf_bytes, get_pdf_part=get_pdf_part)
+    assert client.backend.stats.snapshot()["uploads"] == stats["uploads"]
+
+    registry.release(client, "session")
+    assert registry._entries == {}
+
+
+def test_trimmed_parts_belong_to_their_document(client):
+    registry = PdfFileRegistry()
+    registry.get_part(client, b"%PDF full A", "session")
+    registry.get_part(client, b"%PDF notes of A", "session", document="A")
+    registry.get_part(client, b"%PDF cover of A", "session", document="A")
+    assert sum("session" in e["holders"] for e in registry._entries.values()) == 2
+    # 換成另一份文件時釋放 A 的所有精簡 PDF
+    registry.get_part(client, b"%PDF full B", "session")
+    assert len(registry._entries) == 1
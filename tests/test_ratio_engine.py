@@ -0,0 +1,202 @@
+import pytest
+
+from ratio_engine import (
+    classify_period,
+    compute_ratios,
+    infer_period_type,
+    merge_extraction,
+    render_ratio_markdown,
+    resolve_inputs,
+)
+from report_tables import parse_report_tables
+
+# 半年報：損益表同時列出單季 (4-6 月) 與累計 (1-6 月)，另有變動欄位
+H1_STANDARDIZATION = """
+## 損益
+| 項目 | 113年4-6月 | 112年4-6月 | 113年1-6月 | 112年1-6月 | 變動比率 |
+| :--- | :--- | :--- | :--- | :--- | :--- |
+| 營業收入 | 1,000 | 800 | 1,800 | 1,500 | 20% |
+| 營業毛利 | 400 | 300 | 700 | 560 | 25% |
+| 本期淨利 | 200 | 100 | 350 | 200 | 75% |
+| 歸屬於母公司業主之本期淨利 | 180 | 90 | 320 | 180 | 78% |
+| 基本每股盈餘 (元) | 1.50 | 0.80 | 2.70 | 1.60 | 69% |
+
+## 資產負債
+| 項目 | 113/06/30 | 112/12/31 | 112/06/30 |
+| :--- | :--- | :--- | :--- |
+| 歸屬於母公司業主之權益 | 10,000 | 9,000 | 8,500 |
+| 資產總計 | 20,000 | 18,000 | 17,000 |
+| 負債總計 | 10,000 | 9,000 | 8,500 |
+| 流動資產合計 | 8,000 | 7,000 | 6,500 |
+| 流動負債合計 | 4,000 | 3,500 | 3,000 |
+| 存貨 | 2,000 | 1,500 | 1,400 |
+| 預付款項 | 400 | 300 | 200 |
+"""
+
+# 第三季報：以日期區間表示期間，累計欄位在前
+Q3_STANDARDIZATION = """
+## 損益
+| 項目 | 113/01/01~113/09/30 | 112/01/01~112/09/30 | 113/07/01~113/09/30 | 112/07/01~112/09/30 |
+| :--- | :--- | :--- | :--- | :--- |
+| 營業收入 | 3,000 | 2,400 | 1,200 | 900 |
+| 營業毛利 | 1,200 | 960 | 600 | 360 |
+| 本期淨利 | 600 | 480 | 300 | 180 |
+| 歸屬於母公司業主之本期淨利 | 540 | 420 | 270 | 150 |
+| 基本每股盈餘 | 4.50 | 3.00 | 2.00 | 1.00 |
+
+## 資產負債
+| 項目 | 113/09/30 | 112/12/31 | 112/09/30 |
+| :--- | :--- | :--- | :--- |
+| 期初歸屬於母公司業主之權益 | 9,500 | 8,000 | 8,000 |
+| 歸屬於母公司業主之權益 | 10,500 | 9,500 | 9,000 |
+"""
+
+
+def resolve(markdown):
+    return resolve_inputs(parse_report_tables(markdown, "standardization"))
+
+
+def ratio(ratios, key):
+    return next(r for r in ratios if r["key"] == key)
+
+
+@pytest.mark.parametrize("label, expected", [
+    ("113年4-6月", "quarter"),
+    ("113年1-6月", "cumulative"),
+    ("113年1-3月", "both"),
+    ("113/07/01~113/09/30", "quarter"),
+    ("113/01/01~113/09/30", "cumulative"),
+    ("113年7月1日至9月30日", "quarter"),
+    ("113年1月1日至9月30日", "cumulative"),
+    ("113年第三季", "quarter"),
+    ("113年前三季", "cumulative"),
+    ("113年度", "cumulative"),
+    ("113/06/30", "balance"),
+    ("本期", None),
+])
+def test_classify_period(label, expected):
+    assert classify_period(label) == expected
+
+
+def test_resolve_inputs_h1_uses_quarter_for_margins_and_cumulative_for_eps():
+    values, labels, bases = resolve(H1_STANDARDIZATION)
+    assert values["revenue"] == [1000, 800]
+    assert values["gross_profit"] == [400, 300]
+    assert values["net_income_parent"] == [320, 180]
+    assert values["eps"] == [2.7, 1.6]
+    # 比較期餘額取上年同一日期 (112/06/30)，期初權益取上年度期末 (112/12/31)
+    assert values["equity_parent"] == [10000, 8500]
+    assert values["equity_parent_opening"] == [9000, None]
+    assert labels["quarter"] == ["113年4-6月", "112年4-6月"]
+    assert labels["cumulative"] == ["113年1-6月", "112年1-6月"]
+    assert labels["balance"] == ["113/06/30", "112/06/30"]
+    assert bases["revenue"] == "quarter" and bases["eps"] == "cumulative"
+    assert infer_period_type(labels) == "H1"
+
+
+def test_resolve_inputs_q3_date_ranges():
+    values, labels, bases = resolve(Q3_STANDARDIZATION)
+    assert values["revenue"] == [1200, 900]
+    assert values["eps"] == [4.5, 3.0]
+    assert values["net_income_parent"] == [540, 420]
+    assert values["equity_parent_opening"] == [9500, 8000]
+    assert values["equity_parent"] == [10500, 9000]
+    assert infer_period_type(labels) == "Q3"
+
+
+def test_cumulative_field_never_takes_quarter_column():
+    markdown = "| 項目 | 113年7-9月 | 112年7-9月 |\n| :--- | :--- | :--- |\n| 基本每股盈餘 | 2.00 | 1.00 |\n| 營業收入 | 1,200 | 900 |"
+    values, _, bases = resolve(markdown)
+    assert values["eps"] == [None, None] and "eps" not in bases
+    assert values["revenue"] == [1200, 900]
+
+
+def test_annual_report_margins_fall_back_to_full_year():
+    markdown = ("| 項目 | 113年度 | 112年度 |\n| :--- | :--- | :--- |\n"
+                "| 營業收入 | 4,000 | 3,000 |\n| 營業毛利 | 1,000 | 900 |")
+    values, _, bases = resolve(markdown)
+    assert values["revenue"] == [4000, 3000] and bases["revenue"] == "cumulative"
+    gpm = ratio(compute_ratios(values, bases=bases), "GPM")
+    assert gpm["values"] == pytest.approx([25.0, 30.0])
+    assert any("累計期間" in note for note in gpm["notes"])
+
+
+def test_compute_ratios_h1():
+    values, labels, bases = resolve(H1_STANDARDIZATION)
+    ratios = compute_ratios(values, closing_price=100, period_type="H1", bases=bases)
+    assert ratio(ratios, "GPM")["values"] == pytest.approx([40.0, 37.5])
+    assert ratio(ratios, "NPM")["values"] == pytest.approx([20.0, 12.5])
+    # 本期累計 EPS 2.70 × 2 = 5.40
+    assert ratio(ratios, "PE")["values"] == pytest.approx([100 / 5.4])
+    # 本期期初為上年度期末 (112/12/31)；比較期以上年同期 (112/06/30) 的權益計算，缺期初時以其期末替代
+    roe = ratio(ratios, "ROE")
+    assert roe["values"] == pytest.approx([320 / 9500 * 100, 180 / 8500 * 100])
+    assert roe["notes"] == ["比較期缺少期初權益，以期末權益替代平均權益 (近似處理)"]
+    assert ratio(ratios, "QR")["values"] == pytest.approx([(8000 - 2000 - 400) / 4000 * 100, (6500 - 1400 - 200) / 3000 * 100])
+
+
+def test_compute_ratios_q3_annualizes_cumulative_eps():
+    values, labels, bases = resolve(Q3_STANDARDIZATION)
+    ratios = compute_ratios(values, closing_price=60, period_type=infer_period_type(labels), bases=bases)
+    assert ratio(ratios, "PE")["values"] == pytest.approx([60 / (4.5 / 3 * 4)])
+    assert ratio(ratios, "GPM")["values"] == pytest.approx([50.0, 40.0])
+    assert ratio(ratios, "ROE")["values"] == pytest.approx([540 / 10000 * 100, 420 / 8500 * 100])
+    assert not any("替代" in note for note in ratio(ratios, "ROE")["notes"])
+
+
+def test_average_equity_uses_closing_only_as_last_resort():
+    values, _, bases = resolve(H1_STANDARDIZATION)
+    values["equity_parent"] = [10000, None]
+    values["equity_parent_opening"] = [None, None]
+    roe = ratio(compute_ratios(values, period_type="H1", bases=bases), "ROE")
+    assert roe["values"][0] == pytest.approx(320 / 10000 * 100)
+    assert any("本期缺少期初權益，以期末權益替代" in note for note in roe["notes"])
+    # 全年度財報的比較期期末即本期期初
+    values["equity_parent"] = [10000, 9000]
+    roe = ratio(compute_ratios(values, period_type="FY", bases=bases), "ROE")
+    assert roe["values"][0] == pytest.approx(320 / 9500 * 100)
+    assert any("上年度期末" in note for note in roe["notes"])
+
+
+def test_balance_comparative_falls_back_to_second_column():
+    markdown = ("| 項目 | 113/06/30 | 112/12/31 |\n| :--- | :--- | :--- |\n"
+                "| 歸屬於母公司業主之權益 | 10,000 | 9,000 |")
+    values, labels, _ = resolve(markdown)
+    assert values["equity_parent"] == [10000, 9000]
+    assert values["equity_parent_opening"] == [9000, None]
+    assert labels["balance"] == ["113/06/30", "112/12/31"]
+
+
+def test_quick_ratio_requires_prepayments():
+    values, _, bases = resolve(H1_STANDARDIZATION)
+    values["prepayments"] = [None, 300]
+    qr = ratio(compute_ratios(values, bases=bases), "QR")
+    assert qr["values"][0] is None and qr["values"][1] is not None
+    assert any("預付款項" in note for note in qr["notes"])
+
+
+def test_merge_extraction_fills_missing_fields_with_declared_basis():
+    values, labels, bases = resolve(Q3_STANDARDIZATION)
+    extraction = """
+| 項目 | 本期 | 比較期 |
+| :--- | :--- | :--- |
+| 報告期間 | 113/01/01~113/09/30 | 112/01/01~112/09/30 |
+| 單季期間 | 113/07/01~113/09/30 | 112/07/01~112/09/30 |
+| 期間類型 | Q3 | - |
+| 流動資產合計 | 5,000 | 4,000 |
+| 流動負債合計 | 2,500 | 2,000 |
+| 存貨 | 1,000 | 800 |
+| 預付款項 | 0 | 0 |
+"""
+    values, labels, bases, period_type = merge_extraction(values, labels, bases, extraction)
+    assert period_type == "Q3"
+    assert values["prepayments"] == [0, 0] and bases["prepayments"] == "balance"
+    assert ratio(compute_ratios(values, bases=bases), "QR")["values"] == pytest.approx([160.0, 160.0])
+
+
+def test_render_uses_each_ratio_basis_labels():
+    values, labels, bases = resolve(H1_STANDARDIZATION)
+    markdown = render_ratio_markdown(compute_ratios(values, bases=bases), labels)
+    assert "| 毛利率 (Gross Profit Margin) | 113年4-6月 | 112年4-6月 |" in markdown
+    assert "| 股東權益報酬率 (ROE) | 113年1-6月 | 112年1-6月 |" in markdown
+    assert "| 負債比率 (Debt Ratio) | 113/06/30 | 112/06/30 |" in markdown
@@ -0,0 +1,163 @@
+import pytest
+
+from report_tables import (
+    RECORD_COLUMNS,
+    is_change_period,
+    parse_report_tables,
+    parse_value,
+    ratio_tables,
+    select_records,
+)
+
+# 標準化提取的典型輸出：章節標題、單位說明、多期間欄位與變動欄位
+STANDARDIZATION = """
+# 標準化財務報表
+單位：新台幣仟元
+
+## 資產負債表
+| 項目 | 113/09/30 | 112/12/31 | 112/09/30 | 變動金額 | 變動比率 (%) |
+| :--- | ---: | ---: | ---: | ---: | ---: |
+| 現金及約當現金 | 1,234,567 | 1,000,000 | 980,000 | 234,567 | 23.46 |
+| 短期借款 | (50,000) | - | △30,000 | -50,000 | 無法計算 |
+| **資產總計** | 9,876,543 | 9,000,000 | 8,800,000 | 876,543 | 9.74% |
+
+## 損益表
+| 項目 | 113年7-9月 | 112年7-9月 | 113年1-9月 | 112年1-9月 |
+| :--- | :--- | :--- | :--- | :--- |
+| 營業收入 | 3,000 | 2,500 | 8,500 | 7,000 |
+| 基本每股盈餘 (元) | 1.25 | 1.10 | 3.40 | 2.95 |
+"""
+
+RATIO = """
+### 1. 本益比 (P/E)
+| 本益比 | 113年第3季 | 112年第3季 |
+| :--- | :--- | :--- |
+| 比率 | 15.20倍 | 12.80倍 |
+
+### 2. 毛利率
+| 毛利率 | 113年第3季 | 112年第3季 |
+| :--- | :--- | :--- |
+| 比率 | 45.30% | 無法計算 |
+"""
+
+
+def rows(columns, **filters):
+    """篩選後逐列轉為 dict，方便比對。"""
+    selected = select_records(columns, **filters)
+    return [dict(zip(RECORD_COLUMNS, values)) for values in zip(*(selected[c] for c in RECORD_COLUMNS))]
+
+
+@pytest.mark.parametrize("cell, expected", [
+    ("1,234,567", (1234567.0, None)),
+    ("(50,000)", (-50000.0, None)),
+    ("（1,200）", (-1200.0, None)),
+    ("-50,000", (-50000.0, None)),
+    ("△30,000", (-30000.0, None)),
+    ("**9,876,543**", (9876543.0, None)),
+    ("23.46%", (23.46, "%")),
+    ("23.46 ％", (23.46, "%")),
+    ("15.20倍", (15.2, "倍")),
+    ("1,000千元", (1000.0, "仟元")),
+    ("113/09/30", (None, None)),
+    ("無法計算", (None, None)),
+    ("-", (None, None)),
+    ("", (None, None)),
+])
+def test_parse_value(cell, expected):
+    assert parse_value(cell) == expected
+
+
+def test_parse_standardization_table():
+    columns = parse_report_tables(STANDARDIZATION, "standardization", default_unit="仟元")
+    assert set(columns) == set(RECORD_COLUMNS)
+    assert len({len(values) for values in columns.values()}) == 1
+
+    cash = rows(columns, item="現金及約當現金")
+    assert [r["period"] for r in cash] == ["113/09/30", "112/12/31", "112/09/30", "變動金額", "變動比率 (%)"]
+    assert [r["value"] for r in cash] == [1234567.0, 1000000.0, 980000.0, 234567.0, 23.46]
+    assert {r["section"] for r in cash} == {"資產負債表"}
+    assert {r["table"] for r in cash} == {0}
+
+    borrowing = rows(columns, item="短期借款")
+    assert [r["value"] for r in borrowing] == [-50000.0, None, -30000.0, -50000.0, None]
+    assert borrowing[4]["raw"] == "無法計算"
+    assert rows(columns, item="**資產總計**")[0]["value"] == 9876543.0
+
+
+def test_change_columns_keep_their_own_unit():
+    columns = parse_report_tables(STANDARDIZATION, "standardization", default_unit="仟元")
+    cash = {r["period"]: r for r in rows(columns, item="現金及約當現金")}
+    # 欄標題的 (%) 優先於章節單位；儲存格後綴的 % 優先於所有說明
+    assert cash["變動比率 (%)"]["unit"] == "%"
+    assert cash["變動金額"]["unit"] == "仟元"
+    assert rows(columns, item="**資產總計**")[-1]["unit"] == "%"
+    assert is_change_period("變動金額") and is_change_period("變動比率 (%)")
+    assert not is_change_period("113/09/30") and not is_change_period("113年1-9月")
+
+
+def test_multi_period_income_statement():
+    columns = parse_report_tables(STANDARDIZATION, "standardization", default_unit="仟元")
+    revenue = rows(columns, item="營業收入")
+    assert [r["period"] for r in revenue] == ["113年7-9月", "112年7-9月", "113年1-9月", "112年1-9月"]
+    assert [r["value"] for r in revenue] == [3000.0, 2500.0, 8500.0, 7000.0]
+    assert {r["section"] for r in revenue} == {"損益表"}
+    assert {r["table"] for r in revenue} == {1}
+    # 列標題的 (元) 優先於章節的「單位：新台幣仟元」
+    assert {r["unit"] for r in rows(columns, item="基本每股盈餘 (元)")} == {"元"}
+
+
+def test_ratio_tables_use_ratio_name_as_item():
+    columns = parse_report_tables(RATIO, "ratio")
+    pe = rows(columns, item="本益比")
+    assert [(r["period"], r["value"], r["unit"]) for r in pe] == [
+        ("113年第3季", 15.2, "倍"), ("112年第3季", 12.8, "倍")]
+    assert {r["section"] for r in pe} == {"本益比"}
+
+    tables = ratio_tables(columns)
+    assert set(tables) == {"PE", "GPM"}
+    assert tables["GPM"]["values"] == ["45.30%", "無法計算"]
+    assert rows(columns, item="毛利率")[1]["value"] is None
+
+
+def test_malformed_rows():
+    text = """
+## 資產負債表
+| 項目 | 113/09/30 | 112/12/31 |
+| 沒有分隔列的表格 | 1 | 2 |
+
+| 項目 | 113/09/30 | 112/12/31 |
+| :--- | :--- | :--- |
+| 少一欄 | 100 |
+| 多一欄 | 200 | 300 | 400 |
+|  |  |  |
+| 文字 | 不適用 | N/A |
+"""
+    columns = parse_report_tables(text, "standardization")
+    # 沒有分隔列的列不視為表格；欄數不足只解析存在的欄，多出的欄位忽略
+    assert rows(columns, item="沒有分隔列的表格") == []
+    assert [(r["period"], r["value"]) for r in rows(columns, item="少一欄")] == [("113/09/30", 100.0)]
+    assert [(r["period"], r["value"]) for r in rows(columns, item="多一欄")] == [
+        ("113/09/30", 200.0), ("112/12/31", 300.0)]
+    assert [r["value"] for r in rows(columns, item="文字")] == [None, None]
+    assert set(columns["table"]) == {0}
+
+
+def test_adjacent_tables_without_blank_line():
+    text = """
+| 項目 | 113/09/30 |
+| :--- | :--- |
+| 現金 | 100 |
+| 項目 | 113年1-9月 |
+| :--- | :--- |
+| 營業收入 | 500 |
+"""
+    columns = parse_report_tables(text, "standardization")
+    # 第二個標題列先被當成資料列，遇到分隔列後撤回並開始新表格
+    assert columns["item"] == ["現金", "營業收入"]
+    assert columns["period"] == ["113/09/30", "113年1-9月"]
+    assert columns["table"] == [0, 1]
+
+
+def test_empty_input():
+    for text in (None, "", "沒有表格的文字"):
+        assert parse_report_tables(text, "ratio") == {name: [] for name in RECORD_COLUMNS}
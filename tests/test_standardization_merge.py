@@ -0,0 +1,97 @@
+import pytest
+
+from analysis_pipeline import (
+    STANDARDIZATION_SHARDS,
+    merge_standardization_shards,
+    run_standardization_merge,
+    run_step_graph,
+    section_blocks,
+    section_name,
+    standardization_sections,
+)
+
+SHARDS = {shard["key"]: shard for shard in STANDARDIZATION_SHARDS}
+
+
+def section_markdown(number):
+    """單一大項的模擬輸出 (## 標題 + 表格)，與單次呼叫時的格式相同。"""
+    _, rules = standardization_sections()
+    return (f"## {number}. {section_name(rules[number])}\n"
+            f"| 項目 | 113/09/30 | 112/12/31 |\n| :--- | :--- | :--- |\n| 合計 | {number},000 | {number},500 |")
+
+
+def single_call_layout(numbers=None):
+    """不拆分片時模型依序輸出 37 大項的結果。"""
+    _, rules = standardization_sections()
+    return "\n\n".join(section_markdown(n) for n in (numbers or sorted(rules))) + "\n"
+
+
+def shard_output(shard, order=None):
+    return "\n\n".join(section_markdown(n) for n in (order or shard["sections"]))
+
+
+def test_shards_cover_every_section_once():
+    _, rules = standardization_sections()
+    numbers = [n for shard in STANDARDIZATION_SHARDS for n in shard["sections"]]
+    assert sorted(numbers) == sorted(rules)
+
+
+def test_merge_equals_single_call_layout():
+    outputs = [(shard, shard_output(shard)) for shard in STANDARDIZATION_SHARDS]
+    assert merge_standardization_shards(outputs) == single_call_layout()
+    # 分片完成順序與分片內的大項順序都不影響結果
+    reordered = [(shard, shard_output(shard, order=list(reversed(shard["sections"]))))
+                 for shard in reversed(STANDARDIZATION_SHARDS)]
+    assert merge_standardization_shards(reordered) == single_call_layout()
+
+
+def test_run_standardization_merge_reads_shard_results():
+    ctx = {shard["key"]: shard_output(shard) for shard in STANDARDIZATION_SHARDS}
+    assert run_standardization_merge({}, ctx) == {"status": "success", "content": single_call_layout()}
+
+
+def test_blocks_matching_no_section_follow_previous_block():
+    shard = SHARDS["standardization_liabilities"]  # 17, 18, 19, 32, 33
+    text = "\n\n".join([
+        "以下為負債與權益相關附註。",
+        section_markdown(18),
+        "## 補充說明\n長期借款均為浮動利率。",
+        section_markdown(17),
+        section_markdown(6),  # 其他分片的大項：無法對應，跟隨前一個區塊
+        section_markdown(33),
+    ])
+    blocks = section_blocks(text, shard["sections"])
+    assert [n for n, _ in blocks] == [17, 18, 18, 17, 17, 33]
+    # 開頭沒有標題的文字視為分片的第一個大項
+    assert blocks[0][1] == "以下為負債與權益相關附註。"
+
+    merged = merge_standardization_shards([(shard, text)])
+    assert merged.index("以下為負債與權益相關附註。") < merged.index("## 17.") < merged.index("## 6.") \
+        < merged.index("## 18.") < merged.index("## 補充說明") < merged.index("## 33.")
+
+
+@pytest.mark.parametrize("missing", [None, ""])
+def test_missing_shard_keeps_other_sections_in_order(missing):
+    outputs = [(shard, missing if shard["key"] == "standardization_assets" else shard_output(shard))
+               for shard in STANDARDIZATION_SHARDS]
+    remaining = sorted(n for shard in STANDARDIZATION_SHARDS if shard["key"] != "standardization_assets"
+                       for n in shard["sections"])
+    assert merge_standardization_shards(outputs) == single_call_layout(remaining)
+    ctx = {shard["key"]: text for shard, text in outputs if text}
+    assert run_standardization_merge({}, ctx)["content"] == single_call_layout(remaining)
+
+
+def test_errored_shard_stops_the_merge():
+    def run_shard(step, ctx):
+        if step["key"] == "standardization_income":
+            return {"error": "模型回傳空白內容"}
+        return {"status": "success", "content": shard_output(SHARDS[step["key"]])}
+
+    merged = []
+    steps = [{"key": shard["key"], "label": shard["name"], "deps": [], "run": run_shard}
+             for shard in STANDARDIZATION_SHARDS]
+    steps.append({"key": "standardization", "label": "合併", "deps": list(SHARDS),
+                  "run": lambda step, ctx: merged.append(step) or run_standardization_merge(step, ctx)})
+    with pytest.raises(Exception, match="損益 失敗: 模型回傳空白內容"):
+        run_step_graph(steps, {"model_name": "test-model"}, max_workers=len(steps))
+    assert merged == []
@@ -0,0 +1,280 @@
+"""
+介面靜態資源：主題 CSS 與浮水印等固定的頁面外框 (不依賴 Streamlit)。
+
+Streamlit 每次互動都會從頭執行 streamlit_app.py；樣式在此模組中依主題組合、壓縮一次後快取 (每個程序一份)，
+每次 rerun 只送出同一段已組好的 HTML。style 標籤帶有內容雜湊 (data-version)，樣式改版後可直接辨識。
+"""
+import hashlib
+import re
+from functools import lru_cache
+
+# 介面主題選項 (設定對話框的順序)
+THEMES = ("跟隨系統", "極致黑金 (Dark)", "皇家白金 (Light)")
+DEFAULT_THEME = THEMES[0]
+
+WATERMARK_HTML = '<div class="fixed-watermark">⚜️ (K.R.)</div>'
+
+# =============================================================================
+# CSS 樣式系統 (修復背景全白問題 + Messenger/IG 風格)
+# =============================================================================
+
+CSS_BASE = """
+    /* 1. 強制覆蓋 Streamlit 預設背景，確保漸層不被白色覆蓋 */
+    [data-testid="stAppViewContainer"] {
+        background: transparent !important; 
+    }
+    
+    /* 隱藏預設元素 */
+    header[data-testid="stHeader"] {display: none;}
+    footer {display: none;}
+    .stDeployButton {display: none;}
+    hr { display: none !important; }
+    
+    /* 設定按鈕樣式 */
+    .settings-btn {
+        border: none; background: transparent; font-size: 1.5rem; cursor: pointer;
+        transition: transform 0.3s ease;
+    }
+    .settings-btn:hover { transform: rotate(90deg); }
+
+    /* 進度條置頂 */
+    .processing-indicator {
+        color: #d4af37; font-weight: bold; font-family: monospace; animation: pulse 1.5s infinite;
+        text-align: center; padding: 10px; border: 1px solid #d4af37; border-radius: 10px;
+    }
+    @keyframes pulse { 0% { opacity: 0.5; } 50% { opacity: 1; } 100% { opacity: 0.5; } }
+
+    /* 左下角浮水印 */
+    .fixed-watermark {
+        position: fixed; bottom: 20px; left: 25px; font-size: 20px;
+        font-family: 'Times New Roman', serif; font-weight: 900; 
+        z-index: 9999; pointer-events: none; letter-spacing: 2px;
+        opacity: 0.1 !important; 
+    }
+
+    /* 動畫 */
+    @keyframes sheen { 0% { background-position: 0% 50%; } 100% { background-position: 100% 50%; } }
+    
+    /* 表單按鈕強制樣式 (皇家紫金) */
+    div[data-testid="stForm"] button[kind="primary"] {
+        background: linear-gradient(135deg, #7B2CBF 0%, #9D4EDD 100%) !important;
+        color: #ffffff !important;
+        border: 2px solid #FFD700 !important;
+        box-shadow: 0 4px 10px rgba(123, 44, 191, 0.3) !important;
+        border-radius: 8px !important;
+        height: 46px !important;
+        width: 100% !important;
+        margin-top: 0px !important;
+    }
+    div[data-testid="stForm"] button[kind="primary"]:hover {
+        transform: scale(1.02) !important;
+        box-shadow: 0 6px 15px rgba(123, 44, 191, 0.5) !important;
+    }
+
+    /* 強制對齊 Form 內的元件底部 */
+    div[data-testid="stForm"] [data-testid="column"] {
+        align-items: flex-end !important;
+    }
+    
+    /* -------------------------------------------
+       聊天室 Messenger/IG/Line 風格優化
+       ------------------------------------------- */
+    
+    /* 移除 Streamlit 預設對話框的背景與邊框 */
+    .stChatMessage {
+        background-color: transparent !important;
+        border: none !important;
+        padding: 0.5rem 0 !important;
+    }
+
+    /* 使用者氣泡 (右側 + 藍/紫漸層 + 圓角尖角) */
+    div[data-testid="stChatMessage"]:has(div[data-testid="stChatMessageUserAvatar"]) {
+        flex-direction: row-reverse;
+        text-align: right;
+    }
+    div[data-testid="stChatMessage"]:has(div[data-testid="stChatMessageUserAvatar"]) div[data-testid="stChatMessageContent"] {
+        background: linear-gradient(135deg, #00B2FF 0%, #006AFF 100%);
+        color: white !important;
+        border-radius: 18px 18px 4px 18px !important;
+        box-shadow: 0 1px 2px rgba(0,0,0,0.1);
+        padding: 10px 15px !important;
+        margin-left: 20% !important;
+        margin-right: 10px !important;
+        display: inline-block;
+        text-align: left; 
+    }
+    div[data-testid="stChatMessageUserAvatar"] { display: none !important; }
+
+    /* AI 氣泡 (左側 + 圓角尖角) */
+    div[data-testid="stChatMessage"]:has(div[data-testid="stChatMessageAvatar"]) div[data-testid="stChatMessageContent"] {
+        border-radius: 18px 18px 18px 4px !important;
+        box-shadow: 0 1px 2px rgba(0,0,0,0.05);
+        padding: 10px 15px !important;
+        margin-right: 20% !important;
+        margin-left: 10px !important;
+        display: inline-block;
+    }
+    
+    /* AI 頭像美化 */
+    div[data-testid="stChatMessageAvatar"] {
+        background-color: transparent !important;
+        border: 2px solid #FFD700;
+        border-radius: 50%;
+        overflow: hidden;
+        padding: 2px;
+    }
+"""
+
+CSS_DARK = """
+    /* 🌑 暗色模式 - 強制鎖定背景 */
+    [data-testid="stAppViewContainer"] {
+        background-color: #05020a !important;
+        background-image: 
+            radial-gradient(circle at 20% 30%, rgba(123, 44, 191, 0.2) 0%, transparent 50%),
+            radial-gradient(circle at 80% 70%, rgba(255, 215, 0, 0.15) 0%, transparent 50%),
+            linear-gradient(135deg, rgba(10, 5, 20, 0.95) 0%, rgba(25, 10, 40, 0.95) 100%) !important;
+        background-attachment: fixed !important;
+        background-size: cover !important;
+    }
+    
+    .stApp { color: #e0e0e0 !important; }
+
+    h1, h2, h3, .big-title {
+        background: linear-gradient(to right, #FFD700, #FFC300, #D4AF37, #9D4EDD, #7B2CBF) !important;
+        background-size: 200% auto !important; -webkit-background-clip: text !important; -webkit-text-fill-color: transparent !important;
+        text-shadow: 0 2px 15px rgba(157, 78, 221, 0.6) !important; animation: sheen 3s linear infinite !important;
+    }
+    div[data-testid="stVerticalBlock"] > div[style*="flex-direction: column;"] > div[data-testid="stVerticalBlock"] {
+        background: rgba(40, 20, 60, 0.4) !important; backdrop-filter: blur(10px) !important;
+        border: 2px solid rgba(255, 215, 0, 0.3) !important; border-radius: 20px !important; padding: 30px !important;
+        box-shadow: 0 0 0 1px rgba(157, 78, 221, 0.3) inset, 0 10px 30px rgba(0, 0, 0, 0.5), 0 0 40px rgba(123, 44, 191, 0.2) !important;
+        margin-bottom: 25px !important;
+    }
+    /* 非 Form 的普通按鈕 */
+    .stButton>button:not([kind="primary"]) {
+        background: linear-gradient(135deg, #4a1a88 0%, #7B2CBF 100%) !important; color: #FFD700 !important; border: none !important;
+        box-shadow: 0 5px 15px rgba(123, 44, 191, 0.5) !important;
+    }
+    .stTextInput input, .stChatInput textarea, .stFileUploader {
+        background-color: rgba(20, 10, 30, 0.6) !important; border: 2px solid #9D4EDD !important; color: #FFD700 !important;
+    }
+    .fixed-watermark {
+        background: linear-gradient(to right, #FFD700, #FFF, #9D4EDD) !important; -webkit-background-clip: text !important; -webkit-text-fill-color: transparent !important;
+    }
+    .royal-divider::before, .royal-divider::after { background: linear-gradient(to right, transparent, #FFD700, #9D4EDD, transparent) !important; }
+    .royal-divider-icon { color: #FFD700; }
+    .stTabs [aria-selected="true"] { color: #FFD700 !important; border-bottom: 3px solid #9D4EDD !important; }
+
+    /* AI 氣泡 (暗黑模式) */
+    div[data-testid="stChatMessage"]:has(div[data-testid="stChatMessageAvatar"]) div[data-testid="stChatMessageContent"] {
+        background: #2A2A2A !important; 
+        color: #E4E6EB !important;
+        border: 1px solid #3A3A3A;
+    }
+    /* 輸入框美化 */
+    .stChatInput textarea {
+        background-color: #1A1A1A !important;
+        border: 1px solid #333 !important;
+        color: white !important;
+    }
+"""
+
+CSS_LIGHT = """
+    /* ☀️ 亮色模式 - 強制鎖定背景 */
+    [data-testid="stAppViewContainer"] {
+        background-color: #fdfbf7 !important;
+        background-image: 
+            linear-gradient(120deg, #fdfbf7 0%, #f3e5f5 100%),
+            radial-gradient(at 0% 0%, rgba(255, 215, 0, 0.15) 0px, transparent 50%), 
+            radial-gradient(at 100% 100%, rgba(157, 78, 221, 0.15) 0px, transparent 50%) !important;
+        background-attachment: fixed !important;
+        background-size: cover !important;
+    }
+
+    .stApp { color: #2e1065 !important; }
+
+    h1, h2, h3, .big-title {
+        background: linear-gradient(45deg, #4a1a88, #7b2cbf, #b8860b, #4a1a88) !important;
+        background-size: 300% auto !important; -webkit-background-clip: text !important; -webkit-text-fill-color: transparent !important;
+        font-weight: 900 !important; padding-bottom: 10px !important; animation: sheen 8s ease infinite !important;
+    }
+    div[data-testid="stVerticalBlock"] > div[style*="flex-direction: column;"] > div[data-testid="stVerticalBlock"] {
+        background: rgba(255, 255, 255, 0.75) !important; backdrop-filter: blur(15px) !important;
+        border: 1px solid rgba(157, 78, 221, 0.2) !important; border-radius: 20px !important; padding: 25px !important;
+        box-shadow: 0 10px 30px rgba(100, 50, 150, 0.05), inset 0 0 20px rgba(255, 255, 255, 0.8) !important;
+        margin-bottom: 20px !important;
+    }
+    /* 非 Form 的普通按鈕 */
+    .stButton>button:not([kind="primary"]) {
+        background: linear-gradient(135deg, #7b2cbf 0%, #9d4edd 100%) !important; color: #ffffff !important; border: none !important;
+        border-radius: 12px !important; box-shadow: 0 5px 15px rgba(123, 44, 191, 0.3) !important;
+    }
+    button[kind="secondary"] {
+        background: transparent !important; border: 2px solid #7b2cbf !important; color: #7b2cbf !important;
+    }
+    .stTextInput input, .stChatInput textarea, .stFileUploader {
+        background-color: rgba(255,255,255,0.8) !important; border: 2px solid #dcdcdc !important; color: #4a1a88 !important; border-radius: 12px !important;
+    }
+    .royal-divider::before, .royal-divider::after { background: linear-gradient(to right, transparent, #b8860b, transparent) !important; }
+    .royal-divider-icon { color: #b8860b; }
+    .fixed-watermark {
+        background: linear-gradient(to right, #4a1a88, #b8860b) !important; -webkit-background-clip: text !important; -webkit-text-fill-color: transparent !important;
+    }
+    .stTabs [aria-selected="true"] { color: #7B1FA2 !important; border-bottom: 3px solid #7B1FA2 !important; }
+    
+    /* 使用者氣泡 (IG Style) */
+    div[data-testid="stChatMessage"]:has(div[data-testid="stChatMessageUserAvatar"]) div[data-testid="stChatMessageContent"] {
+        background: linear-gradient(135deg, #833AB4 0%, #FD1D1D 50%, #FCAF45 100%) !important;
+    }
+    
+    /* AI 氣泡 (Messenger Gray) */
+    div[data-testid="stChatMessage"]:has(div[data-testid="stChatMessageAvatar"]) div[data-testid="stChatMessageContent"] {
+        background: #F0F2F5 !important;
+        color: #050505 !important;
+        border: none !important;
+    }
+    /* 輸入框美化 */
+    .stChatInput textarea {
+        background-color: #ffffff !important;
+        border: 1px solid #ddd !important;
+        color: black !important;
+        box-shadow: 0 2px 10px rgba(0,0,0,0.05);
+    }
+"""
+
+CSS_STRUCTURE = """
+    .stTabs [data-baseweb="tab-list"] { background: transparent !important; gap: 15px !important; }
+    .stTabs [data-baseweb="tab"] { border: none !important; font-weight: 800 !important; font-size: 1.1rem !important; }
+    .royal-divider { display: flex; align-items: center; margin: 40px 0; justify-content: center; }
+    .royal-divider::before, .royal-divider::after { content: ""; width: 40%; height: 2px; display: block; }
+    .royal-divider-icon { padding: 0 15px; font-size: 1.5rem; }
+    div[data-testid="column"] { display: flex; flex-direction: column; justify-content: center; }
+"""
+
+
+def minify_css(css):
+    """移除註解與多餘空白 (每次 rerun 都會送出整段樣式，縮短可減少傳輸量)。"""
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.S)
+    css = re.sub(r"\s+", " ", css)
+    return re.sub(r"\s*([{}:;,>])\s*", r"\1", css).strip()
+
+
+@lru_cache(maxsize=None)
+def theme_css(theme):
+    """指定主題的完整 CSS (已壓縮)；「跟隨系統」依瀏覽器的配色偏好切換暗色與亮色。"""
+    css = CSS_BASE + CSS_STRUCTURE
+    if theme == '極致黑金 (Dark)':
+        css += CSS_DARK
+    elif theme == '皇家白金 (Light)':
+        css += CSS_LIGHT
+    else:  # 跟隨系統
+        css += f"@media (prefers-color-scheme: dark) {{ {CSS_DARK} }} @media (prefers-color-scheme: light) {{ {CSS_LIGHT} }}"
+    return minify_css(css + 'html { lang: "zh-Hant"; }')
+
+
+@lru_cache(maxsize=None)
+def page_chrome(theme):
+    """每次 rerun 都要送出的固定外框：主題樣式 (帶內容雜湊) 與浮水印，合併為單一 Markdown 元素。"""
+    css = theme_css(theme)
+    version = hashlib.sha256(css.encode("utf-8")).hexdigest()[:12]
+    return f'<style data-version="{version}">{css}</style>{WATERMARK_HTML}'